@@ -19,6 +19,7 @@ from talosdht.client.dhtrestclient import DHTRestClient, DHTRestClientException,
 from talosstorage.checks import get_priv_key
 from talosstorage.chunkdata import ChunkData, DoubleEntry, create_cloud_chunk, DataStreamIdentifier, \
     TYPE_MULTI_DOUBLE_ENTRY, MultiDoubleEntry
+from talosstorage.pipeline import ChunkPipeline, chunk_sealer
 from talosstorage.timebench import TimeKeeper
 from talosvc.config import BitcoinVersionedPrivateKey
 
@@ -121,15 +122,24 @@ def run_benchmark_fetch_par(num_rounds, data_path, num_entries, granularity, fet
     key = os.urandom(32)
     identifier = DataStreamIdentifier(private_key.public_key().address(), stream_id, policy_nonce, txid)
 
-    dht_api_client = DHTRestClient(dhtip=ip, dhtport=port)
+    # one client per uploader thread
+    clients = threading.local()
 
-    for block_id, chunk_data in enumerate(extract_eth_smartmeter_data(data_path, granularity, max_entries=num_entries)):
+    def store(chunk):
+        if not hasattr(clients, "client"):
+            clients.client = DHTRestClient(dhtip=ip, dhtport=port)
         try:
-            chunk = generate_cloud_chunk(chunk_data, private_key, block_id, identifier, key=key)
-            dht_api_client.store_chunk(chunk)
-            print "Store chunk %d Num entries: %d" % (block_id, len(chunk_data.entries))
+            return clients.client.store_chunk(chunk)
         except DHTRestClientException as e:
-            print "Store round %d error: %s" % (block_id, e)
+            return e
+
+    pipeline = ChunkPipeline(chunk_sealer(identifier, get_priv_key(private_key), 0, key), store=store)
+    chunks = enumerate(extract_eth_smartmeter_data(data_path, granularity, max_entries=num_entries))
+    for block_id, _, result in pipeline.run(chunks):
+        if isinstance(result, DHTRestClientException):
+            print "Store round %d error: %s" % (block_id, result)
+        else:
+            print "Store chunk %d" % block_id
 
     num_fetches = num_entries / granularity
     if not num_entries % granularity == 0:
@@ -9,7 +9,7 @@ sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
 
 from benchmarklogger import FileBenchmarkLogger, SQLLiteBenchmarkLogger
 from talosstorage.chunkdata import ChunkData, DoubleEntry, compress_data, MultiDoubleEntry, TYPE_MULTI_DOUBLE_ENTRY, \
-    TYPE_MULTI_INT_ENTRY, MultiIntegerEntry
+    TYPE_MULTI_INT_ENTRY, MultiIntegerEntry, TimeSeriesEntry
 from talosstorage.timebench import TimeKeeper
 
 pattern_data = re.compile("(.*).csv")
@@ -19,6 +19,12 @@ def date_to_unixstamp(date_str):
     return int(time.mktime(datetime.datetime.strptime(date_str, "%Y-%m-%d").timetuple()))
 
 
+def encode_chunk(chunk, timeseries=False):
+    if timeseries:
+        return ChunkData(entries_in=[TimeSeriesEntry.from_entries(chunk.entries)]).encode()
+    return chunk.encode()
+
+
 def to_string_id(number):
     if number < 10:
         return "0%d" % number
@@ -78,6 +84,8 @@ if __name__ == "__main__":
     parser.add_argument('--name', type=str, help='name', default="COMPRESSION_ETH_PLUG", required=False)
     parser.add_argument('--data_path', type=str, help="data_path", default="/home/lubums/msthesis/blockchain/raw-data/ECOSmart", required=False)
     parser.add_argument('--do_smartmeter', type=bool, help='do_smartmeter', default=True, required=False)
+    parser.add_argument('--timeseries', dest='timeseries', action='store_true',
+                        help='encode the chunks with the delta/XOR time series codec')
     args = parser.parse_args()
 
     LOGGING_FIELDS = ["num_chunk_entries", "size_before", "size_compressed"]
@@ -95,14 +103,14 @@ if __name__ == "__main__":
             print "Chunk size: %d" % chunk_size
             if args.do_smartmeter:
                 for chunk in extract_eth_smartmeter_data(args.data_path, chunk_size):
-                    encoded = chunk.encode()
+                    encoded = encode_chunk(chunk, timeseries=args.timeseries)
                     data_compressed = compress_data(encoded)
                     #print "Before: %d After: %d" % (len(encoded), len(data_compressed))
                     size_plain += len(encoded)
                     size_compressed += len(data_compressed)
             else:
                 for chunk in extract_eth_plug_data(args.data_path, chunk_size, 1, 1):
-                    encoded = chunk.encode()
+                    encoded = encode_chunk(chunk, timeseries=args.timeseries)
                     data_compressed = compress_data(encoded)
                     print "Before: %d After: %d" % (len(encoded), len(data_compressed))
                     size_plain += len(encoded)
@@ -10,14 +10,18 @@ from benchmarklogger import SQLLiteBenchmarkLogger, FileBenchmarkLogger
 from talosstorage.chunkdata import *
 
 
-def benchmark_chunks(num_rounds, local_logger, chunk_size, max_float=10000, tag_size=10):
+def benchmark_chunks(num_rounds, local_logger, chunk_size, max_float=10000, tag_size=10, columnar=False,
+                     metadata_table=False):
     key = os.urandom(32)
     private_key = ec.generate_private_key(ec.SECP256K1, default_backend())
     stream_ident = DataStreamIdentifier("pubaddr", 3, "asvcgdterategdts",
                                         "59f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb")
     for round in range(num_rounds):
         time_keeper = TimeKeeper()
-        chunk = ChunkData()
+        if columnar:
+            chunk = ColumnarChunkData(max_size=chunk_size)
+        else:
+            chunk = ChunkData(max_size=chunk_size, use_metadata_table=metadata_table)
         for i in range(chunk_size):
             entry = DoubleEntry(int(time.time()), "a" * tag_size, random.uniform(0, max_float))
             chunk.add_entry(entry)
@@ -44,6 +48,9 @@ if __name__ == "__main__":
     parser.add_argument('--chunk_size', type=int, help='chunk_size', default=10000, required=False)
     parser.add_argument('--log_db', type=str, help='log_db', default=None, required=False)
     parser.add_argument('--name', type=str, help='name', default="CHUNK_LOCAL", required=False)
+    parser.add_argument('--columnar', action='store_true', help='use the columnar chunk format', required=False)
+    parser.add_argument('--metadata_table', action='store_true', help='store the metadata once per chunk',
+                        required=False)
     args = parser.parse_args()
 
     LOGGING_FIELDS = ["time_create_chunk", "chunk_compression", "gcm_encryption", "ecdsa_signature",
@@ -55,6 +62,7 @@ if __name__ == "__main__":
         logger = SQLLiteBenchmarkLogger(args.log_db, LOGGING_FIELDS, "%s" % (args.name,))
 
     try:
-        benchmark_chunks(args.num_rounds, logger, args.chunk_size, max_float=args.max_float, tag_size=args.tag_size)
+        benchmark_chunks(args.num_rounds, logger, args.chunk_size, max_float=args.max_float, tag_size=args.tag_size,
+                         columnar=args.columnar, metadata_table=args.metadata_table)
     finally:
         logger.close()
@@ -3,9 +3,7 @@ import base64
 import os
 import binascii
 import threading
-from StringIO import StringIO
 
-import boto3
 import sys
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
 
@@ -23,7 +21,7 @@ import random
 
 # Assumes S3 credentials ar located in ~/.aws/credentials
 # (see https://boto3.readthedocs.io/en/latest/guide/quickstart.html)
-from talosstorage.storage import TalosStorage
+from talosstorage.s3storage import TalosS3Storage, create_s3_object, store_data_s3, get_data_s3, clean_bucket
 from talosstorage.timebench import TimeKeeper
 from talosvc.talosclient.restapiclient import TalosVCRestClient
 
@@ -81,38 +79,6 @@ def generate_random_chunk_from_data(chunk, private_key, block_id, stream_identif
     return cloud_chunk
 
 
-def create_s3_object():
-    return boto3.resource('s3')
-
-
-def store_data_s3(s3, key, data, bucket_name):
-    s3.Object(bucket_name, key).upload_fileobj(StringIO(data))
-
-
-def get_data_s3(s3, key, bucket_name):
-    s3_object = s3.Object(bucket_name, key)
-    return s3_object.get()['Body'].read()
-
-
-def clean_bucket(s3, bucket_name):
-    bucket = s3.Bucket(bucket_name)
-    for key in bucket.objects.all():
-        key.delete()
-
-
-class TalosS3Storage(TalosStorage):
-
-    def __init__(self, bucket_name):
-        self.s3 = create_s3_object()
-        self.bucket_name = bucket_name
-
-    def _get_chunk(self, chunk_key):
-        return CloudChunk.decode(get_data_s3(self.s3, binascii.hexlify(chunk_key), self.bucket_name))
-
-    def _store_chunk(self, chunk):
-        store_data_s3(self.s3,  binascii.hexlify(chunk.key), chunk.encode(), self.bucket_name)
-
-
 class PlainS3Storage(object):
     def __init__(self, bucket_name):
         self.s3 = create_s3_object()
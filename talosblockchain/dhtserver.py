@@ -31,6 +31,7 @@ if __name__ == "__main__":
                         required=False)
     parser.add_argument('--secure', dest='secure', action='store_true', required=False)
     parser.add_argument('--tls_port', type=int, help='tls_port', default=-1, required=False)
+    parser.add_argument('--chunk_cache_mb', type=int, help='chunk_cache_mb', default=0, required=False)
     parser.set_defaults(secure=False)
     args = parser.parse_args()
     f = None
@@ -41,7 +42,7 @@ if __name__ == "__main__":
         f = open(args.logfile,'w')
         log.startLogging(f)
 
-    storage = TalosLevelDBDHTStorage(args.dhtdbpath)
+    storage = TalosLevelDBDHTStorage(args.dhtdbpath, chunk_cache_bytes=args.chunk_cache_mb * 1024 * 1024)
     vc_server = AsyncPolicyApiClient(ip=args.vcserver, port=args.vcport)
 
     if args.dht_cache_file is None:
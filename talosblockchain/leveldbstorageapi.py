@@ -10,12 +10,15 @@ if __name__ == "__main__":
     parser.add_argument('--vcserver', type=str, help='server', default="127.0.0.1", required=False)
     parser.add_argument('--port', type=int, help='dir', default=12000, required=False)
     parser.add_argument('--server', type=str, help='server', default="127.0.0.1", required=False)
+    parser.add_argument('--stream_index', dest='stream_index', action='store_true', required=False)
+    parser.add_argument('--chunk_cache_mb', type=int, help='chunk_cache_mb', default=0, required=False)
     args = parser.parse_args()
 
     VC_IP = args.vcserver
     VC_PORT = args.vcport
 
     client = TalosVCRestClient(ip=args.vcserver, port=args.vcport)
-    set_storage_impl(LevelDBStorage("./leveldb"))
+    set_storage_impl(LevelDBStorage("./leveldb", stream_index=args.stream_index,
+                                     chunk_cache_bytes=args.chunk_cache_mb * 1024 * 1024))
     set_vc_client(client)
     app.run(debug=False, host=args.server, port=args.port)
\ No newline at end of file
@@ -1,5 +1,10 @@
+import multiprocessing
 import os
+import socket
 import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 """
 assumes lepton is installed:
@@ -13,18 +18,171 @@ if os.uname()[4][:3] == 'arm':
 else:
     CMD = ["lepton", '-']
 
+SERVER_START_TIMEOUT = 10
+_SOCKET_BLOCK_SIZE = 64 * 1024
 
-def compress_jpg_file(jpg_file):
-    with open(jpg_file, 'r') as f:
+
+def _run_lepton(data):
+    p = subprocess.Popen(CMD, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
+    out, _ = p.communicate(input=data)
+    return out
+
+
+def _run_lepton_file(path):
+    with open(path, 'r') as f:
         p = subprocess.Popen(CMD, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=f)
         out, _ = p.communicate()
     return out
 
 
+def _run_lepton_socket(socket_path, blocks):
+    """
+    Sends the input to a lepton server, which answers after the client closed its write side
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        for block in blocks:
+            sock.sendall(block)
+        sock.shutdown(socket.SHUT_WR)
+        out = []
+        while True:
+            block = sock.recv(_SOCKET_BLOCK_SIZE)
+            if not block:
+                break
+            out.append(block)
+        return "".join(out)
+    finally:
+        sock.close()
+
+
+def _iter_file_blocks(path):
+    with open(path, 'r') as f:
+        while True:
+            block = f.read(_SOCKET_BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+
+
+class LeptonPool(object):
+    """
+    Runs lepton with a bounded concurrency, the items of a batch run in parallel and at most
+    max_workers items run at the same time, also across threads
+    (e.g. lepton-scalar with 128M per process on the raspberry).
+    Without a socket path each item starts a lepton process. With a socket path the items are sent
+    to a long-lived lepton server (lepton -socket), which forks an initialized child per connection
+    instead of starting and initializing a new process per item.
+    The threads only wait for the processes, the GIL is released.
+    """
+    def __init__(self, max_workers=None, socket_path=None, start_server=False):
+        """
+        Create a pool
+        :param max_workers: the maximum number of concurrent lepton processes, default number of cpus
+        :param socket_path: the unix socket of a lepton server (optional)
+        :param start_server: if True, the pool starts the lepton server on socket_path and stops it on close
+        """
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.socket_path = socket_path
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._threads = None
+        self._server = None
+        self._lock = threading.Lock()
+        if start_server:
+            self._start_server()
+
+    def _start_server(self):
+        if self.socket_path is None:
+            raise ValueError("The lepton server needs a socket path")
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        cmd = CMD[:-1] + ['-socket=%s' % self.socket_path, '-max_children=%d' % self.max_workers, '-preload']
+        self._server = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while not os.path.exists(self.socket_path):
+            if self._server.poll() is not None or time.time() > deadline:
+                self._stop_server()
+                raise IOError("The lepton server did not start")
+            time.sleep(0.01)
+
+    def _stop_server(self):
+        if self._server is not None:
+            if self._server.poll() is None:
+                self._server.terminate()
+            self._server.wait()
+            self._server = None
+
+    def run(self, data):
+        """
+        Compresses a jpg or decompresses a lepton file (lepton detects the direction)
+        """
+        with self._slots:
+            if self.socket_path is not None:
+                return _run_lepton_socket(self.socket_path, [data])
+            return _run_lepton(data)
+
+    def run_file(self, path):
+        """
+        Same as run for a file, the file is streamed to lepton and not read into memory
+        """
+        with self._slots:
+            if self.socket_path is not None:
+                return _run_lepton_socket(self.socket_path, _iter_file_blocks(path))
+            return _run_lepton_file(path)
+
+    def map(self, data_list):
+        """
+        Runs lepton on all items in parallel
+        :param data_list: list of jpg or lepton data
+        :return: list of the results in the same order
+        """
+        if len(data_list) <= 1 or self.max_workers == 1:
+            return [self.run(data) for data in data_list]
+        return self._get_threads().map(self.run, data_list)
+
+    def _get_threads(self):
+        with self._lock:
+            if self._threads is None:
+                self._threads = ThreadPool(self.max_workers)
+            return self._threads
+
+    def close(self):
+        with self._lock:
+            if self._threads is not None:
+                self._threads.close()
+                self._threads.join()
+                self._threads = None
+            self._stop_server()
+
+
+_DEFAULT_POOL = None
+_DEFAULT_POOL_LOCK = threading.Lock()
+
+
+def get_default_pool():
+    global _DEFAULT_POOL
+    with _DEFAULT_POOL_LOCK:
+        if _DEFAULT_POOL is None:
+            _DEFAULT_POOL = LeptonPool()
+        return _DEFAULT_POOL
+
+
+def set_default_pool(pool):
+    """
+    Replaces the pool used by the module functions e.g. to change the concurrency limit
+    :param pool: a LeptonPool object
+    """
+    global _DEFAULT_POOL
+    with _DEFAULT_POOL_LOCK:
+        _DEFAULT_POOL = pool
+
+
+def compress_jpg_file(jpg_file):
+    return get_default_pool().run_file(jpg_file)
+
+
 def compress_jpg_data(data):
-    p = subprocess.Popen(CMD, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-    out, _ = p.communicate(input=data)
-    return out
+    return get_default_pool().run(data)
 
 
 def decompress_jpg_file(lepton_file):
@@ -34,3 +192,10 @@ def decompress_jpg_file(lepton_file):
 def decompress_jpg_data(data):
     return compress_jpg_data(data)
 
+
+def compress_jpg_data_batch(data_list):
+    return get_default_pool().map(data_list)
+
+
+def decompress_jpg_data_batch(data_list):
+    return compress_jpg_data_batch(data_list)
@@ -1,8 +1,44 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 
 from pylepton.lepton import *
 
 
+class ReversingServer(object):
+    """
+    Stand-in for a lepton server, answers each connection with the reversed input
+    """
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(socket_path)
+        self.sock.listen(8)
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            data = []
+            while True:
+                block = conn.recv(4096)
+                if not block:
+                    break
+                data.append(block)
+            conn.sendall("".join(data)[::-1])
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
 class TestLepton(unittest.TestCase):
 
     def test_compress_file(self):
@@ -31,3 +67,30 @@ class TestLepton(unittest.TestCase):
         self.assertEquals(pic, after)
 
 
+
+    def test_pool_batch(self):
+        with open("./pylepton/haas.jpg", 'r') as f:
+            pic = f.read()
+        pool = LeptonPool(max_workers=2)
+        out = pool.map([pic] * 4)
+        self.assertEquals(4, len(out))
+        self.assertEquals([pic] * 4, pool.map(out))
+        pool.close()
+
+    def test_pool_socket(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            socket_path = os.path.join(tmp_dir, "lepton.sock")
+            server = ReversingServer(socket_path)
+            pool = LeptonPool(max_workers=2, socket_path=socket_path)
+            data = [os.urandom(100000) for _ in range(4)]
+            self.assertEquals([item[::-1] for item in data], pool.map(data))
+
+            path = os.path.join(tmp_dir, "pic.jpg")
+            with open(path, 'w') as f:
+                f.write(data[0])
+            self.assertEquals(data[0][::-1], pool.run_file(path))
+            pool.close()
+            server.close()
+        finally:
+            shutil.rmtree(tmp_dir)
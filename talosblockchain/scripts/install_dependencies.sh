@@ -38,6 +38,7 @@ sudo pip install kademlia
 sudo pip install requests
 sudo pip install cryptography
 sudo pip install cachetools
+sudo pip install numpy
 sudo pip install leveldb
 sudo pip install --upgrade pyopenssl
 sudo pip install service_identity
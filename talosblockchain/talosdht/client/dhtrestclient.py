@@ -41,9 +41,10 @@ def get_stream_identifier(owner, stream_id, nonce_policy, txid):
     return DataStreamIdentifier(owner, stream_id, nonce_policy, txid)
 
 
-def generate_token(block_id, private_key, stream_ident, nonce):
-    return generate_query_token(stream_ident.owner, stream_ident.streamid, nonce,
-                                stream_ident.get_key_for_blockid(block_id), private_key)
+def generate_token(block_id, private_key, stream_ident, nonce, chunk_key=None):
+    if chunk_key is None:
+        chunk_key = stream_ident.get_key_for_blockid(block_id)
+    return generate_query_token(stream_ident.owner, stream_ident.streamid, nonce, chunk_key, private_key)
 
 
 class FetchThread(threading.Thread):
@@ -58,10 +59,11 @@ class FetchThread(threading.Thread):
         self.private_key = private_key
 
     def run(self):
-        for block_id in self.blockids:
+        chunk_keys = self.stream_identifier.get_keys_for_blockids(self.blockids)
+        for block_id, chunk_key in zip(self.blockids, chunk_keys):
             try:
-                chunk = self.connection.fetch_chunk(block_id, self.private_key,
-                                                    self.stream_identifier, time_keeper=self.time_keeper)
+                chunk = self.connection.fetch_chunk(block_id, self.private_key, self.stream_identifier,
+                                                    time_keeper=self.time_keeper, chunk_key=chunk_key)
                 self.result_store[self.my_id].append(chunk)
             except DHTRestClientException as e:
                 print e
@@ -111,10 +113,11 @@ class DHTRestClient(object):
         else:
             raise DHTRestClientException("Store chunk error", code, reason, text)
 
-    def fetch_chunk(self, block_id, private_key, stream_identifier, time_keeper=TimeKeeper()):
+    def fetch_chunk(self, block_id, private_key, stream_identifier, time_keeper=TimeKeeper(), chunk_key=None):
+        if chunk_key is None:
+            chunk_key = stream_identifier.get_key_for_blockid(block_id)
         time_keeper.start_clock()
-        reason, code, address = get_chunk_addr(self.session, stream_identifier.get_key_for_blockid(block_id),
-                                               self.dhtip, self.dhtport)
+        reason, code, address = get_chunk_addr(self.session, chunk_key, self.dhtip, self.dhtport)
         time_keeper.stop_clock(TIME_FETCH_ADDRESS)
 
         if code != 200:
@@ -132,7 +135,7 @@ class DHTRestClient(object):
             raise DHTRestClientException("Fetch nonce error", code, reason, nonce)
 
         nonce = str(nonce)
-        token = generate_token(block_id, private_key, stream_identifier, nonce)
+        token = generate_token(block_id, private_key, stream_identifier, nonce, chunk_key=chunk_key)
 
         time_keeper.start_clock()
         reason, code, chunk = get_chunk_peer(self.session, token.to_json(), ip, int(port))
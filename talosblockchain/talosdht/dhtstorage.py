@@ -2,11 +2,19 @@ import struct
 import time
 
 from kademlia.storage import IStorage
-from twisted.internet import threads
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
 from zope.interface import implements
 
-from talosstorage.chunkdata import CloudChunk
+from talosstorage.chunkdata import CloudChunk, HASH_BYTES
 from talosstorage.storage import LevelDBStorage
+from talosstorage.timebench import TimeKeeper
+
+DEFAULT_IO_THREADS = 4
+# the store time of a chunk is refreshed on a read only if it is older
+TIME_REFRESH_SECONDS = 60
+
+_IO_THREADPOOL = None
 
 
 def add_time_chunk(encoded_chunk):
@@ -22,35 +30,67 @@ def get_time_and_chunk(encoded):
 class TalosLevelDBDHTStorage(LevelDBStorage):
     implements(IStorage)
 
-    def __init__(self, db_dir):
-        LevelDBStorage.__init__(self, db_dir)
+    def __init__(self, db_dir, stream_index=False, chunk_cache_bytes=0, key_index=True):
+        """
+        :param db_dir: the leveldb directory
+        :param stream_index: see LevelDBStorage
+        :param chunk_cache_bytes: see LevelDBStorage
+        :param key_index: if True, the keys of the stored chunks are kept in memory (rebuilt from a key-only
+                          scan on startup, ~100 bytes per chunk), has_value does not read the db
+        """
+        LevelDBStorage.__init__(self, db_dir, stream_index=stream_index, chunk_cache_bytes=chunk_cache_bytes)
+        self.key_index = set(self.iter_chunk_keys()) if key_index else None
+
+    def _iter_chunk_items(self):
+        # skips the stream index entries
+        for key, value in self.db.RangeIter():
+            if len(key) == HASH_BYTES:
+                yield key, value
 
     def iteritemsOlderThan(self, secondsOld):
         cur_time = int(time.time())
-        for key, value in self.db.RangeIter():
+        for key, value in self._iter_chunk_items():
             time_value, real_value = get_time_and_chunk(value)
             if cur_time - time_value > secondsOld:
                 yield key, real_value
 
-    def _store_chunk(self, chunk):
-        self.db.Put(chunk.key, add_time_chunk(chunk.encode()))
+    def _encode_value(self, chunk):
+        return add_time_chunk(chunk.encode())
+
+    def _store_chunk(self, chunk, block_id=None):
+        LevelDBStorage._store_chunk(self, chunk, block_id=block_id)
+        if self.key_index is not None:
+            self.key_index.add(chunk.key)
+
+    def _store_chunks(self, chunks, block_ids=None):
+        LevelDBStorage._store_chunks(self, chunks, block_ids=block_ids)
+        if self.key_index is not None:
+            self.key_index.update(chunk.key for chunk in chunks)
+
+    def _delete_chunk(self, chunk_key):
+        if self.key_index is not None:
+            self.key_index.discard(chunk_key)
+        LevelDBStorage._delete_chunk(self, chunk_key)
 
     def iteritems(self):
-        for key, value in self.db.RangeIter():
+        for key, value in self._iter_chunk_items():
             _, real_value = get_time_and_chunk(value)
             yield key, real_value
 
     def __setitem__(self, key, value):
         self._store_chunk(value)
+        self._invalidate_cached_chunks([value.key])
 
     def __getitem__(self, key):
         self._get_chunk(key)
 
     def get(self, key, default=None):
-        res = self._get_chunk(key)
+        res = self._load_chunk(key)
         return default if res is None else res
 
     def has_value(self, to_find):
+        if self.key_index is not None:
+            return to_find in self.key_index
         try:
             self.db.Get(to_find)
             return True
@@ -62,10 +102,82 @@ class TalosLevelDBDHTStorage(LevelDBStorage):
             encoded = self.db.Get(chunk_key)
         except KeyError:
             return None
-        _, bin_chunk = get_time_and_chunk(encoded)
-
-        def store_update():
-            self.db.Put(chunk_key, add_time_chunk(bin_chunk))
-
-        threads.deferToThread(store_update)
-        return CloudChunk.decode(bin_chunk)
+        time_value, bin_chunk = get_time_and_chunk(memoryview(encoded))
+        chunk = CloudChunk.decode(bin_chunk)
+        if int(time.time()) - time_value < TIME_REFRESH_SECONDS:
+            return chunk
+        # not on the read path, the write is queued from the reactor (reads may run in the io threads)
+        reactor.callFromThread(lambda: threads.deferToThreadPool(reactor, get_io_threadpool(),
+                                                                 self._refresh_time, chunk_key, chunk))
+        return chunk
+
+    def _refresh_time(self, chunk_key, chunk):
+        """
+        Rewrites the chunk with the current time, skipped if the chunk was deleted since the read
+        :param chunk_key: the key of the chunk
+        :param chunk: the CloudChunk object read
+        """
+        if self.key_index is not None:
+            if chunk_key not in self.key_index:
+                return
+        elif not self.has_value(chunk_key):
+            return
+        self.db.Put(chunk_key, add_time_chunk(chunk.encode()))
+
+
+def get_io_threadpool():
+    """
+    Returns the shared thread pool for the storage io, started on first use and stopped with the reactor
+    """
+    global _IO_THREADPOOL
+    if _IO_THREADPOOL is None:
+        _IO_THREADPOOL = ThreadPool(minthreads=1, maxthreads=DEFAULT_IO_THREADS, name="talos-storage-io")
+        _IO_THREADPOOL.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', _IO_THREADPOOL.stop)
+    return _IO_THREADPOOL
+
+
+class AsyncTalosStorage(object):
+    """
+    Non-blocking interface of a talos storage for the twisted reactor. The disk io and the checks
+    run in a bounded thread pool, the methods return Deferreds.
+    """
+    def __init__(self, storage, threadpool=None):
+        """
+        :param storage: the blocking TalosStorage e.g. TalosLevelDBDHTStorage
+        :param threadpool: a started twisted ThreadPool, default the shared pool (see get_io_threadpool)
+        """
+        self.storage = storage
+        self.threadpool = threadpool
+
+    def _run(self, func, *args, **kwargs):
+        return threads.deferToThreadPool(reactor, self.threadpool or get_io_threadpool(), func, *args, **kwargs)
+
+    def store_check_chunk(self, chunk, chunk_id, policy, time_keeper=TimeKeeper()):
+        """
+        See TalosStorage.store_check_chunk
+        :return: Deferred, fails with InvalidChunkError if the chunk is not valid
+        """
+        return self._run(self.storage.store_check_chunk, chunk, chunk_id, policy, time_keeper=time_keeper)
+
+    def get_check_chunk(self, chunk_key, pubkey, policy, time_keeper=TimeKeeper()):
+        """
+        See TalosStorage.get_check_chunk
+        :return: Deferred with the CloudChunk, fails with InvalidAccess if the access is not valid
+        """
+        return self._run(self.storage.get_check_chunk, chunk_key, pubkey, policy, time_keeper=time_keeper)
+
+    def has_value(self, chunk_key):
+        """
+        :return: Deferred with True if the chunk is stored locally
+        """
+        if getattr(self.storage, 'key_index', None) is not None:
+            # in-memory lookup, no io
+            return defer.succeed(self.storage.has_value(chunk_key))
+        return self._run(self.storage.has_value, chunk_key)
+
+    def get_items_older_than(self, seconds_old):
+        """
+        :return: Deferred with the list of (key, value) stored before seconds_old seconds
+        """
+        return self._run(lambda: list(self.storage.iteritemsOlderThan(seconds_old)))
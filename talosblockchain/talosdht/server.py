@@ -17,7 +17,7 @@ from twisted.python.modules import getModule
 
 from talosdht.asyncpolicy import AsyncPolicyApiClient
 from talosdht.crawlers import TalosChunkSpiderCrawl, TimedNodeSpiderCrawl
-from talosdht.dhtstorage import TalosLevelDBDHTStorage
+from talosdht.dhtstorage import TalosLevelDBDHTStorage, AsyncTalosStorage
 from talosdht.protocolsecurity import generate_keys_with_crypto_puzzle, pub_to_node_id, serialize_priv_key, \
     deserialize_priv_key
 from talosdht.talosprotocol import TalosKademliaProtocol, TalosHTTPClient, QueryChunk, StoreLargeChunk, \
@@ -58,6 +58,7 @@ class TalosDHTServer(object):
         self.alpha = alpha
         self.log = Logger(system=self)
         self.storage = storage or TalosLevelDBDHTStorage("./leveldb")
+        self.async_storage = AsyncTalosStorage(self.storage)
         self.node = Node(id or digest(random.getrandbits(255)))
 
         def start_looping_call(num_seconds):
@@ -66,7 +67,8 @@ class TalosDHTServer(object):
         self.delay = rebub_delay
         task.deferLater(reactor, rebub_delay, start_looping_call, rebub_delay)
         self.talos_vc = talos_vc or AsyncPolicyApiClient()
-        self.protocol = TalosKademliaProtocol(self.node, self.storage, ksize, talos_vc=self.talos_vc)
+        self.protocol = TalosKademliaProtocol(self.node, self.storage, ksize, talos_vc=self.talos_vc,
+                                              async_storage=self.async_storage)
         self.httpprotocol_client = None
         self.tls_port = tls_port
 
@@ -78,8 +80,10 @@ class TalosDHTServer(object):
         if self.tls_port != -1:
             root1 = Resource()
             root2 = Resource()
-            root1.putChild("get_chunk", QueryChunk(self.storage, talos_vc=self.talos_vc))
-            root2.putChild("storelargechunk", StoreLargeChunk(self.storage, self.protocol, talos_vc=self.talos_vc))
+            root1.putChild("get_chunk", QueryChunk(self.storage, talos_vc=self.talos_vc,
+                                                    async_storage=self.async_storage))
+            root2.putChild("storelargechunk", StoreLargeChunk(self.storage, self.protocol, talos_vc=self.talos_vc,
+                                                                    async_storage=self.async_storage))
             factory1 = Site(root1)
             factory2 = Site(root2)
 
@@ -93,8 +97,10 @@ class TalosDHTServer(object):
             return reactor.listenUDP(port, self.protocol, interface, maxPacketSize=65535)
         else:
             root = Resource()
-            root.putChild("get_chunk", QueryChunk(self.storage, talos_vc=self.talos_vc))
-            root.putChild("storelargechunk", StoreLargeChunk(self.storage, self.protocol, talos_vc=self.talos_vc))
+            root.putChild("get_chunk", QueryChunk(self.storage, talos_vc=self.talos_vc,
+                                                    async_storage=self.async_storage))
+            root.putChild("storelargechunk", StoreLargeChunk(self.storage, self.protocol, talos_vc=self.talos_vc,
+                                                                    async_storage=self.async_storage))
             factory = Site(root)
 
             self.httpprotocol_client = TalosHTTPClient(self.protocol, port)
@@ -115,14 +121,15 @@ class TalosDHTServer(object):
             spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
             ds.append(spider.find())
 
-        def republishKeys(_):
+        def republishKeys(items):
             ds = []
             # Republish keys older than one hour
-            for dkey, value in self.storage.iteritemsOlderThan(self.delay):
+            for dkey, value in items:
                 ds.append(self.digest_set(digest(dkey), value))
             return defer.gatherResults(ds)
 
-        return defer.gatherResults(ds).addCallback(republishKeys)
+        return defer.gatherResults(ds).addCallback(
+            lambda _: self.async_storage.get_items_older_than(self.delay)).addCallback(republishKeys)
 
     def bootstrappableNeighbors(self):
         """
@@ -184,20 +191,23 @@ class TalosDHTServer(object):
         return result
 
     def get_addr_chunk(self, chunk_key, policy_in=None, time_keeper=TimeKeeper()):
-        # if this node has it, return it
-        if self.storage.has_value(chunk_key):
-            addr = self.protocol.get_address()
-            return defer.succeed("%s:%d" % (addr[0], addr[1]))
-        dkey = digest(chunk_key)
-        node = Node(dkey)
-        nearest = self.protocol.router.findNeighbors(node)
-        self.log.debug("Crawling for key %s" % (binascii.hexlify(dkey),))
-        if len(nearest) == 0:
-            self.log.warning("There are no known neighbors to get key %s" % binascii.hexlify(dkey))
-            return defer.succeed(None)
-        spider = TalosChunkSpiderCrawl(self.protocol, self.httpprotocol_client, node, chunk_key, nearest, self.ksize,
-                                       self.alpha, time_keeper=time_keeper)
-        return spider.find()
+        def handle_has_value(has_value):
+            # if this node has it, return it
+            if has_value:
+                addr = self.protocol.get_address()
+                return "%s:%d" % (addr[0], addr[1])
+            dkey = digest(chunk_key)
+            node = Node(dkey)
+            nearest = self.protocol.router.findNeighbors(node)
+            self.log.debug("Crawling for key %s" % (binascii.hexlify(dkey),))
+            if len(nearest) == 0:
+                self.log.warning("There are no known neighbors to get key %s" % binascii.hexlify(dkey))
+                return None
+            spider = TalosChunkSpiderCrawl(self.protocol, self.httpprotocol_client, node, chunk_key, nearest,
+                                           self.ksize, self.alpha, time_keeper=time_keeper)
+            return spider.find()
+
+        return self.async_storage.has_value(chunk_key).addCallback(handle_has_value)
 
     def digest_set(self, dkey, value, policy_in=None, time_keeper=TimeKeeper()):
         """
@@ -230,15 +240,19 @@ class TalosDHTServer(object):
 
                 def handle_policy(policy):
                     time_keeper.stop_clock(ENTRY_FETCH_POLICY)
-                    # Hack no chunk id given -> no key checks, key is in the encoded chunk
-                    id = time_keeper.start_clock_unique()
-                    self.storage.store_check_chunk(chunk, None, policy, time_keeper=time_keeper)
-                    time_keeper.stop_clock_unique(ENTRY_STORE_CHECK, id)
 
+                    def handle_stored(_):
+                        time_keeper.stop_clock_unique(ENTRY_STORE_CHECK, id)
+
+                        id_all = time_keeper.start_clock_unique()
+                        ds = [self.protocol.callStore(n, dkey, value) for n in nodes]
+                        return defer.DeferredList(ds).addCallback(_anyRespondSuccess, time_keeper, id_all,
+                                                                  ENTRY_STORE_TO_ALL_NODES)
+
+                    # Hack no chunk id given -> no key checks, key is in the encoded chunk
                     id = time_keeper.start_clock_unique()
-                    ds = [self.protocol.callStore(n, dkey, value) for n in nodes]
-                    return defer.DeferredList(ds).addCallback(_anyRespondSuccess, time_keeper, id,
-                                                              ENTRY_STORE_TO_ALL_NODES)
+                    return self.async_storage.store_check_chunk(chunk, None, policy, time_keeper=time_keeper) \
+                        .addCallback(handle_stored)
 
                 if not policy_in is None:
                     return handle_policy(policy_in)
@@ -317,6 +331,7 @@ class TalosSecureDHTServer(TalosDHTServer):
         self.alpha = alpha
         self.log = Logger(system=self)
         self.storage = storage or TalosLevelDBDHTStorage("./leveldb")
+        self.async_storage = AsyncTalosStorage(self.storage)
         self.c1bits = c1bits
 
         if priv_key is None:
@@ -335,7 +350,8 @@ class TalosSecureDHTServer(TalosDHTServer):
 
         self.talos_vc = talos_vc or AsyncPolicyApiClient()
         self.protocol = TalosSKademliaProtocol(self.priv_key, self.node,
-                                               self.storage, ksize, talos_vc=self.talos_vc, cbits=c1bits)
+                                               self.storage, ksize, talos_vc=self.talos_vc, cbits=c1bits,
+                                               async_storage=self.async_storage)
         self.httpprotocol_client = None
         self.tls_port = tls_port
 
@@ -17,10 +17,11 @@ from twisted.web.http_headers import Headers
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
+from talosdht.dhtstorage import AsyncTalosStorage
 from talosdht.talosudprpc import TalosRPCProtocol, TalosWeakSignedRPCProtocol
 from talosdht.util import *
 from talosstorage.checks import check_query_token_valid, InvalidQueryToken, get_and_check_query_token, CloudChunk
-from talosstorage.storage import InvalidChunkError
+from talosstorage.storage import InvalidChunkError, InvalidAccess
 from talosstorage.timebench import TimeKeeper
 from talosvc.talosclient.restapiclient import TalosVCRestClient, TalosVCRestClientError
 
@@ -72,10 +73,11 @@ class TalosKademliaProtocol(TalosRPCProtocol):
     New protocol for the talos storage, base protocol from bmuller's implementation
     """
 
-    def __init__(self, sourceNode, storage, ksize, talos_vc=TalosVCRestClient()):
+    def __init__(self, sourceNode, storage, ksize, talos_vc=TalosVCRestClient(), async_storage=None):
         TalosRPCProtocol.__init__(self)
         self.router = TalosKademliaRoutingTable(self, ksize, sourceNode)
         self.storage = storage
+        self.async_storage = async_storage or AsyncTalosStorage(storage)
         self.sourceNode = sourceNode
         self.log = Logger(system=self)
         self.talos_vc = talos_vc
@@ -118,17 +120,25 @@ class TalosKademliaProtocol(TalosRPCProtocol):
             def handle_policy(policy):
                 time_keeper.stop_clock(ENTRY_FETCH_POLICY)
 
+                def handle_stored(_):
+                    time_keeper.stop_clock_unique(ENTRY_STORE_CHECK, id)
+
+                    time_keeper.stop_clock_unique(ENTRY_TOTAL_STORE_LOCAL, total_time_id)
+                    self.log.debug("%s %s %s" % (BENCH_TAG, TYPE_STORE_CHUNK_LOCAL, time_keeper.get_summary()))
+                    return {'value': 'ok'}
+
                 # Hack no chunk id given -> no key checks, key is in the encoded chunk
                 id = time_keeper.start_clock_unique()
-                self.storage.store_check_chunk(chunk, None, policy, time_keeper=time_keeper)
-                time_keeper.stop_clock_unique(ENTRY_STORE_CHECK, id)
+                return self.async_storage.store_check_chunk(chunk, None, policy, time_keeper=time_keeper) \
+                    .addCallback(handle_stored)
 
-                time_keeper.stop_clock_unique(ENTRY_TOTAL_STORE_LOCAL, total_time_id)
-                self.log.debug("%s %s %s" % (BENCH_TAG, TYPE_STORE_CHUNK_LOCAL, time_keeper.get_summary()))
-                return {'value': 'ok'}
+            def handle_invalid_chunk(failure):
+                failure.trap(InvalidChunkError)
+                return {'error': failure.value.value}
 
             time_keeper.start_clock()
-            return self.talos_vc.get_policy_with_txid(chunk.get_tag_hex()).addCallback(handle_policy)
+            return self.talos_vc.get_policy_with_txid(chunk.get_tag_hex()).addCallback(handle_policy) \
+                .addErrback(handle_invalid_chunk)
         except InvalidChunkError as e:
             return {'error': e.value}
         except TalosVCRestClientError:
@@ -144,16 +154,15 @@ class TalosKademliaProtocol(TalosRPCProtocol):
     def rpc_find_value(self, sender, nodeid, key, chunk_key):
         source = Node(nodeid, sender[0], sender[1])
         self.welcomeIfNewNode(source)
-        if self.storage.has_value(chunk_key):
-            try:
+
+        def handle_has_value(has_value):
+            if has_value:
                 myaddress = self.transport.getHost()
                 return {'value': "%s:%d" % (myaddress.host, myaddress.port)}
-            except InvalidQueryToken as e:
-                self.log.info("Invalid query token received %s" % (e.value,))
-                return {'error': e.value}
-        else:
             return self.rpc_find_node(sender, nodeid, key)
 
+        return self.async_storage.has_value(chunk_key).addCallback(handle_has_value)
+
     def callFindNode(self, nodeToAsk, nodeToFind):
         address = (nodeToAsk.ip, nodeToAsk.port)
         d = self.find_node(address, self.sourceNode.id, nodeToFind.id)
@@ -250,13 +259,16 @@ class TalosKademliaProtocol(TalosRPCProtocol):
 class QueryChunk(Resource):
     allowedMethods = ('GET', 'POST')
 
-    def __init__(self, storage, talos_vc=TalosVCRestClient(), max_nonce_cache=1000, nonce_ttl=10):
+    def __init__(self, storage, talos_vc=TalosVCRestClient(), max_nonce_cache=1000, nonce_ttl=10,
+                 async_storage=None):
         Resource.__init__(self)
         self.storage = storage
+        self.async_storage = async_storage or AsyncTalosStorage(storage)
         self.log = Logger(system=self)
         self.talos_vc = talos_vc
         self.nonce_cache = TTLCache(max_nonce_cache, nonce_ttl)
-        self.refreshLoop = LoopingCall(self.nonce_cache.expire).start(3600)
+        self.refreshLoop = LoopingCall(self.nonce_cache.expire)
+        self.refreshLoop.start(3600)
         self.sem = Semaphore(1)
 
     def render_GET(self, request):
@@ -296,15 +308,28 @@ class QueryChunk(Resource):
                     request.setResponseCode(400)
                     request.write("No Policy Found")
                     request.finish()
-                # check policy for correctness
-                id = timekeeper.start_clock_unique()
-                chunk = self.storage.get_check_chunk(token.chunk_key, token.pubkey, policy, time_keeper=timekeeper)
-                timekeeper.stop_clock_unique(ENTRY_GET_AND_CHECK, id)
-                timekeeper.stop_clock_unique(ENTRY_TOTAL_LOCAL_QUERY, total_time_id)
+                    return
+
+                def handle_chunk(chunk):
+                    timekeeper.stop_clock_unique(ENTRY_GET_AND_CHECK, id)
+                    timekeeper.stop_clock_unique(ENTRY_TOTAL_LOCAL_QUERY, total_time_id)
 
-                self.log.debug("%s %s %s" % (BENCH_TAG, TYPE_QUERY_CHUNK_LOCAL, timekeeper.get_summary()))
-                request.write(chunk.encode())
-                request.finish()
+                    self.log.debug("%s %s %s" % (BENCH_TAG, TYPE_QUERY_CHUNK_LOCAL, timekeeper.get_summary()))
+                    request.write(chunk.encode())
+                    request.finish()
+
+                def handle_error(failure):
+                    request.setResponseCode(400)
+                    if failure.check(InvalidAccess):
+                        request.write("ERROR: Invalid access")
+                    else:
+                        request.write("ERROR: error occured")
+                    request.finish()
+
+                # check policy for correctness, the storage io runs in the io thread pool
+                id = timekeeper.start_clock_unique()
+                self.async_storage.get_check_chunk(token.chunk_key, token.pubkey, policy, time_keeper=timekeeper) \
+                    .addCallbacks(handle_chunk, handle_error)
 
             timekeeper.start_clock()
             self.talos_vc.get_policy(token.owner, token.streamid).addCallback(handle_policy)
@@ -324,9 +349,10 @@ class QueryChunk(Resource):
 class StoreLargeChunk(Resource):
     allowedMethods = ('POST',)
 
-    def __init__(self, storage, rpc_protocol, talos_vc=TalosVCRestClient()):
+    def __init__(self, storage, rpc_protocol, talos_vc=TalosVCRestClient(), async_storage=None):
         Resource.__init__(self)
         self.storage = storage
+        self.async_storage = async_storage or AsyncTalosStorage(storage)
         self.log = Logger(system=self)
         self.talos_vc = talos_vc
         self.rpc_protocol = rpc_protocol
@@ -364,14 +390,25 @@ class StoreLargeChunk(Resource):
             def handle_policy(policy):
                 time_keeper.stop_clock(ENTRY_FETCH_POLICY)
 
-                id = time_keeper.start_clock_unique()
-                self.storage.store_check_chunk(chunk, None, policy, time_keeper=time_keeper)
-                time_keeper.stop_clock_unique(ENTRY_STORE_CHECK, id)
+                def handle_stored(_):
+                    time_keeper.stop_clock_unique(ENTRY_STORE_CHECK, id)
+
+                    time_keeper.stop_clock_unique(ENTRY_TOTAL_STORE_LOCAL, total_time_id)
+                    self.log.debug("%s %s %s" % (BENCH_TAG, TYPE_STORE_CHUNK_LOCAL, time_keeper.get_summary()))
+                    request.write(json.dumps({'value': "ok"}))
+                    request.finish()
+
+                def handle_error(failure):
+                    request.setResponseCode(400)
+                    if failure.check(InvalidChunkError):
+                        request.write(json.dumps({'error': failure.value.value}))
+                    else:
+                        request.write(json.dumps({'error': "Error occured"}))
+                    request.finish()
 
-                time_keeper.stop_clock_unique(ENTRY_TOTAL_STORE_LOCAL, total_time_id)
-                self.log.debug("%s %s %s" % (BENCH_TAG, TYPE_STORE_CHUNK_LOCAL, time_keeper.get_summary()))
-                request.write(json.dumps({'value': "ok"}))
-                request.finish()
+                id = time_keeper.start_clock_unique()
+                self.async_storage.store_check_chunk(chunk, None, policy, time_keeper=time_keeper) \
+                    .addCallbacks(handle_stored, handle_error)
 
             time_keeper.start_clock()
             self.talos_vc.get_policy_with_txid(chunk.get_tag_hex()).addCallback(handle_policy)
@@ -423,10 +460,12 @@ class TalosSKademliaProtocol(TalosWeakSignedRPCProtocol):
     New protocol for the talos storage, base protocol from bmuller's implementation
     """
 
-    def __init__(self, ecdsa_privkey, sourceNode, storage, ksize, talos_vc=TalosVCRestClient(), cbits=10, bench_mode=True):
+    def __init__(self, ecdsa_privkey, sourceNode, storage, ksize, talos_vc=TalosVCRestClient(), cbits=10, bench_mode=True,
+                 async_storage=None):
         TalosWeakSignedRPCProtocol.__init__(self, ecdsa_privkey, sourceNode.id, cbits=cbits)
         self.router = TalosKademliaRoutingTable(self, ksize, sourceNode)
         self.storage = storage
+        self.async_storage = async_storage or AsyncTalosStorage(storage)
         self.sourceNode = sourceNode
         self.log = Logger(system=self)
         self.talos_vc = talos_vc
@@ -470,17 +509,25 @@ class TalosSKademliaProtocol(TalosWeakSignedRPCProtocol):
             def handle_policy(policy):
                 time_keeper.stop_clock(ENTRY_FETCH_POLICY)
 
+                def handle_stored(_):
+                    time_keeper.stop_clock_unique(ENTRY_STORE_CHECK, id)
+
+                    time_keeper.stop_clock_unique(ENTRY_TOTAL_STORE_LOCAL, total_time_id)
+                    self.log.debug("%s %s %s" % (BENCH_TAG, TYPE_STORE_CHUNK_LOCAL, time_keeper.get_summary()))
+                    return {'value': 'ok'}
+
                 # Hack no chunk id given -> no key checks, key is in the encoded chunk
                 id = time_keeper.start_clock_unique()
-                self.storage.store_check_chunk(chunk, None, policy, time_keeper=time_keeper)
-                time_keeper.stop_clock_unique(ENTRY_STORE_CHECK, id)
+                return self.async_storage.store_check_chunk(chunk, None, policy, time_keeper=time_keeper) \
+                    .addCallback(handle_stored)
 
-                time_keeper.stop_clock_unique(ENTRY_TOTAL_STORE_LOCAL, total_time_id)
-                self.log.debug("%s %s %s" % (BENCH_TAG, TYPE_STORE_CHUNK_LOCAL, time_keeper.get_summary()))
-                return {'value': 'ok'}
+            def handle_invalid_chunk(failure):
+                failure.trap(InvalidChunkError)
+                return {'error': failure.value.value}
 
             time_keeper.start_clock()
-            return self.talos_vc.get_policy_with_txid(chunk.get_tag_hex()).addCallback(handle_policy)
+            return self.talos_vc.get_policy_with_txid(chunk.get_tag_hex()).addCallback(handle_policy) \
+                .addErrback(handle_invalid_chunk)
         except InvalidChunkError as e:
             return {'error': e.value}
         except TalosVCRestClientError:
@@ -496,16 +543,15 @@ class TalosSKademliaProtocol(TalosWeakSignedRPCProtocol):
     def rpc_find_value(self, sender, nodeid, key, chunk_key):
         source = Node(nodeid, sender[0], sender[1])
         self.welcomeIfNewNode(source)
-        if self.storage.has_value(chunk_key):
-            try:
+
+        def handle_has_value(has_value):
+            if has_value:
                 myaddress = self.transport.getHost()
                 return {'value': "%s:%d" % (myaddress.host, myaddress.port)}
-            except InvalidQueryToken as e:
-                self.log.info("Invalid query token received %s" % (e.value,))
-                return {'error': e.value}
-        else:
             return self.rpc_find_node(sender, nodeid, key)
 
+        return self.async_storage.has_value(chunk_key).addCallback(handle_has_value)
+
     def callFindNode(self, nodeToAsk, nodeToFind):
         address = (nodeToAsk.ip, nodeToAsk.port)
         d = self.find_node(address, self.sourceNode.id, nodeToFind.id)
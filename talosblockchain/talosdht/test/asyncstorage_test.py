@@ -0,0 +1,162 @@
+import json
+import os
+from StringIO import StringIO
+
+from kademlia.node import Node
+from kademlia.utils import digest
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.python import failure
+from twisted.trial import unittest
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from talosdht.dhtstorage import AsyncTalosStorage
+from talosdht.protocolsecurity import generate_secret_key
+from talosdht.talosprotocol import TalosSKademliaProtocol, QueryChunk
+from talosdht.test.testutil import PRIVATE_KEY, NONCE, STREAMID, TXID
+from talosstorage.checks import generate_query_token, get_priv_key
+from talosstorage.chunkdata import ChunkData, DoubleEntry, DataStreamIdentifier, create_cloud_chunk
+from talosstorage.storage import InvalidChunkError, InvalidAccess
+
+
+class SynchronousThreadPool(object):
+    """
+    Runs the storage calls of AsyncTalosStorage directly in the calling thread
+    """
+    def callInThreadWithCallback(self, onResult, func, *args, **kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except:
+            onResult(False, failure.Failure())
+        else:
+            onResult(True, result)
+
+
+class FakeStorage(object):
+    def __init__(self, key_index=None, error=None):
+        self.key_index = key_index
+        self.error = error
+        self.chunks = {}
+
+    def store_check_chunk(self, chunk, chunk_id, policy, time_keeper=None):
+        if self.error is not None:
+            raise self.error
+        self.chunks[chunk.key] = chunk
+
+    def get_check_chunk(self, chunk_key, pubkey, policy, time_keeper=None):
+        if self.error is not None:
+            raise self.error
+        return self.chunks[chunk_key]
+
+    def has_value(self, chunk_key):
+        if self.key_index is not None:
+            return chunk_key in self.key_index
+        return chunk_key in self.chunks
+
+    def iteritems(self):
+        return iter([])
+
+
+class FakeTalosVC(object):
+    def __init__(self, policy):
+        self.policy = policy
+
+    def get_policy_with_txid(self, txid):
+        return defer.succeed(self.policy)
+
+    def get_policy(self, owner, streamid):
+        return defer.succeed(self.policy)
+
+
+class FakeTransport(object):
+    def getHost(self):
+        return IPv4Address('UDP', '127.0.0.1', 12345)
+
+
+class DummyProtocol(TalosSKademliaProtocol):
+    def welcomeIfNewNode(self, node):
+        pass
+
+
+class AsyncStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        chunk = ChunkData()
+        chunk.add_entry(DoubleEntry(1, "test", 1.0))
+        # the fake storage does not check the owner
+        stream_ident = DataStreamIdentifier("pubaddr", STREAMID, NONCE, TXID)
+        self.chunk = create_cloud_chunk(stream_ident, 1, get_priv_key(PRIVATE_KEY), 10, os.urandom(32), chunk)
+        self.sender = ("127.0.0.1", 12346)
+        self.nodeid = digest(os.urandom(16))
+
+    def create_protocol(self, storage, policy="policy"):
+        source_node = Node(digest(os.urandom(16)), ip="127.0.0.1", port=12345)
+        protocol = DummyProtocol(generate_secret_key(), source_node, storage, 4, talos_vc=FakeTalosVC(policy),
+                                 async_storage=AsyncTalosStorage(storage, threadpool=SynchronousThreadPool()))
+        protocol.transport = FakeTransport()
+        return protocol
+
+    def create_query(self, storage, policy="policy"):
+        query = QueryChunk(storage, talos_vc=FakeTalosVC(policy),
+                           async_storage=AsyncTalosStorage(storage, threadpool=SynchronousThreadPool()))
+        self.addCleanup(query.refreshLoop.stop)
+        nonce = query.render_GET(DummyRequest([]))
+        token = generate_query_token("pubaddr", STREAMID, nonce, self.chunk.key, PRIVATE_KEY)
+        request = DummyRequest([])
+        request.content = StringIO(json.dumps(token.to_json()))
+        return query, request
+
+    @defer.inlineCallbacks
+    def test_store(self):
+        storage = FakeStorage()
+        protocol = self.create_protocol(storage)
+        result = yield protocol.rpc_store(self.sender, self.nodeid, digest(self.chunk.key), self.chunk.encode())
+        self.assertEquals({'value': 'ok'}, result)
+        self.assertEquals(self.chunk.encode(), storage.chunks[self.chunk.key].encode())
+
+    @defer.inlineCallbacks
+    def test_store_invalid_chunk(self):
+        protocol = self.create_protocol(FakeStorage(error=InvalidChunkError("Invalid chunk")))
+        result = yield protocol.rpc_store(self.sender, self.nodeid, digest(self.chunk.key), self.chunk.encode())
+        self.assertEquals({'error': "Invalid chunk"}, result)
+
+    @defer.inlineCallbacks
+    def test_find_value(self):
+        storage = FakeStorage(key_index=set([self.chunk.key]))
+        protocol = self.create_protocol(storage)
+        result = yield protocol.rpc_find_value(self.sender, self.nodeid, digest(self.chunk.key), self.chunk.key)
+        self.assertEquals({'value': "127.0.0.1:12345"}, result)
+
+    @defer.inlineCallbacks
+    def test_find_value_missing(self):
+        # without key index, has_value runs in the thread pool
+        protocol = self.create_protocol(FakeStorage())
+        result = yield protocol.rpc_find_value(self.sender, self.nodeid, digest(self.chunk.key), self.chunk.key)
+        self.assertEquals([], result)
+
+    @defer.inlineCallbacks
+    def test_query_chunk(self):
+        storage = FakeStorage()
+        storage.chunks[self.chunk.key] = self.chunk
+        query, request = self.create_query(storage)
+        self.assertEquals(NOT_DONE_YET, query.render_POST(request))
+        yield request.notifyFinish()
+        self.assertEquals(self.chunk.encode(), "".join(request.written))
+        self.assertEquals(1, request.finished)
+
+    @defer.inlineCallbacks
+    def test_query_chunk_invalid_access(self):
+        query, request = self.create_query(FakeStorage(error=InvalidAccess("Invalid access")))
+        self.assertEquals(NOT_DONE_YET, query.render_POST(request))
+        yield request.notifyFinish()
+        self.assertEquals(400, request.responseCode)
+        self.assertEquals("ERROR: Invalid access", "".join(request.written))
+        self.assertEquals(1, request.finished)
+
+    def test_query_chunk_no_policy(self):
+        query, request = self.create_query(FakeStorage(), policy=None)
+        self.assertEquals(NOT_DONE_YET, query.render_POST(request))
+        self.assertEquals(400, request.responseCode)
+        self.assertEquals("No Policy Found", "".join(request.written))
+        self.assertEquals(1, request.finished)
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from talosdht.dhtstorage import TalosLevelDBDHTStorage
+from talosdht.test.testutil import PRIVATE_KEY, NONCE, STREAMID, TXID
+from talosstorage.checks import get_priv_key
+from talosstorage.chunkdata import ChunkData, DoubleEntry, DataStreamIdentifier, create_cloud_chunk
+
+
+class NoGetDB(object):
+    """
+    Wraps a leveldb db and fails on reads of single keys
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def Get(self, key):
+        raise AssertionError("Unexpected db read")
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class KeyIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        stream_ident = DataStreamIdentifier("pubaddr", STREAMID, NONCE, TXID)
+        symmetric_key = os.urandom(32)
+        self.chunks = []
+        for block_id in range(4):
+            chunk = ChunkData()
+            chunk.add_entry(DoubleEntry(block_id, "test", float(block_id)))
+            self.chunks.append(create_cloud_chunk(stream_ident, block_id, get_priv_key(PRIVATE_KEY), 10,
+                                                  symmetric_key, chunk))
+        self.db_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    def test_key_index(self):
+        chunks = self.chunks
+        storage = TalosLevelDBDHTStorage(self.db_dir, stream_index=True)
+        storage._store_chunk(chunks[0], block_id=0)
+        storage._store_chunks(chunks[1:3], block_ids=[1, 2])
+        self.assertEquals(set(chunk.key for chunk in chunks[:3]), storage.key_index)
+        storage.delete_chunk(chunks[1].key)
+        self.assertEquals(set([chunks[0].key, chunks[2].key]), storage.key_index)
+
+        storage.db = NoGetDB(storage.db)
+        self.assertEquals([True, False, True, False], [storage.has_value(chunk.key) for chunk in chunks])
+
+        # rebuilt on startup, the stream index entries are skipped
+        del storage
+        storage = TalosLevelDBDHTStorage(self.db_dir, stream_index=True)
+        self.assertEquals(set([chunks[0].key, chunks[2].key]), storage.key_index)
+
+    def test_without_key_index(self):
+        chunks = self.chunks
+        storage = TalosLevelDBDHTStorage(self.db_dir, key_index=False)
+        self.assertTrue(storage.key_index is None)
+        storage._store_chunks(chunks[:2])
+        storage.delete_chunk(chunks[0].key)
+        self.assertEquals([False, True, False, False], [storage.has_value(chunk.key) for chunk in chunks])
+
+    def test_refresh_time_after_delete(self):
+        chunks = self.chunks
+        for key_index in [True, False]:
+            storage = TalosLevelDBDHTStorage(self.db_dir, key_index=key_index)
+            storage._store_chunks(chunks[:2])
+            storage.delete_chunk(chunks[0].key)
+            # the refresh of a chunk deleted after the read does not bring it back
+            storage._refresh_time(chunks[0].key, chunks[0])
+            storage._refresh_time(chunks[1].key, chunks[1])
+            self.assertEquals([False, True], [storage.has_value(chunk.key) for chunk in chunks[:2]])
+            self.assertTrue(storage._get_chunk(chunks[0].key) is None)
+            storage.delete_chunk(chunks[1].key)
+            del storage
@@ -1,6 +1,8 @@
 import base64
 import os
+import threading
 
+from cachetools import LRUCache
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePublicNumbers
@@ -35,35 +37,99 @@ class BitcoinVersionedPrivateKey(BitcoinPrivateKey):
     _pubkeyhash_version_byte = USED_VERSIONBYTE
 
 
+class _LockedCache(object):
+    """
+    Thread-safe wrapper of a cachetools cache, the storage api serves requests from many threads
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.cache
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.cache[key] = value
+
+    def __len__(self):
+        with self.lock:
+            return len(self.cache)
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.cache.get(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+
+"""
+Caches of the key material, the same owners and readers send requests all the time.
+The cached objects are immutable, the caches are bounded (LRU).
+"""
+
+# bitcoin hex public key -> cryptography ECDSA public key object
+PUBLIC_KEY_CACHE = _LockedCache(LRUCache(maxsize=4096))
+# bitcoin hex public key -> bitcoin address
+ADDRESS_CACHE = _LockedCache(LRUCache(maxsize=4096))
+# (owner, stream id, nonce, txid) of a policy -> DataStreamIdentifier
+STREAM_IDENTIFIER_CACHE = _LockedCache(LRUCache(maxsize=4096))
+# the Merkle roots with a valid owner signature, the other chunks of a batch need only hashing
+VERIFIED_MERKLE_ROOTS = _LockedCache(LRUCache(maxsize=4096))
+
+
+def clear_key_caches():
+    for cache in [PUBLIC_KEY_CACHE, ADDRESS_CACHE, STREAM_IDENTIFIER_CACHE, VERIFIED_MERKLE_ROOTS]:
+        cache.clear()
+
+
 def get_crypto_ecdsa_pubkey_from_bitcoin_hex(bitcoin_hex_key):
     """
     Given a bitcoin hex string key returns the corresponding cryptography ECDSA key object
+    (cached, see PUBLIC_KEY_CACHE)
     :param bitcoin_hex_key: the h
     :return: cryptography ECDSA key object
     """
-    bin_ecdsa_public_key = extract_bin_ecdsa_pubkey(bitcoin_hex_key)
-    numbers = EllipticCurvePublicNumbers.from_encoded_point(ec.SECP256K1(), b'\x04' + bin_ecdsa_public_key)
-    return numbers.public_key(backend=default_backend())
+    pub_key = PUBLIC_KEY_CACHE.get(bitcoin_hex_key)
+    if pub_key is None:
+        bin_ecdsa_public_key = extract_bin_ecdsa_pubkey(bitcoin_hex_key)
+        numbers = EllipticCurvePublicNumbers.from_encoded_point(ec.SECP256K1(), b'\x04' + bin_ecdsa_public_key)
+        pub_key = numbers.public_key(backend=default_backend())
+        PUBLIC_KEY_CACHE[bitcoin_hex_key] = pub_key
+    return pub_key
 
 
 def get_bitcoin_address_for_pubkey(hex_pubkey):
     """
-    Computes the bitcoin address given a bitcoin public key in hex format 
+    Computes the bitcoin address given a bitcoin public key in hex format (cached, see ADDRESS_CACHE)
     :param hex_pubkey: the bitcoin public key in hex format
     :return: bitcoin address hex string
     """
-    priv = extract_bin_bitcoin_pubkey(hex_pubkey)
-    hash_priv = get_bin_hash160(priv)
-    return bin_hash160_to_address(hash_priv, version_byte=USED_VERSIONBYTE)
+    addr = ADDRESS_CACHE.get(hex_pubkey)
+    if addr is None:
+        priv = extract_bin_bitcoin_pubkey(hex_pubkey)
+        hash_priv = get_bin_hash160(priv)
+        addr = bin_hash160_to_address(hash_priv, version_byte=USED_VERSIONBYTE)
+        ADDRESS_CACHE[hex_pubkey] = addr
+    return addr
 
 
 def get_stream_identifier_from_policy(policy):
     """
-    Given a policy, extracts a StreamIdentifier object
+    Given a policy, extracts a StreamIdentifier object (cached, see STREAM_IDENTIFIER_CACHE)
     :param policy: a Talos policy object
     :return: a StreamIdentifier object
     """
-    return DataStreamIdentifier(policy.owner, policy.stream_id, policy.get_nonce_bin(), policy.txid)
+    nonce = policy.get_nonce_bin()
+    cache_key = (policy.owner, policy.stream_id, nonce, policy.txid)
+    stream_ident = STREAM_IDENTIFIER_CACHE.get(cache_key)
+    if stream_ident is None:
+        stream_ident = DataStreamIdentifier(policy.owner, policy.stream_id, nonce, policy.txid)
+        STREAM_IDENTIFIER_CACHE[cache_key] = stream_ident
+    return stream_ident
 
 
 def check_key_matches(cloud_chunk, policy, chunkid):
@@ -98,7 +164,7 @@ def check_signature(cloud_chunk, policy):
     :return: True if ok else False
     """
     pub_key = get_crypto_ecdsa_pubkey_from_bitcoin_hex(str(policy.owner_pk))
-    return cloud_chunk.check_signature(pub_key)
+    return cloud_chunk.check_signature(pub_key, verified_roots=VERIFIED_MERKLE_ROOTS)
 
 
 def check_access_allowed(hex_pubkey, policy):
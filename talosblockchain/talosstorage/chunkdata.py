@@ -1,15 +1,20 @@
 import base64
+import copy
 import hashlib
+import multiprocessing
 import struct
 import zlib
 from binascii import unhexlify, hexlify
 
+import numpy as np
+from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, utils
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 from pylepton.lepton import *
+from talosstorage.compression import CODEC_LEGACY, MAX_CODEC_ID, get_codec
 from talosstorage.timebench import TimeKeeper
 
 """
@@ -17,6 +22,29 @@ Implementaion of the chunks, each stream is partitioned into chunks.
 """
 
 
+def _to_bytes(data):
+    """
+    Returns the data as a byte string, copies only if the data is not a string already
+    (e.g. a memoryview or bytearray)
+    """
+    if isinstance(data, str):
+        return data
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+
+def _cipher_update(context, data):
+    """
+    Feeds the data to a cipher context. Memoryviews are passed without a copy
+    if the installed cryptography version accepts buffers.
+    """
+    try:
+        return context.update(data)
+    except TypeError:
+        return context.update(_to_bytes(data))
+
+
 def compress_data(data, level=6):
     """
     Compresses the data wit zlib
@@ -61,10 +89,10 @@ def decrypt_aes_gcm_data(key, tag, plain_data, data):
     :param key: the 32 byte decryption key
     :param tag: the authentication tag
     :param plain_data: the plaint data to be authenticated
-    :param data: the ciphertext
+    :param data: the ciphertext (string or memoryview)
     :return: plaintext (throws InvalidTag exception if auth fails)
     """
-    iv = data[0:12]
+    iv = _to_bytes(data[0:12])
     ciphertext = data[12:]
 
     decryptor = Cipher(
@@ -73,7 +101,7 @@ def decrypt_aes_gcm_data(key, tag, plain_data, data):
         backend=default_backend()
     ).decryptor()
     decryptor.authenticate_additional_data(plain_data)
-    return decryptor.update(ciphertext) + decryptor.finalize()
+    return _cipher_update(decryptor, ciphertext) + decryptor.finalize()
 
 
 def hash_sign_data(private_key, data):
@@ -101,10 +129,188 @@ def check_signed_data(public_key, signature, data):
     return verifier.verify()
 
 
+def _hash_data_parts(parts):
+    hasher = hashlib.sha256()
+    for part in parts:
+        hasher.update(part)
+    return hasher.digest()
+
+
+def hash_sign_data_parts(private_key, parts):
+    """
+    Signs the concatenation of the parts with ECDSA-SHA256 without concatenating them
+    :param private_key: the private key (crypthography framework object)
+    :param parts: list of strings or memoryviews
+    :return: the signature
+    """
+    return private_key.sign(_hash_data_parts(parts), ec.ECDSA(utils.Prehashed(hashes.SHA256())))
+
+
+def check_signed_data_parts(public_key, signature, parts):
+    """
+    Checks if the given signature matches the concatenation of the parts with ECDSA-SHA256
+    :param public_key: the public key (crypthography framework object)
+    :param signature: the signature
+    :param parts: list of strings or memoryviews
+    :return: True if ok else throws InvalidSignature exception
+    """
+    public_key.verify(signature, _hash_data_parts(parts), ec.ECDSA(utils.Prehashed(hashes.SHA256())))
+    return True
+
+
+"""
+Merkle batch signatures: the owner signs the root of a Merkle tree over the hashes of N chunks
+and each chunk carries its inclusion proof instead of an own ECDSA signature.
+
+Signature format (a DER ECDSA signature starts with 0x30):
+MERKLE_SIGNATURE_MAGIC 1 byte | leaf index 4 bytes | number of leaves 4 bytes |
+proof (sibling hashes from the leaf to the root) 32 bytes each | ECDSA signature of the root digest
+
+A node without sibling (odd number of nodes on a level) is moved up to the next level unchanged,
+the number of proof hashes follows from the leaf index and the number of leaves.
+"""
+
+MERKLE_SIGNATURE_MAGIC = b'M'
+_MERKLE_HEADER = struct.Struct("<II")
+_MERKLE_LEAF_PREFIX = b'\x00'
+_MERKLE_NODE_PREFIX = b'\x01'
+
+
+def _merkle_leaf_hash(parts):
+    return hashlib.sha256(_MERKLE_LEAF_PREFIX + _hash_data_parts(parts)).digest()
+
+
+def _merkle_node_hash(left, right):
+    return hashlib.sha256(_MERKLE_NODE_PREFIX + left + right).digest()
+
+
+def _merkle_root_digest(root, num_leaves):
+    return hashlib.sha256(MERKLE_SIGNATURE_MAGIC + struct.pack("<I", num_leaves) + root).digest()
+
+
+def _merkle_tree_proofs(leaves):
+    """
+    Builds the Merkle tree over the leaf hashes
+    :param leaves: list of leaf hashes
+    :return: (root, list with the proof of each leaf)
+    """
+    proofs = [[] for _ in leaves]
+    positions = range(len(leaves))
+    level = leaves
+    while len(level) > 1:
+        for leaf, pos in enumerate(positions):
+            sibling = pos ^ 1
+            if sibling < len(level):
+                proofs[leaf].append(level[sibling])
+        level = [_merkle_node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+        positions = [pos / 2 for pos in positions]
+    return level[0], proofs
+
+
+def _merkle_root_from_proof(leaf, index, num_leaves, proof):
+    """
+    Computes the root given the leaf hash and its proof
+    :return: (root, number of proof hashes used)
+    """
+    used = 0
+    node = leaf
+    level_size = num_leaves
+    while level_size > 1:
+        if index ^ 1 < level_size:
+            sibling = proof[used * HASH_BYTES:(used + 1) * HASH_BYTES]
+            if len(sibling) != HASH_BYTES:
+                raise InvalidSignature("Merkle proof too short")
+            node = _merkle_node_hash(sibling, node) if index & 1 else _merkle_node_hash(node, sibling)
+            used += 1
+        index /= 2
+        level_size = (level_size + 1) / 2
+    return node, used
+
+
+def merkle_sign_data_parts(private_key, parts_list):
+    """
+    Signs many messages with one ECDSA signature over the root of a Merkle tree
+    :param private_key: the private key (crypthography framework object)
+    :param parts_list: list of messages, each a list of strings or memoryviews
+    :return: list of signatures (one per message) in the Merkle signature format
+    """
+    num_leaves = len(parts_list)
+    root, proofs = _merkle_tree_proofs([_merkle_leaf_hash(parts) for parts in parts_list])
+    root_signature = private_key.sign(_merkle_root_digest(root, num_leaves),
+                                      ec.ECDSA(utils.Prehashed(hashes.SHA256())))
+    return [MERKLE_SIGNATURE_MAGIC + _MERKLE_HEADER.pack(index, num_leaves) + "".join(proof) + root_signature
+            for index, proof in enumerate(proofs)]
+
+
+def is_merkle_signature(signature):
+    return signature[:1] == MERKLE_SIGNATURE_MAGIC
+
+
+def check_merkle_signed_data_parts(public_key, signature, parts, verified_roots=None):
+    """
+    Checks if the given Merkle signature (see merkle_sign_data_parts) matches the data.
+    :param public_key: the public key (crypthography framework object)
+    :param signature: the Merkle signature
+    :param parts: list of strings or memoryviews
+    :param verified_roots: optional cache (e.g. cachetools.LRUCache) of the verified roots,
+                           if the root of the proof was already verified only the hashes are computed
+    :return: True if ok else throws InvalidSignature exception
+    """
+    if not is_merkle_signature(signature) or len(signature) < 1 + _MERKLE_HEADER.size:
+        raise InvalidSignature("Not a Merkle signature")
+    index, num_leaves = _MERKLE_HEADER.unpack_from(signature, 1)
+    if index >= num_leaves:
+        raise InvalidSignature("Invalid Merkle leaf index")
+    proof = signature[1 + _MERKLE_HEADER.size:]
+    root, num_proof_hashes = _merkle_root_from_proof(_merkle_leaf_hash(parts), index, num_leaves, proof)
+    root_signature = proof[num_proof_hashes * HASH_BYTES:]
+    digest = _merkle_root_digest(root, num_leaves)
+    if verified_roots is not None:
+        numbers = public_key.public_numbers()
+        cache_key = (numbers.x, numbers.y, digest)
+        if cache_key in verified_roots:
+            return True
+    public_key.verify(root_signature, digest, ec.ECDSA(utils.Prehashed(hashes.SHA256())))
+    if verified_roots is not None:
+        verified_roots[cache_key] = True
+    return True
+
+
+_STRUCT_CACHE = {}
+
+
+def _get_struct(fmt, *lengths):
+    """
+    Returns a cached struct.Struct for a format with variable length fields
+    :param fmt: the format with %d placeholders for the variable lengths
+    :param lengths: the lengths to fill in
+    :return: struct.Struct object
+    """
+    key = (fmt,) + lengths
+    try:
+        return _STRUCT_CACHE[key]
+    except KeyError:
+        if len(_STRUCT_CACHE) > 1024:
+            _STRUCT_CACHE.clear()
+        packer = _STRUCT_CACHE[key] = struct.Struct(fmt % lengths)
+        return packer
+
+
 TYPE_DOUBLE_ENTRY = 0
 TYPE_MULTI_DOUBLE_ENTRY = 2
 TYPE_MULTI_INT_ENTRY = 3
 TYPE_PICTURE_ENTRY = 1
+TYPE_DOUBLE_COLUMN_ENTRY = 4
+TYPE_TIMESERIES_ENTRY = 5
+TYPE_METADATA_TABLE_ENTRY = 6
+TYPE_INDEX_ENTRY = 7
+TYPE_LARGE_OBJECT_ENTRY = 8
+
+# explicit little-endian dtypes, the encoding does not depend on the platform
+TIMESTAMP_DTYPE = np.dtype("<u8")
+DOUBLE_DTYPE = np.dtype("<f8")
+UINT32_DTYPE = np.dtype("<u4")
 
 
 class Entry(object):
@@ -124,6 +330,27 @@ class Entry(object):
     def get_encoded_size(self):
         pass
 
+    def encode_into(self, buf, offset, use_compression=False):
+        """
+        Writes the encoded entry into a preallocated buffer
+        :param buf: the bytearray to write to
+        :param offset: the position of the entry in the buffer
+        :param use_compression: indicates if compression should be applied
+        :return: the position after the entry
+        """
+        encoded = self.encode(use_compression=use_compression)
+        end = offset + len(encoded)
+        buf[offset:end] = encoded
+        return end
+
+    def with_metadata(self, metadata):
+        """
+        Returns a shallow copy of the entry with different metadata
+        """
+        entry = copy.copy(self)
+        entry.metadata = metadata
+        return entry
+
 
 class PictureEntry(Entry):
     """
@@ -157,11 +384,41 @@ class PictureEntry(Entry):
             self.time_keeper.start_clock()
             compressed_picture = compress_jpg_data(self.picture_data)
             self.time_keeper.stop_clock("time_lepton_compression")
-            total_size = self.get_encoded_size_compressed(len(compressed_picture))
         else:
             compressed_picture = self.picture_data
-            total_size = self.get_encoded_size_compressed(len(compressed_picture))
-        return struct.pack("<IBQI", total_size, self.get_type_id(), self.timestamp, len(self.metadata)) + self.metadata + compressed_picture
+        return self.encode_with_picture(compressed_picture)
+
+    def encode_with_picture(self, picture):
+        """
+        Encodes the entry with the given (e.g. already compressed) picture data
+        """
+        total_size = self.get_encoded_size_compressed(len(picture))
+        return struct.pack("<IBQI", total_size, self.get_type_id(), self.timestamp, len(self.metadata)) + self.metadata + picture
+
+    @staticmethod
+    def compress_pictures(entries):
+        """
+        Compresses the pictures of the entries in parallel on the lepton pool
+        :param entries: list of PictureEntry objects
+        :return: list of the compressed pictures
+        """
+        time_keeper = TimeKeeper()
+        time_keeper.start_clock()
+        compressed = compress_jpg_data_batch([entry.picture_data for entry in entries])
+        time_keeper.stop_clock("time_lepton_compression")
+        for entry in entries:
+            entry.time_keeper.store_value("time_lepton_compression",
+                                          time_keeper.logged_times["time_lepton_compression"])
+        return compressed
+
+    @staticmethod
+    def decompress_pictures(entries):
+        """
+        Decompresses the pictures of entries decoded without decompression in parallel on the lepton pool
+        :param entries: list of PictureEntry objects, the picture data is replaced
+        """
+        for entry, picture in zip(entries, decompress_jpg_data_batch([entry.picture_data for entry in entries])):
+            entry.picture_data = picture
 
     def __str__(self):
         return "%s %s" % (str(self.timestamp), self.metadata)
@@ -199,12 +456,20 @@ class DoubleEntry(Entry):
     def get_type_id(self):
         return TYPE_DOUBLE_ENTRY
 
+    def with_metadata(self, metadata):
+        return DoubleEntry(self.timestamp, metadata, self.value)
+
     def get_encoded_size(self):
-        return struct.calcsize("<IBQ") + len(self.metadata) + struct.calcsize("d")
+        return _get_struct("<IBQ%dsd", len(self.metadata)).size
 
     def encode(self, use_compression=False):
-        total_size = self.get_encoded_size()
-        return struct.pack("<IBQ", total_size, self.get_type_id(), self.timestamp) + self.metadata + struct.pack("d", self.value)
+        packer = _get_struct("<IBQ%dsd", len(self.metadata))
+        return packer.pack(packer.size, TYPE_DOUBLE_ENTRY, self.timestamp, self.metadata, self.value)
+
+    def encode_into(self, buf, offset, use_compression=False):
+        packer = _get_struct("<IBQ%dsd", len(self.metadata))
+        packer.pack_into(buf, offset, packer.size, TYPE_DOUBLE_ENTRY, self.timestamp, self.metadata, self.value)
+        return offset + packer.size
 
     def __str__(self):
         return "%s %s %s" % (str(self.timestamp), self.metadata, str(self.value))
@@ -219,6 +484,10 @@ class DoubleEntry(Entry):
         return DoubleEntry(timestamp, metadata, value)
 
 
+# |len_entry (4 byte)| type | timestamp (8 byte) | len metadata (4 byte) | metadata | values (little-endian) |
+_MULTI_ENTRY_HEADER = struct.Struct("<IBQI")
+
+
 class MultiDoubleEntry(Entry):
     def __init__(self, timestamp, metadata, values):
         self.timestamp = timestamp
@@ -229,29 +498,34 @@ class MultiDoubleEntry(Entry):
     def get_type_id(self):
         return TYPE_MULTI_DOUBLE_ENTRY
 
+    def with_metadata(self, metadata):
+        return MultiDoubleEntry(self.timestamp, metadata, self.values)
+
     def get_encoded_size(self):
-        return struct.calcsize("<IBQI") + len(self.metadata) + (struct.calcsize("d")*len(self.values))
+        return _get_struct("<IBQI%ds%dd", len(self.metadata), len(self.values)).size
 
     def encode(self, use_compression=False):
-        total_size = self.get_encoded_size()
-        temp = struct.pack("<IBQI", total_size, self.get_type_id(), self.timestamp, len(self.metadata)) + self.metadata
-        for value in self.values:
-            temp += struct.pack("d", value)
-        return temp
+        packer = _get_struct("<IBQI%ds%dd", len(self.metadata), len(self.values))
+        return packer.pack(packer.size, TYPE_MULTI_DOUBLE_ENTRY, self.timestamp,
+                           len(self.metadata), self.metadata, *self.values)
+
+    def encode_into(self, buf, offset, use_compression=False):
+        packer = _get_struct("<IBQI%ds%dd", len(self.metadata), len(self.values))
+        packer.pack_into(buf, offset, packer.size, TYPE_MULTI_DOUBLE_ENTRY, self.timestamp,
+                         len(self.metadata), self.metadata, *self.values)
+        return offset + packer.size
 
     def __str__(self):
         return "%s %s %s" % (str(self.timestamp), self.metadata, str(self.values))
 
     @staticmethod
     def decode(encoded, use_compression=False):
-        len_struct = struct.calcsize("<IBQI")
-        len_tot, _, timestamp, len_meta = struct.unpack("<IBQI", encoded[:len_struct])
-        size_double = struct.calcsize("d")
-        num_double = (len_tot - len_struct - len_meta) / size_double
+        len_struct = _MULTI_ENTRY_HEADER.size
+        len_tot, _, timestamp, len_meta = _MULTI_ENTRY_HEADER.unpack_from(encoded)
+        num_double = (len_tot - len_struct - len_meta) / DOUBLE_DTYPE.itemsize
         metadata = encoded[len_struct:(len_struct + len_meta)]
-        tmp = len_struct + len_meta
-        values = [struct.unpack("d", encoded[(tmp + i * size_double):(tmp + (i + 1) * size_double)]) for i in range(num_double)]
-        return MultiDoubleEntry(timestamp, metadata, values)
+        values = np.frombuffer(encoded, dtype=DOUBLE_DTYPE, count=num_double, offset=len_struct + len_meta)
+        return MultiDoubleEntry(timestamp, metadata, values.tolist())
 
 
 class MultiIntegerEntry(Entry):
@@ -264,35 +538,483 @@ class MultiIntegerEntry(Entry):
     def get_type_id(self):
         return TYPE_MULTI_INT_ENTRY
 
+    def with_metadata(self, metadata):
+        return MultiIntegerEntry(self.timestamp, metadata, self.values)
+
     def get_encoded_size(self):
-        return struct.calcsize("<IBQI") + len(self.metadata) + (struct.calcsize("H")*len(self.values))
+        return _get_struct("<IBQI%ds%dI", len(self.metadata), len(self.values)).size
 
     def encode(self, use_compression=False):
-        total_size = self.get_encoded_size()
-        temp = struct.pack("<IBQI", total_size, self.get_type_id(), self.timestamp, len(self.metadata)) + self.metadata
-        for value in self.values:
-            temp += struct.pack("I", value)
-        return temp
+        packer = _get_struct("<IBQI%ds%dI", len(self.metadata), len(self.values))
+        return packer.pack(packer.size, TYPE_MULTI_INT_ENTRY, self.timestamp,
+                           len(self.metadata), self.metadata, *self.values)
+
+    def encode_into(self, buf, offset, use_compression=False):
+        packer = _get_struct("<IBQI%ds%dI", len(self.metadata), len(self.values))
+        packer.pack_into(buf, offset, packer.size, TYPE_MULTI_INT_ENTRY, self.timestamp,
+                         len(self.metadata), self.metadata, *self.values)
+        return offset + packer.size
 
     def __str__(self):
         return "%s %s %s" % (str(self.timestamp), self.metadata, str(self.values))
 
     @staticmethod
     def decode(encoded, use_compression=False):
-        len_struct = struct.calcsize("<IBQI")
-        len_tot, _, timestamp, len_meta = struct.unpack("<IBQI", encoded[:len_struct])
-        size_double = struct.calcsize("I")
-        num_double = (len_tot - len_struct - len_meta) / size_double
+        len_struct = _MULTI_ENTRY_HEADER.size
+        len_tot, _, timestamp, len_meta = _MULTI_ENTRY_HEADER.unpack_from(encoded)
+        num_ints = (len_tot - len_struct - len_meta) / UINT32_DTYPE.itemsize
+        metadata = encoded[len_struct:(len_struct + len_meta)]
+        values = np.frombuffer(encoded, dtype=UINT32_DTYPE, count=num_ints, offset=len_struct + len_meta)
+        return MultiIntegerEntry(timestamp, metadata, values.tolist())
+
+
+class DoubleColumnEntry(Entry):
+    """
+    Represents a block of double entries with the same metadata.
+    The timestamps and values are stored column wise in contiguous numpy buffers,
+    such that the whole block is encoded/decoded in one pass.
+
+    Format: |len_entry (4 byte)| type | num_entries (4 byte) | len_meta (4 byte) | metadata |
+            timestamps (8 byte each) | values (8 byte double each)|
+    """
+    def __init__(self, metadata, timestamps, values):
+        """
+        Create a column entry
+        :param metadata: string metadata shared by all values
+        :param timestamps: (int) unix timestamps (sequence or numpy array)
+        :param values: the double values (sequence or numpy array)
+        """
+        self.metadata = metadata
+        self.timestamps = np.asarray(timestamps, dtype=TIMESTAMP_DTYPE)
+        self.values = np.asarray(values, dtype=DOUBLE_DTYPE)
+        if len(self.timestamps) != len(self.values):
+            raise ValueError("Number of timestamps and values do not match")
+        Entry.__init__(self)
+
+    def get_type_id(self):
+        return TYPE_DOUBLE_COLUMN_ENTRY
+
+    def num_entries(self):
+        return len(self.timestamps)
+
+    def get_encoded_size(self):
+        return struct.calcsize("<IBII") + len(self.metadata) + \
+               self.num_entries() * (TIMESTAMP_DTYPE.itemsize + DOUBLE_DTYPE.itemsize)
+
+    def encode(self, use_compression=False):
+        buf = bytearray(self.get_encoded_size())
+        self.encode_into(buf, 0, use_compression=use_compression)
+        return bytes(buf)
+
+    def encode_into(self, buf, offset, use_compression=False):
+        total_size = self.get_encoded_size()
+        num_entries = self.num_entries()
+        struct.pack_into("<IBII%ds" % len(self.metadata), buf, offset, total_size, self.get_type_id(),
+                         num_entries, len(self.metadata), self.metadata)
+        cur_pos = offset + struct.calcsize("<IBII") + len(self.metadata)
+        np.frombuffer(buf, dtype=TIMESTAMP_DTYPE, count=num_entries, offset=cur_pos)[:] = self.timestamps
+        cur_pos += num_entries * TIMESTAMP_DTYPE.itemsize
+        np.frombuffer(buf, dtype=DOUBLE_DTYPE, count=num_entries, offset=cur_pos)[:] = self.values
+        return offset + total_size
+
+    def get_entry(self, index):
+        return DoubleEntry(int(self.timestamps[index]), self.metadata, float(self.values[index]))
+
+    def __iter__(self):
+        for index in range(self.num_entries()):
+            yield self.get_entry(index)
+
+    def __str__(self):
+        return "%d entries %s" % (self.num_entries(), self.metadata)
+
+    @staticmethod
+    def decode(encoded, use_compression=False):
+        len_struct = struct.calcsize("<IBII")
+        len_tot, _, num_entries, len_meta = struct.unpack("<IBII", encoded[:len_struct])
         metadata = encoded[len_struct:(len_struct + len_meta)]
-        tmp = len_struct + len_meta
-        values = [struct.unpack("I", encoded[(tmp + i * size_double):(tmp + (i + 1) * size_double)]) for i in range(num_double)]
-        return MultiDoubleEntry(timestamp, metadata, values)
+        cur_pos = len_struct + len_meta
+        timestamps = np.frombuffer(encoded, dtype=TIMESTAMP_DTYPE, count=num_entries, offset=cur_pos)
+        cur_pos += num_entries * TIMESTAMP_DTYPE.itemsize
+        values = np.frombuffer(encoded, dtype=DOUBLE_DTYPE, count=num_entries, offset=cur_pos)
+        return DoubleColumnEntry(metadata, timestamps, values)
+
+
+def _zigzag_encode(values):
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def _zigzag_decode(values):
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+_VARINT_SHIFTS = np.arange(10, dtype=np.uint64) * np.uint64(7)
+
+
+def _varint_encode(values):
+    """
+    Encodes unsigned 64-bit integers as LEB128 varints (7 bits per byte, high bit = continue)
+    :param values: numpy uint64 array
+    :return: the encoded bytes
+    """
+    groups = (values[:, None] >> _VARINT_SHIFTS) & np.uint64(0x7f)
+    num_bytes = 1 + ((values[:, None] >> _VARINT_SHIFTS[1:]) != 0).sum(axis=1)
+    positions = np.arange(len(_VARINT_SHIFTS))
+    continued = positions < (num_bytes[:, None] - 1)
+    encoded = groups.astype(np.uint8) | (continued.astype(np.uint8) << 7)
+    return encoded[positions < num_bytes[:, None]].tobytes()
+
+
+def _varint_decode(encoded):
+    """
+    Decodes LEB128 varints
+    :param encoded: numpy uint8 array
+    :return: numpy uint64 array
+    """
+    if len(encoded) == 0:
+        return np.empty(0, dtype=np.uint64)
+    ends = (encoded & 0x80) == 0
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    group = np.cumsum(ends) - ends
+    positions = np.arange(len(encoded)) - starts[group]
+    parts = (encoded & 0x7f).astype(np.uint64) << (positions.astype(np.uint64) * np.uint64(7))
+    return np.bitwise_or.reduceat(parts, starts)
+
+
+def _xor_encode(values):
+    """
+    Gorilla style float compression: each value is XORed with its predecessor in the same column
+    and only the bytes between the leading and trailing zero bytes are stored.
+    :param values: 2d numpy double array (rows x columns)
+    :return: (control bytes, payload bytes) the control byte is (trailing zero bytes << 4 | stored bytes)
+    """
+    bits = np.ascontiguousarray(values, dtype=DOUBLE_DTYPE).view(TIMESTAMP_DTYPE)
+    xored = bits.copy()
+    xored[1:] ^= bits[:-1]
+    value_bytes = xored.reshape(-1).view(np.uint8).reshape(-1, 8)
+    non_zero = value_bytes != 0
+    any_set = non_zero.any(axis=1)
+    trailing = np.where(any_set, non_zero.argmax(axis=1), 0)
+    num_bytes = np.where(any_set, 8 - non_zero[:, ::-1].argmax(axis=1) - trailing, 0)
+    positions = np.arange(8)
+    mask = (positions >= trailing[:, None]) & (positions < (trailing + num_bytes)[:, None])
+    control = ((trailing << 4) | num_bytes).astype(np.uint8)
+    return control.tobytes(), value_bytes[mask].tobytes()
+
+
+def _xor_decode(control, payload, shape):
+    """
+    Inverse of _xor_encode
+    :param control: numpy uint8 array with one control byte per value
+    :param payload: numpy uint8 array with the stored bytes
+    :param shape: the shape of the values (rows x columns)
+    :return: 2d numpy double array
+    """
+    trailing = (control >> 4)[:, None]
+    num_bytes = (control & 0x0f)[:, None]
+    positions = np.arange(8)
+    mask = (positions >= trailing) & (positions < trailing + num_bytes)
+    value_bytes = np.zeros((len(control), 8), dtype=np.uint8)
+    value_bytes[mask] = payload
+    xored = value_bytes.view(TIMESTAMP_DTYPE).reshape(shape)
+    return np.bitwise_xor.accumulate(xored, axis=0).view(DOUBLE_DTYPE)
+
+
+class TimeSeriesEntry(Entry):
+    """
+    Represents a block of double (or multi double) entries with the same metadata,
+    compressed with a Gorilla style codec. Timestamps are stored as delta-of-delta
+    zigzag varints, values are XORed with the previous value of the same column and
+    stored without leading/trailing zero bytes. The codec is byte aligned such that
+    encoding and decoding is vectorized with numpy.
+
+    Format: |len_entry (4 byte)| type | num_entries (4 byte) | num_columns (2 byte) | len_meta (4 byte) |
+            metadata | first timestamp (8 byte) | len_timestamps (4 byte) | delta-of-delta varints |
+            control byte per value | value bytes |
+    num_columns is 0 for DoubleEntry rows and the number of values for MultiDoubleEntry rows.
+    """
+    def __init__(self, metadata, timestamps, values):
+        """
+        Create a time series entry
+        :param metadata: string metadata shared by all values
+        :param timestamps: (int) unix timestamps (sequence or numpy array)
+        :param values: the double values, one dimensional for DoubleEntry rows
+                       or two dimensional (rows x columns) for MultiDoubleEntry rows
+        """
+        self.metadata = metadata
+        self.timestamps = np.asarray(timestamps, dtype=TIMESTAMP_DTYPE)
+        self.values = np.asarray(values, dtype=DOUBLE_DTYPE)
+        if len(self.timestamps) != len(self.values):
+            raise ValueError("Number of timestamps and values do not match")
+        self._encoded = None
+        Entry.__init__(self)
+
+    def get_type_id(self):
+        return TYPE_TIMESERIES_ENTRY
+
+    def num_entries(self):
+        return len(self.timestamps)
+
+    def num_columns(self):
+        return 0 if self.values.ndim == 1 else self.values.shape[1]
+
+    def _encode_body(self):
+        if self._encoded is None:
+            timestamps = self.timestamps.astype(np.int64)
+            first = int(timestamps[0]) if len(timestamps) > 0 else 0
+            delta_of_delta = np.diff(np.diff(timestamps), prepend=0) if len(timestamps) > 1 \
+                else np.empty(0, dtype=np.int64)
+            encoded_timestamps = _varint_encode(_zigzag_encode(delta_of_delta))
+            control, payload = _xor_encode(self.values.reshape(len(self.values), max(self.num_columns(), 1)))
+            self._encoded = struct.pack("<QI", first, len(encoded_timestamps)) + \
+                            encoded_timestamps + control + payload
+        return self._encoded
+
+    def get_encoded_size(self):
+        return struct.calcsize("<IBIHI") + len(self.metadata) + len(self._encode_body())
+
+    def encode(self, use_compression=False):
+        return struct.pack("<IBIHI", self.get_encoded_size(), self.get_type_id(), self.num_entries(),
+                           self.num_columns(), len(self.metadata)) + self.metadata + self._encode_body()
+
+    def get_entry(self, index):
+        if self.values.ndim == 1:
+            return DoubleEntry(int(self.timestamps[index]), self.metadata, float(self.values[index]))
+        return MultiDoubleEntry(int(self.timestamps[index]), self.metadata, self.values[index].tolist())
+
+    def __iter__(self):
+        for index in range(self.num_entries()):
+            yield self.get_entry(index)
+
+    def __str__(self):
+        return "%d entries %s" % (self.num_entries(), self.metadata)
+
+    @staticmethod
+    def from_entries(entries):
+        """
+        Creates a time series entry from DoubleEntry or MultiDoubleEntry objects with the same metadata
+        :param entries: list of entries
+        :return: TimeSeriesEntry
+        """
+        if len(entries) == 0:
+            raise ValueError("No entries given")
+        metadata = entries[0].metadata
+        if any([entry.metadata != metadata for entry in entries]):
+            raise ValueError("Entries have different metadata")
+        timestamps = [entry.timestamp for entry in entries]
+        if entries[0].get_type_id() == TYPE_MULTI_DOUBLE_ENTRY:
+            values = [entry.values for entry in entries]
+        else:
+            values = [entry.value for entry in entries]
+        return TimeSeriesEntry(metadata, timestamps, values)
+
+    @staticmethod
+    def decode(encoded, use_compression=False):
+        len_struct = struct.calcsize("<IBIHI")
+        len_tot, _, num_entries, num_columns, len_meta = struct.unpack("<IBIHI", encoded[:len_struct])
+        metadata = encoded[len_struct:(len_struct + len_meta)]
+        cur_pos = len_struct + len_meta
+        first, len_timestamps = struct.unpack("<QI", encoded[cur_pos:(cur_pos + struct.calcsize("<QI"))])
+        cur_pos += struct.calcsize("<QI")
+        raw = np.frombuffer(encoded, dtype=np.uint8, count=len_tot - cur_pos, offset=cur_pos)
+
+        delta_of_delta = _zigzag_decode(_varint_decode(raw[:len_timestamps]))
+        timestamps = np.empty(num_entries, dtype=np.int64)
+        if num_entries > 0:
+            timestamps[0] = first
+            timestamps[1:] = first + np.cumsum(np.cumsum(delta_of_delta))
+
+        num_values = num_entries * max(num_columns, 1)
+        control = raw[len_timestamps:(len_timestamps + num_values)]
+        payload = raw[(len_timestamps + num_values):]
+        values = _xor_decode(control, payload, (num_entries, max(num_columns, 1)))
+        if num_columns == 0:
+            values = values.reshape(num_entries)
+        return TimeSeriesEntry(metadata, timestamps, values)
+
+
+class MetadataTableEntry(Entry):
+    """
+    The metadata strings of a chunk, if present it is the first entry of the chunk and the
+    following entries store the index of their metadata in the table (2 byte) instead of the string.
+
+    Format: |len_entry (4 byte)| type | num_metadata (2 byte) | (len_meta (2 byte) | metadata)* |
+    """
+    def __init__(self, metadata_list):
+        """
+        Create a metadata table
+        :param metadata_list: list of metadata strings
+        """
+        self.metadata_list = metadata_list
+        Entry.__init__(self)
+
+    def get_type_id(self):
+        return TYPE_METADATA_TABLE_ENTRY
+
+    def get_encoded_size(self):
+        return struct.calcsize("<IBH") + sum([struct.calcsize("<H") + len(meta) for meta in self.metadata_list])
+
+    def encode(self, use_compression=False):
+        parts = [struct.pack("<IBH", self.get_encoded_size(), self.get_type_id(), len(self.metadata_list))]
+        for meta in self.metadata_list:
+            parts.append(struct.pack("<H", len(meta)))
+            parts.append(meta)
+        return "".join(parts)
+
+    def __str__(self):
+        return "metadata table %s" % str(self.metadata_list)
+
+    @staticmethod
+    def decode(encoded, use_compression=False):
+        cur_pos = struct.calcsize("<IBH")
+        _, _, num_metadata = struct.unpack("<IBH", encoded[:cur_pos])
+        metadata_list = []
+        for _ in range(num_metadata):
+            len_meta, = struct.unpack("<H", encoded[cur_pos:(cur_pos + 2)])
+            cur_pos += 2
+            metadata_list.append(encoded[cur_pos:(cur_pos + len_meta)])
+            cur_pos += len_meta
+        return MetadataTableEntry(metadata_list)
+
+
+# entries which reference the metadata table if the chunk has one
+METADATA_TABLE_TYPES = frozenset([TYPE_DOUBLE_ENTRY, TYPE_PICTURE_ENTRY, TYPE_MULTI_DOUBLE_ENTRY,
+                                  TYPE_MULTI_INT_ENTRY])
+MAX_METADATA_TABLE_SIZE = 0xffff
+
+
+def _resolve_metadata(entry, table):
+    if entry.get_type_id() in METADATA_TABLE_TYPES:
+        entry.metadata = table[struct.unpack("<H", entry.metadata)[0]]
+    return entry
+
+
+INDEX_MAGIC = "TIDX"
+OFFSET_DTYPE = np.dtype("<u4")
+
+
+class IndexEntry(Entry):
+    """
+    Offset and timestamp of each entry in the chunk, if present it is the last entry of the chunk.
+    The entry ends with its length and a magic value such that it can be found from the end of the
+    plaintext without walking the entries (see ChunkDataView).
+
+    Format: |len_entry (4 byte)| type | num_entries (4 byte) | offsets (4 byte each) |
+            timestamps (8 byte each) | len_entry (4 byte) | TIDX |
+    """
+    def __init__(self, offsets, timestamps):
+        """
+        Create an index
+        :param offsets: the offsets of the entries in the encoded chunk
+        :param timestamps: the timestamps of the entries
+        """
+        self.offsets = np.asarray(offsets, dtype=OFFSET_DTYPE)
+        self.timestamps = np.asarray(timestamps, dtype=TIMESTAMP_DTYPE)
+        Entry.__init__(self)
+
+    def get_type_id(self):
+        return TYPE_INDEX_ENTRY
+
+    def num_entries(self):
+        return len(self.offsets)
+
+    @staticmethod
+    def get_encoded_size_for(num_entries):
+        return struct.calcsize("<IBI") + num_entries * (OFFSET_DTYPE.itemsize + TIMESTAMP_DTYPE.itemsize) + \
+               struct.calcsize("<I") + len(INDEX_MAGIC)
+
+    def get_encoded_size(self):
+        return IndexEntry.get_encoded_size_for(self.num_entries())
+
+    def encode(self, use_compression=False):
+        buf = bytearray(self.get_encoded_size())
+        self.encode_into(buf, 0)
+        return bytes(buf)
+
+    def encode_into(self, buf, offset, use_compression=False):
+        total_size = self.get_encoded_size()
+        num_entries = self.num_entries()
+        struct.pack_into("<IBI", buf, offset, total_size, self.get_type_id(), num_entries)
+        cur_pos = offset + struct.calcsize("<IBI")
+        np.frombuffer(buf, dtype=OFFSET_DTYPE, count=num_entries, offset=cur_pos)[:] = self.offsets
+        cur_pos += num_entries * OFFSET_DTYPE.itemsize
+        np.frombuffer(buf, dtype=TIMESTAMP_DTYPE, count=num_entries, offset=cur_pos)[:] = self.timestamps
+        cur_pos += num_entries * TIMESTAMP_DTYPE.itemsize
+        struct.pack_into("<I4s", buf, cur_pos, total_size, INDEX_MAGIC)
+        return offset + total_size
+
+    def __str__(self):
+        return "index %d entries" % self.num_entries()
+
+    @staticmethod
+    def decode(encoded, use_compression=False, offset=0):
+        len_struct = struct.calcsize("<IBI")
+        _, _, num_entries = struct.unpack_from("<IBI", encoded, offset)
+        cur_pos = offset + len_struct
+        offsets = np.frombuffer(encoded, dtype=OFFSET_DTYPE, count=num_entries, offset=cur_pos)
+        cur_pos += num_entries * OFFSET_DTYPE.itemsize
+        timestamps = np.frombuffer(encoded, dtype=TIMESTAMP_DTYPE, count=num_entries, offset=cur_pos)
+        return IndexEntry(offsets, timestamps)
+
+
+class LargeObjectEntry(Entry):
+    """
+    Manifest of a large object (e.g. a high resolution picture) stored as a sequence of segments,
+    each segment is an own CloudChunk (see talosstorage.largeobject).
+
+    Format: |len_entry (4 byte)| type | timestamp (8 byte) | object size (8 byte) | segment size (4 byte) |
+            number of segments (4 byte) | metadata |
+    """
+    FORMAT = "<IBQQII%ds"
+
+    def __init__(self, timestamp, metadata, object_size, segment_size, num_segments):
+        """
+        Create a manifest entry
+        :param timestamp: (int) unix timestamp
+        :param metadata: string metadata
+        :param object_size: the size of the object in bytes
+        :param segment_size: the size of the plaintext segments (the last one can be smaller)
+        :param num_segments: the number of segments
+        """
+        self.timestamp = timestamp
+        self.metadata = metadata
+        self.object_size = object_size
+        self.segment_size = segment_size
+        self.num_segments = num_segments
+        Entry.__init__(self)
+
+    def get_type_id(self):
+        return TYPE_LARGE_OBJECT_ENTRY
+
+    def get_encoded_size(self):
+        return _get_struct(LargeObjectEntry.FORMAT, len(self.metadata)).size
+
+    def encode(self, use_compression=False):
+        packer = _get_struct(LargeObjectEntry.FORMAT, len(self.metadata))
+        return packer.pack(packer.size, TYPE_LARGE_OBJECT_ENTRY, self.timestamp, self.object_size,
+                           self.segment_size, self.num_segments, self.metadata)
+
+    def __str__(self):
+        return "%s %s large object %d bytes" % (str(self.timestamp), self.metadata, self.object_size)
+
+    @staticmethod
+    def decode(encoded, use_compression=False):
+        len_tot, = struct.unpack_from("<I", encoded)
+        packer = _get_struct(LargeObjectEntry.FORMAT, len_tot - struct.calcsize(LargeObjectEntry.FORMAT % 0))
+        _, _, timestamp, object_size, segment_size, num_segments, metadata = packer.unpack_from(encoded)
+        return LargeObjectEntry(timestamp, metadata, object_size, segment_size, num_segments)
+
 
 DECODER_FOR_TYPE = {
     TYPE_DOUBLE_ENTRY: DoubleEntry.decode,
     TYPE_PICTURE_ENTRY: PictureEntry.decode,
     TYPE_MULTI_DOUBLE_ENTRY: MultiDoubleEntry.decode,
-    TYPE_MULTI_INT_ENTRY: MultiIntegerEntry.decode
+    TYPE_MULTI_INT_ENTRY: MultiIntegerEntry.decode,
+    TYPE_DOUBLE_COLUMN_ENTRY: DoubleColumnEntry.decode,
+    TYPE_TIMESERIES_ENTRY: TimeSeriesEntry.decode,
+    TYPE_METADATA_TABLE_ENTRY: MetadataTableEntry.decode,
+    TYPE_INDEX_ENTRY: IndexEntry.decode,
+    TYPE_LARGE_OBJECT_ENTRY: LargeObjectEntry.decode
 }
 
 
@@ -301,15 +1023,19 @@ class ChunkData:
     Represents a plaintext chunk. 
     Contains a certain number of entries.
     """
-    def __init__(self, entries_in=None, max_size=1000):
+    def __init__(self, entries_in=None, max_size=1000, use_metadata_table=False, use_index=False):
         """
         Create a new chunk
         :param entries_in: a list of entries if None create a empry one
         :param max_size: the maximum number of entries
-        :param entry_type: the type of entries 
+        :param use_metadata_table: store each metadata string once per chunk and reference it
+                                   by index in the entries
+        :param use_index: append an offset/timestamp index for random access (see ChunkDataView)
         """
         self.entries = entries_in or []
         self.max_size = max_size
+        self.use_metadata_table = use_metadata_table
+        self.use_index = use_index
 
     def add_entry(self, entry):
         """
@@ -332,11 +1058,104 @@ class ChunkData:
     def remaining_space(self):
         return self.max_size - len(self.entries)
 
-    def encode(self, use_compression=False):
-        res = ""
+    def _get_entries_to_encode(self):
+        """
+        Returns the entries as they are encoded, with the metadata table as first entry
+        and metadata indices in the entries if the table is used
+        """
+        if not self.use_metadata_table:
+            return self.entries
+        table = []
+        indices = {}
+        entries = []
         for entry in self.entries:
-            res += entry.encode(use_compression=use_compression)
-        return res
+            if entry.get_type_id() in METADATA_TABLE_TYPES:
+                index = indices.get(entry.metadata)
+                if index is None:
+                    if len(table) >= MAX_METADATA_TABLE_SIZE:
+                        raise ValueError("Too many different metadata strings in chunk")
+                    index = indices[entry.metadata] = struct.pack("<H", len(table))
+                    table.append(entry.metadata)
+                entry = entry.with_metadata(index)
+            entries.append(entry)
+        return [MetadataTableEntry(table)] + entries
+
+    @staticmethod
+    def _get_index_entry(entries, sizes):
+        offsets = []
+        timestamps = []
+        cur_pos = 0
+        for entry, size in zip(entries, sizes):
+            if entry.get_type_id() != TYPE_METADATA_TABLE_ENTRY:
+                offsets.append(cur_pos)
+                timestamps.append(getattr(entry, "timestamp", 0))
+            cur_pos += size
+        return IndexEntry(offsets, timestamps)
+
+    def get_encoded_size(self):
+        size = sum([entry.get_encoded_size() for entry in self._get_entries_to_encode()])
+        if self.use_index:
+            size += IndexEntry.get_encoded_size_for(len(self.entries))
+        return size
+
+    def encode(self, use_compression=False):
+        """
+        Encodes the entries into one preallocated buffer, sized with get_encoded_size
+        """
+        entries = self._get_entries_to_encode()
+        if use_compression:
+            # the size of compressed entries is only known after compressing them
+            pictures = [entry for entry in entries if entry.get_type_id() == TYPE_PICTURE_ENTRY]
+            if len(pictures) > 1:
+                compressed = iter(PictureEntry.compress_pictures(pictures))
+                encoded_entries = [entry.encode_with_picture(next(compressed))
+                                   if entry.get_type_id() == TYPE_PICTURE_ENTRY
+                                   else entry.encode(use_compression=True) for entry in entries]
+            else:
+                encoded_entries = [entry.encode(use_compression=True) for entry in entries]
+            if self.use_index:
+                encoded_entries.append(ChunkData._get_index_entry(
+                    entries, [len(encoded) for encoded in encoded_entries]).encode())
+            return "".join(encoded_entries)
+        sizes = [entry.get_encoded_size() for entry in entries]
+        if self.use_index:
+            entries = entries + [ChunkData._get_index_entry(entries, sizes)]
+            sizes.append(entries[-1].get_encoded_size())
+        buf = bytearray(sum(sizes))
+        cur_pos = 0
+        for entry in entries:
+            cur_pos = entry.encode_into(buf, cur_pos)
+        return bytes(buf)
+
+    def to_numpy(self):
+        """
+        Returns the entries as numpy structured array (see chunk_to_numpy)
+        """
+        return _entries_to_numpy(self.entries)
+
+    @staticmethod
+    def from_numpy(array, metadata=None, **kwargs):
+        """
+        Creates a chunk from a structured array with the fields timestamp, value or values
+        and optionally metadata (see get_numpy_dtype)
+        :param array: the structured array
+        :param metadata: the metadata of all entries if the array has no metadata field
+        :param kwargs: passed to the ChunkData constructor
+        :return: a ChunkData object with DoubleEntry or MultiDoubleEntry objects
+        """
+        if metadata is None:
+            metadata_list = array['metadata'].tolist()
+        else:
+            metadata_list = [metadata] * len(array)
+        timestamps = array['timestamp'].tolist()
+        if 'values' in array.dtype.names:
+            entries = [MultiDoubleEntry(timestamp, meta, values) for timestamp, meta, values
+                       in zip(timestamps, metadata_list, array['values'].tolist())]
+        else:
+            entries = [DoubleEntry(timestamp, meta, value) for timestamp, meta, value
+                       in zip(timestamps, metadata_list, array['value'].tolist())]
+        kwargs.setdefault('max_size', len(entries))
+        return ChunkData(entries_in=entries, **kwargs)
 
     @staticmethod
     def decode(encoded, use_compression=True):
@@ -347,12 +1166,466 @@ class ChunkData:
         len_integer = struct.calcsize("<IB")
         cur_pos = 0
         entries = []
+        pictures = []
         while cur_pos < len_encoded:
             len_entry, type_entry = struct.unpack("<IB", encoded[cur_pos:(cur_pos + len_integer)])
-            entry_decoder = DECODER_FOR_TYPE[int(type_entry)]
-            entries.append(entry_decoder(encoded[cur_pos:(cur_pos + len_entry)], use_compression))
+            if type_entry == TYPE_PICTURE_ENTRY and use_compression:
+                # the pictures are decompressed in parallel after decoding all entries
+                entry = PictureEntry.decode(encoded[cur_pos:(cur_pos + len_entry)], use_decompression=False)
+                pictures.append(entry)
+            else:
+                entry_decoder = DECODER_FOR_TYPE[int(type_entry)]
+                entry = entry_decoder(encoded[cur_pos:(cur_pos + len_entry)], use_compression)
+            entries.append(entry)
             cur_pos += len_entry
-        return ChunkData(entries_in=entries, max_size=len(entries))
+        if len(pictures) > 0:
+            PictureEntry.decompress_pictures(pictures)
+        use_index = len(entries) > 0 and entries[-1].get_type_id() == TYPE_INDEX_ENTRY
+        if use_index:
+            entries.pop()
+        if len(entries) > 0 and entries[0].get_type_id() == TYPE_METADATA_TABLE_ENTRY:
+            table = entries.pop(0).metadata_list
+            for entry in entries:
+                _resolve_metadata(entry, table)
+            return ChunkData(entries_in=entries, max_size=len(entries), use_metadata_table=True,
+                             use_index=use_index)
+        if len(entries) == 1 and not use_index and \
+                (entries[0].get_type_id() == TYPE_DOUBLE_COLUMN_ENTRY or
+                 (entries[0].get_type_id() == TYPE_TIMESERIES_ENTRY and entries[0].num_columns() == 0)):
+            return ColumnarChunkData.from_column_entry(entries[0])
+        return ChunkData(entries_in=entries, max_size=len(entries), use_index=use_index)
+
+
+class ChunkDataView(object):
+    """
+    Lazy read-only view on an encoded chunk with an index (ChunkData(use_index=True)).
+    Entries are only decoded when accessed, the timestamp lookups assume that the
+    entries are ordered by timestamp.
+    """
+    def __init__(self, encoded, use_compression=True):
+        """
+        Create a view
+        :param encoded: the encoded (decompressed) chunk,
+                        e.g. CloudChunk.get_and_check_chunk_data(key, do_decode=False)
+        :param use_compression: passed to the entry decoders (e.g. lepton for pictures)
+        """
+        if not ChunkDataView.has_index(encoded):
+            raise ValueError("Chunk has no index")
+        # numpy cannot read memoryviews, strings are used without a copy
+        encoded = _to_bytes(encoded)
+        self.encoded = encoded
+        self.use_compression = use_compression
+        len_index, = struct.unpack_from("<I", encoded, len(encoded) - struct.calcsize("<I") - len(INDEX_MAGIC))
+        if len_index > len(encoded) or \
+                struct.unpack_from("<IB", encoded, len(encoded) - len_index) != (len_index, TYPE_INDEX_ENTRY):
+            raise ValueError("Invalid chunk index")
+        self.index = IndexEntry.decode(encoded, offset=len(encoded) - len_index)
+        self.table = None
+        if len(encoded) > len_index:
+            _, type_entry = struct.unpack_from("<IB", encoded, 0)
+            if type_entry == TYPE_METADATA_TABLE_ENTRY:
+                self.table = self._decode_at(0).metadata_list
+
+    @staticmethod
+    def has_index(encoded):
+        len_trailer = struct.calcsize("<I") + len(INDEX_MAGIC)
+        return len(encoded) >= len_trailer and _to_bytes(encoded[-len(INDEX_MAGIC):]) == INDEX_MAGIC
+
+    def _decode_at(self, offset):
+        len_entry, type_entry = struct.unpack_from("<IB", self.encoded, offset)
+        return DECODER_FOR_TYPE[int(type_entry)](self.encoded[offset:(offset + len_entry)], self.use_compression)
+
+    def num_entries(self):
+        return self.index.num_entries()
+
+    def __len__(self):
+        return self.num_entries()
+
+    def get_timestamp(self, index):
+        return int(self.index.timestamps[index])
+
+    def get_entry(self, index):
+        """
+        Decodes the entry at the given position
+        """
+        entry = self._decode_at(int(self.index.offsets[index]))
+        if self.table is not None:
+            _resolve_metadata(entry, self.table)
+        return entry
+
+    def __getitem__(self, index):
+        return self.get_entry(index)
+
+    def __iter__(self):
+        for index in range(self.num_entries()):
+            yield self.get_entry(index)
+
+    def find_timestamp(self, timestamp):
+        """
+        Binary search for the first entry with a timestamp >= the given timestamp
+        :return: the position of the entry (num_entries() if there is none)
+        """
+        return int(np.searchsorted(self.index.timestamps, timestamp, side='left'))
+
+    def get_entries_in_range(self, from_timestamp, to_timestamp):
+        """
+        Decodes only the entries with from_timestamp <= timestamp < to_timestamp
+        """
+        start = self.find_timestamp(from_timestamp)
+        end = self.find_timestamp(to_timestamp)
+        return [self.get_entry(index) for index in range(start, end)]
+
+    def get_last_entries(self, num_entries):
+        return [self.get_entry(index) for index in range(max(0, self.num_entries() - num_entries),
+                                                           self.num_entries())]
+
+    def to_chunk_data(self):
+        return ChunkData.decode(self.encoded, use_compression=self.use_compression)
+
+
+class ColumnarChunkData(object):
+    """
+    Represents a plaintext chunk of double values with the same metadata.
+    Stores the timestamps and values in preallocated numpy buffers instead of one
+    object per entry and is encoded as a single DoubleColumnEntry (or TimeSeriesEntry).
+    """
+    def __init__(self, max_size=1000, metadata=None, use_timeseries_codec=False):
+        """
+        Create a new columnar chunk
+        :param max_size: the maximum number of entries
+        :param metadata: the metadata of the entries, if None taken from the first entry
+        :param use_timeseries_codec: encode the chunk as a delta/XOR compressed TimeSeriesEntry
+        """
+        self.max_size = max_size
+        self.metadata = metadata
+        self.use_timeseries_codec = use_timeseries_codec
+        self.timestamps = np.empty(max_size, dtype=TIMESTAMP_DTYPE)
+        self.values = np.empty(max_size, dtype=DOUBLE_DTYPE)
+        self.size = 0
+
+    def add_value(self, timestamp, metadata, value):
+        """
+        Add a value to the chunk
+        :param timestamp: (int) unix timestamp
+        :param metadata: string metadata, has to match the chunk metadata
+        :param value: the value as double
+        :return: True if success else False i.e. chunk full
+        """
+        if self.size >= self.max_size:
+            return False
+        if self.metadata is None:
+            self.metadata = metadata
+        elif self.metadata != metadata:
+            raise ValueError("Metadata %s does not match chunk metadata %s" % (metadata, self.metadata))
+        self.timestamps[self.size] = timestamp
+        self.values[self.size] = value
+        self.size += 1
+        return True
+
+    def add_entry(self, entry):
+        """
+        Add a DoubleEntry to the chunk
+        :param entry: the entry
+        :return: True if success else False i.e. chunk full
+        """
+        return self.add_value(entry.timestamp, entry.metadata, entry.value)
+
+    def num_entries(self):
+        return self.size
+
+    def remaining_space(self):
+        return self.max_size - self.size
+
+    def get_column_entry(self):
+        if self.use_timeseries_codec:
+            return TimeSeriesEntry(self.metadata or "", self.timestamps[:self.size], self.values[:self.size])
+        return DoubleColumnEntry(self.metadata or "", self.timestamps[:self.size], self.values[:self.size])
+
+    @property
+    def entries(self):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.get_column_entry())
+
+    def encode(self, use_compression=False):
+        return self.get_column_entry().encode(use_compression=use_compression)
+
+    def to_numpy(self):
+        """
+        Returns the entries as numpy structured array (see chunk_to_numpy)
+        """
+        result = np.empty(self.size, dtype=get_numpy_dtype(len(self.metadata or "")))
+        result['timestamp'] = self.timestamps[:self.size]
+        result['metadata'] = self.metadata or ""
+        result['value'] = self.values[:self.size]
+        return result
+
+    @staticmethod
+    def from_numpy(array, metadata=None, use_timeseries_codec=False):
+        """
+        Creates a columnar chunk from a structured array with the fields timestamp and value,
+        all entries need the same metadata
+        :param array: the structured array
+        :param metadata: the metadata, if None taken from the metadata field of the array
+        :param use_timeseries_codec: see ColumnarChunkData
+        """
+        if metadata is None and len(array) > 0:
+            metadata = array['metadata'][0]
+            if (array['metadata'] != metadata).any():
+                raise ValueError("The entries have different metadata")
+        chunk = ColumnarChunkData(max_size=len(array), metadata=metadata, use_timeseries_codec=use_timeseries_codec)
+        chunk.timestamps[:] = array['timestamp']
+        chunk.values[:] = array['value']
+        chunk.size = len(array)
+        return chunk
+
+    @staticmethod
+    def from_column_entry(column_entry):
+        chunk = ColumnarChunkData(max_size=0, metadata=column_entry.metadata,
+                                  use_timeseries_codec=column_entry.get_type_id() == TYPE_TIMESERIES_ENTRY)
+        chunk.timestamps = column_entry.timestamps
+        chunk.values = column_entry.values
+        chunk.size = chunk.max_size = column_entry.num_entries()
+        return chunk
+
+    @staticmethod
+    def decode(encoded, use_compression=False):
+        return ChunkData.decode(encoded, use_compression=use_compression)
+
+
+def _get_entry_timestamps_and_values(entry):
+    if hasattr(entry, "timestamps"):
+        return np.asarray(entry.timestamps, dtype=TIMESTAMP_DTYPE), np.asarray(entry.values, dtype=DOUBLE_DTYPE).ravel()
+    if hasattr(entry, "value"):
+        values = [entry.value]
+    elif hasattr(entry, "values"):
+        values = entry.values
+    else:
+        values = []
+    return np.array([entry.timestamp], dtype=TIMESTAMP_DTYPE), np.asarray(values, dtype=DOUBLE_DTYPE).ravel()
+
+
+"""
+Export of chunks to numpy structured arrays with the fields timestamp, metadata and value
+(DoubleEntry) or values (MultiDoubleEntry, MultiIntegerEntry, all entries with the same number of values).
+"""
+
+_DOUBLE_ENTRY_HEADER_SIZE = struct.calcsize("<IBQ")
+
+
+def get_numpy_dtype(len_metadata, num_values=0):
+    """
+    The dtype of the exported arrays
+    :param len_metadata: the length of the metadata strings
+    :param num_values: the number of values per entry, 0 for a single value ('value' field)
+    """
+    fields = [('timestamp', TIMESTAMP_DTYPE), ('metadata', 'S%d' % max(len_metadata, 1))]
+    if num_values == 0:
+        fields.append(('value', DOUBLE_DTYPE))
+    else:
+        fields.append(('values', DOUBLE_DTYPE, (num_values,)))
+    return np.dtype(fields)
+
+
+def _entries_to_numpy(entries):
+    """
+    Builds the array from decoded entries
+    """
+    if len(entries) == 0:
+        return np.empty(0, dtype=get_numpy_dtype(0))
+    if all([hasattr(entry, "timestamps") for entry in entries]):
+        timestamps = np.concatenate([np.asarray(entry.timestamps, dtype=TIMESTAMP_DTYPE) for entry in entries])
+        values = np.concatenate([np.asarray(entry.values, dtype=DOUBLE_DTYPE) for entry in entries])
+        metadata = [entry.metadata for entry in entries for _ in range(entry.num_entries())]
+    elif all([hasattr(entry, "value") for entry in entries]):
+        timestamps = [entry.timestamp for entry in entries]
+        values = [entry.value for entry in entries]
+        metadata = [entry.metadata for entry in entries]
+    elif all([hasattr(entry, "values") for entry in entries]) and \
+            len(set([len(entry.values) for entry in entries])) == 1:
+        timestamps = [entry.timestamp for entry in entries]
+        values = [entry.values for entry in entries]
+        metadata = [entry.metadata for entry in entries]
+    else:
+        raise ValueError("The entries cannot be exported to one array")
+    values = np.asarray(values, dtype=DOUBLE_DTYPE)
+    result = np.empty(len(timestamps), dtype=get_numpy_dtype(max([len(meta) for meta in metadata]),
+                                                             values.shape[1] if values.ndim > 1 else 0))
+    result['timestamp'] = timestamps
+    result['metadata'] = metadata
+    result['values' if values.ndim > 1 else 'value'] = values
+    return result
+
+
+def _fixed_width_entries_view(encoded, start, end):
+    """
+    Returns a structured view on DoubleEntry or MultiDoubleEntry objects of the same size between start and end,
+    None if the entries do not have the same type and size
+    """
+    if end <= start:
+        return None
+    len_entry, type_entry = struct.unpack_from("<IB", encoded, start)
+    if len_entry == 0 or (end - start) % len_entry != 0:
+        return None
+    names = ['len', 'type', 'timestamp']
+    formats = ['<u4', 'u1', TIMESTAMP_DTYPE]
+    offsets = [0, 4, 5]
+    if type_entry == TYPE_DOUBLE_ENTRY:
+        len_meta = len_entry - _DOUBLE_ENTRY_HEADER_SIZE - DOUBLE_DTYPE.itemsize
+        value_field = ('value', DOUBLE_DTYPE)
+        value_offset = _DOUBLE_ENTRY_HEADER_SIZE + len_meta
+    elif type_entry == TYPE_MULTI_DOUBLE_ENTRY:
+        len_meta, = struct.unpack_from("<I", encoded, start + _DOUBLE_ENTRY_HEADER_SIZE)
+        len_values = len_entry - _MULTI_ENTRY_HEADER.size - len_meta
+        if len_values <= 0 or len_values % DOUBLE_DTYPE.itemsize != 0:
+            return None
+        names.append('len_meta')
+        formats.append('<u4')
+        offsets.append(_DOUBLE_ENTRY_HEADER_SIZE)
+        value_field = ('values', (DOUBLE_DTYPE, (len_values / DOUBLE_DTYPE.itemsize,)))
+        value_offset = _MULTI_ENTRY_HEADER.size + len_meta
+    else:
+        return None
+    if len_meta <= 0:
+        return None
+    names += ['metadata', value_field[0]]
+    formats += ['S%d' % len_meta, value_field[1]]
+    offsets += [value_offset - len_meta, value_offset]
+    view = np.frombuffer(encoded, dtype=np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                                                  'itemsize': len_entry}),
+                         count=(end - start) / len_entry, offset=start)
+    if not ((view['len'] == len_entry).all() and (view['type'] == type_entry).all()):
+        return None
+    if 'len_meta' in names and not (view['len_meta'] == len_meta).all():
+        return None
+    return view[['timestamp', 'metadata', value_field[0]]]
+
+
+def chunk_to_numpy(encoded):
+    """
+    Exports an encoded (decrypted and decompressed) chunk to a structured array.
+    If the chunk only contains DoubleEntry or MultiDoubleEntry objects of the same size
+    (e.g. the same metadata) the array is a view on the encoded chunk, no entry objects are created.
+    Chunks with a metadata table are resolved with one vectorized lookup, other chunks are decoded.
+    :param encoded: the encoded chunk e.g. CloudChunk.get_and_check_chunk_data(key, do_decode=False)
+    :return: numpy structured array with the fields timestamp, metadata and value or values (see get_numpy_dtype)
+    """
+    encoded = _to_bytes(encoded)
+    start = 0
+    end = len(encoded)
+    if ChunkDataView.has_index(encoded):
+        len_index, = struct.unpack_from("<I", encoded, end - struct.calcsize("<I") - len(INDEX_MAGIC))
+        end -= len_index
+    table = None
+    if end > start:
+        len_entry, type_entry = struct.unpack_from("<IB", encoded, start)
+        if type_entry == TYPE_METADATA_TABLE_ENTRY:
+            table = MetadataTableEntry.decode(encoded[start:(start + len_entry)]).metadata_list
+            start += len_entry
+    view = _fixed_width_entries_view(encoded, start, end)
+    if view is None:
+        return ChunkData.decode(encoded).to_numpy()
+    if table is None:
+        return view
+    if view.dtype['metadata'].itemsize != struct.calcsize("<H"):
+        return ChunkData.decode(encoded).to_numpy()
+    value_name = view.dtype.names[2]
+    num_values = view.dtype[value_name].shape[0] if view.dtype[value_name].shape else 0
+    result = np.empty(len(view), dtype=get_numpy_dtype(max([len(meta) for meta in table] + [0]), num_values))
+    result['timestamp'] = view['timestamp']
+    result['metadata'] = np.array(table)[view['metadata'].view("<u2")]
+    result[value_name] = view[value_name]
+    return result
+
+
+def iter_cloud_chunks_numpy(cloud_chunks, symmetric_key, compression_used=True):
+    """
+    Decrypts the chunks one at a time and exports them to structured arrays (see chunk_to_numpy)
+    :param cloud_chunks: iterable of CloudChunk objects
+    :param symmetric_key: the 32 byte key
+    :param compression_used: see CloudChunk.get_and_check_chunk_data
+    :return: generator of structured arrays
+    """
+    for cloud_chunk in cloud_chunks:
+        yield chunk_to_numpy(cloud_chunk.get_and_check_chunk_data(symmetric_key, compression_used=compression_used,
+                                                                  do_decode=False))
+
+
+class ChunkSummary(object):
+    """
+    Summary statistics of a chunk (timestamps and all double values of the entries).
+    Stored in front of the compressed payload inside the encrypted data, such that it is
+    covered by the GCM tag and can be read without decompressing and decoding the entries.
+
+    Format: | min timestamp (8 byte) | max timestamp (8 byte) | count (4 byte) |
+            min value (double) | max value (double) | sum of values (double) |
+    """
+    FORMAT = struct.Struct("<QQIddd")
+
+    def __init__(self, min_timestamp, max_timestamp, count, min_value, max_value, sum_values):
+        self.min_timestamp = min_timestamp
+        self.max_timestamp = max_timestamp
+        self.count = count
+        self.min_value = min_value
+        self.max_value = max_value
+        self.sum_values = sum_values
+
+    def overlaps(self, from_timestamp, to_timestamp):
+        """
+        Checks if the chunk may contain entries with from_timestamp <= timestamp < to_timestamp
+        """
+        return self.count > 0 and self.min_timestamp < to_timestamp and self.max_timestamp >= from_timestamp
+
+    def merge(self, other):
+        """
+        Returns the summary of both chunks
+        """
+        if self.count == 0:
+            return other
+        if other.count == 0:
+            return self
+        return ChunkSummary(min(self.min_timestamp, other.min_timestamp),
+                            max(self.max_timestamp, other.max_timestamp),
+                            self.count + other.count,
+                            float(np.fmin(self.min_value, other.min_value)),
+                            float(np.fmax(self.max_value, other.max_value)),
+                            self.sum_values + other.sum_values)
+
+    def encode(self):
+        return ChunkSummary.FORMAT.pack(self.min_timestamp, self.max_timestamp, self.count,
+                                        self.min_value, self.max_value, self.sum_values)
+
+    def __str__(self):
+        return "[%d, %d] count: %d min: %s max: %s sum: %s" % (self.min_timestamp, self.max_timestamp, self.count,
+                                                               self.min_value, self.max_value, self.sum_values)
+
+    @staticmethod
+    def decode(encoded):
+        return ChunkSummary(*ChunkSummary.FORMAT.unpack_from(encoded))
+
+    @staticmethod
+    def from_chunk(chunk_data):
+        """
+        Computes the summary of a ChunkData or ColumnarChunkData object
+        """
+        if isinstance(chunk_data, ColumnarChunkData):
+            timestamps = chunk_data.timestamps[:chunk_data.size]
+            values = chunk_data.values[:chunk_data.size]
+        elif len(chunk_data.entries) == 0:
+            timestamps = values = []
+        else:
+            parts = [_get_entry_timestamps_and_values(entry) for entry in chunk_data.entries]
+            timestamps = np.concatenate([part[0] for part in parts])
+            values = np.concatenate([part[1] for part in parts])
+        if len(timestamps) == 0:
+            return ChunkSummary(0, 0, 0, float("nan"), float("nan"), 0.0)
+        if len(values) == 0:
+            min_value = max_value = float("nan")
+        else:
+            min_value, max_value = float(np.min(values)), float(np.max(values))
+        return ChunkSummary(int(np.min(timestamps)), int(np.max(timestamps)), len(timestamps),
+                            min_value, max_value, float(np.sum(values)))
 
 
 class DataStreamIdentifier:
@@ -371,31 +1644,108 @@ class DataStreamIdentifier:
         self.streamid = streamid
         self.nonce = nonce
         self.txid_create_policy = txid_create_policy
+        self._prefix_hasher = None
+
+    def __getstate__(self):
+        # hashlib objects cannot be pickled (e.g. for create_cloud_chunks)
+        state = self.__dict__.copy()
+        state['_prefix_hasher'] = None
+        return state
 
     def get_tag(self):
         return unhexlify(self.txid_create_policy)
 
+    def _get_prefix_hasher(self):
+        """
+        Returns a sha256 hasher fed with owner, stream id and nonce, the keys of the blocks
+        are derived from copies of it
+        """
+        if self._prefix_hasher is None:
+            hasher = hashlib.sha256()
+            hasher.update(self.owner)
+            hasher.update(str(self.streamid))
+            hasher.update(self.nonce)
+            self._prefix_hasher = hasher
+        return self._prefix_hasher
+
     def get_key_for_blockid(self, block_id):
-        hasher = hashlib.sha256()
-        hasher.update(self.owner)
-        hasher.update(str(self.streamid))
-        hasher.update(self.nonce)
+        hasher = self._get_prefix_hasher().copy()
         hasher.update(str(block_id))
         return hasher.digest()
 
+    def get_keys_for_blockids(self, block_ids):
+        """
+        Returns the lookup keys of many blocks
+        :param block_ids: iterable of block ids e.g. range(0, 10000)
+        :return: list of keys in the order of the block ids
+        """
+        prefix_hasher = self._get_prefix_hasher()
+        keys = []
+        for block_id in block_ids:
+            hasher = prefix_hasher.copy()
+            hasher.update(str(block_id))
+            keys.append(hasher.digest())
+        return keys
+
 
 HASH_BYTES = 32
 VERSION_BYTES = 4
 MAC_BYTES = 16
 
-def _encode_cloud_chunk_public_part(lookup_key, key_version, policy_tag):
-    return lookup_key + struct.pack("<I", key_version) + policy_tag
+# the high byte of the key version field holds the compression codec id and the summary flag
+CODEC_SHIFT = 24
+MAX_KEY_VERSION = (1 << CODEC_SHIFT) - 1
+SUMMARY_FLAG = 0x80
+
+
+def _pack_version_field(key_version, codec_id, has_summary=False):
+    if codec_id == CODEC_LEGACY and not has_summary:
+        return key_version
+    if key_version > MAX_KEY_VERSION or codec_id > MAX_CODEC_ID:
+        raise ValueError("Key version %d with codec %d does not fit in the version field" % (key_version, codec_id))
+    flags = SUMMARY_FLAG if has_summary else 0
+    return ((codec_id | flags) << CODEC_SHIFT) | key_version
+
+
+def _unpack_version_field(version_field):
+    """
+    :return: (key version, codec id, has summary)
+    """
+    high_byte = version_field >> CODEC_SHIFT
+    return version_field & MAX_KEY_VERSION, high_byte & ~SUMMARY_FLAG, (high_byte & SUMMARY_FLAG) != 0
+
+
+def _encode_cloud_chunk_public_part(lookup_key, key_version, policy_tag, codec_id=CODEC_LEGACY, has_summary=False):
+    return lookup_key + struct.pack("<I", _pack_version_field(key_version, codec_id, has_summary)) + policy_tag
 
 
-def _enocde_cloud_chunk_without_signature(lookup_key, key_version, policy_tag, encrypted_data, mac_tag):
-    return _encode_cloud_chunk_public_part(lookup_key, key_version, policy_tag) + \
-           struct.pack("<I", len(encrypted_data)) + encrypted_data + \
-           mac_tag
+def _cloud_chunk_parts_without_signature(lookup_key, key_version, policy_tag, encrypted_data, mac_tag,
+                                         codec_id=CODEC_LEGACY, has_summary=False):
+    return [_encode_cloud_chunk_public_part(lookup_key, key_version, policy_tag, codec_id=codec_id,
+                                            has_summary=has_summary),
+            struct.pack("<I", len(encrypted_data)), encrypted_data, mac_tag]
+
+
+def _enocde_cloud_chunk_without_signature(lookup_key, key_version, policy_tag, encrypted_data, mac_tag,
+                                          codec_id=CODEC_LEGACY, has_summary=False):
+    return "".join([_to_bytes(part) for part in _cloud_chunk_parts_without_signature(
+        lookup_key, key_version, policy_tag, encrypted_data, mac_tag, codec_id=codec_id, has_summary=has_summary)])
+
+
+def _decompress_chunk_payload(data, codec_id, compression_used, time_keeper):
+    """
+    Decompresses the decrypted chunk payload with the codec from the chunk header.
+    Chunks without codec id (CODEC_LEGACY) are zlib compressed if compression_used is set.
+    """
+    if codec_id != CODEC_LEGACY:
+        time_keeper.start_clock()
+        data = get_codec(codec_id).decompress(data)
+        time_keeper.stop_clock("chunk_decompression")
+    elif compression_used:
+        time_keeper.start_clock()
+        data = decompress_data(data)
+        time_keeper.stop_clock("zlib_decompression")
+    return data
 
 
 class CloudChunkDecodingError(Exception):
@@ -413,67 +1763,124 @@ class CloudChunk:
         
         Format:
         Key = H(Owner-addr  Stream-id  nonce  blockid) 32 bytes
-        Symmetric Key-Version (to know which key version to use ) 4 bytes
+        Symmetric Key-Version (to know which key version to use ) 4 bytes,
+            the high byte is the compression codec id (0 = legacy, see talosstorage.compression)
+            and the summary flag (0x80, the plaintext starts with a ChunkSummary)
         Policy-TAG = Create_txt_id
         Len-Chunk + Encrypted Chunk (symmetric Key Ki) X bytes
         MAC (symmetric Key Ki) 16 bytes
         Signature (Public-Key of Owner) X bytes
+
+        A decoded chunk keeps a reference to the encoded buffer, the encrypted data is a
+        memoryview into it and encode() returns the buffer without re-encoding. Setting a
+        field drops the reference.
     """
 
-    def __init__(self, lookup_key, key_version, policy_tag, encrypted_data, mac_tag, signature):
+    def __init__(self, lookup_key, key_version, policy_tag, encrypted_data, mac_tag, signature,
+                 codec_id=CODEC_LEGACY, has_summary=False):
         self.key = lookup_key
         self.key_version = key_version
+        self.codec_id = codec_id
+        self.has_summary = has_summary
         self.policy_tag = policy_tag
         self.encrypted_data = encrypted_data
         self.mac_tag = mac_tag
         self.signature = signature
+        self._encoded = None
+        self._encoded_without_key = None
+
+    def __setattr__(self, name, value):
+        # the cached encodings of a decoded chunk are stale once a field changes
+        if not name.startswith("_"):
+            self.__dict__['_encoded'] = None
+            self.__dict__['_encoded_without_key'] = None
+        self.__dict__[name] = value
+
+    def _get_parts_without_signature(self):
+        return _cloud_chunk_parts_without_signature(self.key, self.key_version, self.policy_tag,
+                                                    self.encrypted_data, self.mac_tag, codec_id=self.codec_id,
+                                                    has_summary=self.has_summary)
+
+    def _get_public_part(self):
+        return _encode_cloud_chunk_public_part(self.key, self.key_version, self.policy_tag, codec_id=self.codec_id,
+                                               has_summary=self.has_summary)
+
+    def _decrypt_payload(self, symmetric_key, time_keeper=TimeKeeper()):
+        """
+        Decrypts + checks the data with aes gcm
+        :return: (ChunkSummary or None, the compressed payload)
+        """
+        time_keeper.start_clock()
+        data = decrypt_aes_gcm_data(symmetric_key, self.mac_tag, self._get_public_part(), self.encrypted_data)
+        time_keeper.stop_clock("aes_gcm_decrypt")
+        if self.has_summary:
+            return ChunkSummary.decode(data), data[ChunkSummary.FORMAT.size:]
+        return None, data
+
+    def get_and_check_summary(self, symmetric_key):
+        """
+        Given the symetric key, decrypt + check the data with aes gcm and return the summary
+        without decompressing the entries
+        :param symmetric_key: the 32 byte key
+        :return: a ChunkSummary object or None if the chunk has no summary, else expcetion thrown
+        """
+        summary, _ = self._decrypt_payload(symmetric_key)
+        return summary
 
     def get_and_check_chunk_data(self, symmetric_key, compression_used=True, time_keeper=TimeKeeper(), do_decode=True):
         """
         Given the symetric key, decrypt + check the data with aes gcm and decompress it 
         :param time_keeper: benchmark 
         :param symmetric_key: the 32 byte key
-        :param compression_used: indicates if decompression should be applied
+        :param compression_used: indicates if decompression should be applied,
+                                 ignored if the chunk header contains a codec id
         :return: a ChunkData object, else expcetion thrown 
         """
-        pub_part = _encode_cloud_chunk_public_part(self.key, self.key_version, self.policy_tag)
-        time_keeper.start_clock()
-        data = decrypt_aes_gcm_data(symmetric_key, self.mac_tag, pub_part, self.encrypted_data)
-        time_keeper.stop_clock("aes_gcm_decrypt")
-        if compression_used:
-            time_keeper.start_clock()
-            data = decompress_data(data)
-            time_keeper.stop_clock("zlib_decompression")
+        _, data = self._decrypt_payload(symmetric_key, time_keeper=time_keeper)
+        data = _decompress_chunk_payload(data, self.codec_id, compression_used, time_keeper)
         if do_decode:
             return ChunkData.decode(data)
         else:
             return data
 
-    def check_signature(self, public_key):
+    def has_merkle_signature(self):
+        return is_merkle_signature(self.signature)
+
+    def check_signature(self, public_key, verified_roots=None):
         """
         Checks if the chunk has a valid signature given the public key
         :param public_key: public key (cryptography lib key format)
+        :param verified_roots: optional cache of verified Merkle roots, see check_merkle_signed_data_parts
         :return: True if ok else throw InvalidSignature exception
         """
-        data = _enocde_cloud_chunk_without_signature(self.key, self.key_version,
-                                                     self.policy_tag, self.encrypted_data, self.mac_tag)
-        return check_signed_data(public_key, self.signature, data)
+        if self.has_merkle_signature():
+            return check_merkle_signed_data_parts(public_key, self.signature, self._get_parts_without_signature(),
+                                                  verified_roots=verified_roots)
+        return check_signed_data_parts(public_key, self.signature, self._get_parts_without_signature())
 
     def get_encoded_len(self):
         return struct.calcsize("<I") + 2 * HASH_BYTES + VERSION_BYTES + MAC_BYTES + \
                len(self.signature) + len(self.encrypted_data)
 
     def encode(self):
-        return _enocde_cloud_chunk_without_signature(self.key, self.key_version,
-                                                     self.policy_tag, self.encrypted_data, self.mac_tag) \
-               + self.signature
+        if self._encoded is not None:
+            return _to_bytes(self._encoded)
+        if self._encoded_without_key is not None:
+            return self.key + _to_bytes(self._encoded_without_key)
+        return "".join([_to_bytes(part) for part in self._get_parts_without_signature()] + [self.signature])
 
     def encode_without_signature(self):
-        return _enocde_cloud_chunk_without_signature(self.key, self.key_version,
-                                                     self.policy_tag, self.encrypted_data, self.mac_tag)
+        return _enocde_cloud_chunk_without_signature(self.key, self.key_version, self.policy_tag,
+                                                     self.encrypted_data, self.mac_tag, codec_id=self.codec_id,
+                                                     has_summary=self.has_summary)
 
     def get_encoded_without_key(self):
-        return self.encode()[HASH_BYTES:]
+        """
+        Returns a memoryview of the encoded chunk without the lookup key
+        """
+        if self._encoded_without_key is not None:
+            return memoryview(self._encoded_without_key)
+        return memoryview(self.encode())[HASH_BYTES:]
 
     def get_tag_hex(self):
         return hexlify(self.policy_tag)
@@ -484,28 +1891,59 @@ class CloudChunk:
     def get_base64_encoded(self):
         return base64.b64encode(self.encode())
 
+    @staticmethod
+    def _decode_without_key(key, view):
+        """
+        Decodes the chunk fields after the lookup key, the encrypted data stays a memoryview
+        """
+        cur_pos = 0
+        len_int = struct.calcsize("<I")
+        key_version, codec_id, has_summary = _unpack_version_field(struct.unpack_from("<I", view, cur_pos)[0])
+        cur_pos += VERSION_BYTES
+        policy_tag = view[cur_pos:(cur_pos + HASH_BYTES)].tobytes()
+        cur_pos += HASH_BYTES
+        enc_len, = struct.unpack_from("<I", view, cur_pos)
+        cur_pos += len_int
+        if cur_pos + enc_len + MAC_BYTES > len(view):
+            raise ValueError("Encrypted data length exceeds the chunk")
+        encrypted_data = view[cur_pos:(cur_pos + enc_len)]
+        cur_pos += enc_len
+        mac_tag = view[cur_pos:(cur_pos + MAC_BYTES)].tobytes()
+        cur_pos += MAC_BYTES
+        signature = view[cur_pos:].tobytes()
+        return CloudChunk(key, key_version, policy_tag, encrypted_data, mac_tag, signature, codec_id=codec_id,
+                          has_summary=has_summary)
+
     @staticmethod
     def decode(encoded):
+        """
+        Decodes a chunk without copying the encrypted data
+        :param encoded: the encoded chunk (string, bytearray or memoryview)
+        :return: a CloudChunk object
+        """
         try:
-            encoded = bytes(encoded)
-            cur_pos = 0
-            len_int = struct.calcsize("<I")
-            key = encoded[:HASH_BYTES]
-            cur_pos += HASH_BYTES
-            key_version, = struct.unpack("<I", encoded[cur_pos:(cur_pos + VERSION_BYTES)])
-            cur_pos += VERSION_BYTES
-            policy_tag = encoded[cur_pos:(cur_pos + HASH_BYTES)]
-            cur_pos += HASH_BYTES
-            enc_len, = struct.unpack("<I", encoded[cur_pos:(cur_pos + len_int)])
-            cur_pos += len_int
-            encrypted_data = encoded[cur_pos:(cur_pos + enc_len)]
-            cur_pos += enc_len
-            mac_tag = encoded[cur_pos:(cur_pos + MAC_BYTES)]
-            cur_pos += MAC_BYTES
-            signature = encoded[cur_pos:]
-            return CloudChunk(key, key_version, policy_tag, encrypted_data, mac_tag, signature)
+            view = memoryview(encoded)
+            key = view[:HASH_BYTES].tobytes()
+            chunk = CloudChunk._decode_without_key(key, view[HASH_BYTES:])
+            chunk._encoded = encoded
+            return chunk
         except Exception as r:
-            raise CloudChunkDecodingError(encoded, r.message)
+            raise CloudChunkDecodingError(_to_bytes(encoded), str(r))
+
+    @staticmethod
+    def decode_without_key(key, encoded_without_key):
+        """
+        Decodes a chunk stored without its lookup key (see get_encoded_without_key)
+        :param key: the lookup key
+        :param encoded_without_key: the encoded chunk without the key
+        :return: a CloudChunk object
+        """
+        try:
+            chunk = CloudChunk._decode_without_key(key, memoryview(encoded_without_key))
+            chunk._encoded_without_key = encoded_without_key
+            return chunk
+        except Exception as r:
+            raise CloudChunkDecodingError(key + _to_bytes(encoded_without_key), str(r))
 
     @staticmethod
     def decode_base64_str(encoded):
@@ -513,7 +1951,8 @@ class CloudChunk:
 
 
 def create_cloud_chunk(data_stream_identifier, block_id, private_key, key_version,
-                       symmetric_key, chunk_data, use_compression=True, time_keeper=TimeKeeper()):
+                       symmetric_key, chunk_data, use_compression=True, time_keeper=TimeKeeper(),
+                       codec_id=None, codec_selector=None, with_summary=False):
     """
     Creates a CloudChunk object given a plain ChunkData object. Performs encryption and signing given the keys
     and the stream identifier
@@ -525,17 +1964,81 @@ def create_cloud_chunk(data_stream_identifier, block_id, private_key, key_versio
     :param chunk_data: the ChunkData object
     :param use_compression: indicates if compression sould be apllied default:True
     :param time_keeper: benchmark util object
+    :param codec_id: if set, compress with this codec and store the codec id in the chunk header
+                     (use_compression is ignored)
+    :param codec_selector: a CodecSelector object, selects the codec per stream (overrides codec_id)
+    :param with_summary: store a ChunkSummary of the entries in front of the compressed data
     :return: a CloudChunk object
     """
+    data, codec_id, summary = _encode_chunk_for_sealing(data_stream_identifier, chunk_data, codec_id,
+                                                        codec_selector, with_summary)
+    return _seal_encoded_chunk(data_stream_identifier, block_id, private_key, key_version, symmetric_key, data,
+                               use_compression=use_compression, time_keeper=time_keeper, codec_id=codec_id,
+                               summary=summary)
 
-    # encode the chunk data
+
+def create_cloud_chunk_from_bytes(data_stream_identifier, block_id, private_key, key_version, symmetric_key, data,
+                                  use_compression=True, time_keeper=TimeKeeper(), codec_id=None):
+    """
+    Creates a CloudChunk object given raw bytes instead of a ChunkData object (e.g. a segment of a large object),
+    the bytes are returned by get_and_check_chunk_data(symmetric_key, do_decode=False)
+    :param data: the plaintext bytes
+    :return: a CloudChunk object, see create_cloud_chunk for the other parameters
+    """
+    return _seal_encoded_chunk(data_stream_identifier, block_id, private_key, key_version, symmetric_key, data,
+                               use_compression=use_compression, time_keeper=time_keeper, codec_id=codec_id)
+
+
+def _encode_chunk_for_sealing(data_stream_identifier, chunk_data, codec_id, codec_selector, with_summary):
+    """
+    Encodes the chunk data and selects the codec and the summary, see create_cloud_chunk
+    :return: (encoded data, codec id, ChunkSummary or None)
+    """
     data = chunk_data.encode()
+    if codec_selector is not None:
+        codec_id = codec_selector.get_codec_id((data_stream_identifier.owner, data_stream_identifier.streamid), data)
+    summary = ChunkSummary.from_chunk(chunk_data) if with_summary else None
+    return data, codec_id, summary
+
+
+def _seal_encoded_chunk(data_stream_identifier, block_id, private_key, key_version, symmetric_key, data,
+                        use_compression=True, time_keeper=TimeKeeper(), codec_id=None, summary=None):
+    """
+    Compresses, encrypts and signs an encoded chunk, see create_cloud_chunk
+    """
+    cloud_chunk = _seal_unsigned_chunk(data_stream_identifier, block_id, key_version, symmetric_key, data,
+                                       use_compression=use_compression, time_keeper=time_keeper,
+                                       codec_id=codec_id, summary=summary)
+    time_keeper.start_clock()
+    # sign it with ECDSA-SHA256
+    cloud_chunk.signature = hash_sign_data_parts(private_key, cloud_chunk._get_parts_without_signature())
+    time_keeper.stop_clock('ecdsa_signature')
+    return cloud_chunk
+
+
+def _seal_unsigned_chunk(data_stream_identifier, block_id, key_version, symmetric_key, data,
+                         use_compression=True, time_keeper=TimeKeeper(), codec_id=None, summary=None):
+    """
+    Compresses and encrypts an encoded chunk, the signature of the returned chunk is None
+    and is set afterwards (see sign_cloud_chunks_merkle)
+    """
+    with_summary = summary is not None
 
     # compress it
-    if use_compression:
+    if codec_id is not None:
+        time_keeper.start_clock()
+        data = get_codec(codec_id).compress(data)
+        time_keeper.stop_clock('chunk_compression')
+    elif use_compression:
+        codec_id = CODEC_LEGACY
         time_keeper.start_clock()
         data = compress_data(data)
         time_keeper.stop_clock('chunk_compression')
+    else:
+        codec_id = CODEC_LEGACY
+
+    if with_summary:
+        data = summary.encode() + data
     # get the key for the chunk given the block id
     block_key = data_stream_identifier.get_key_for_blockid(block_id)
     # get the tag for binding the chunk to a policy
@@ -544,16 +2047,130 @@ def create_cloud_chunk(data_stream_identifier, block_id, private_key, key_versio
     time_keeper.start_clock()
     # encrypt it with aes gcm
     encrypted_data, mac_tag = encrypt_aes_gcm_data(symmetric_key,
-                                                   _encode_cloud_chunk_public_part(block_key, key_version, tag), data)
+                                                   _encode_cloud_chunk_public_part(block_key, key_version, tag,
+                                                                                   codec_id=codec_id,
+                                                                                   has_summary=with_summary), data)
     time_keeper.stop_clock('gcm_encryption')
+    return CloudChunk(block_key, key_version, tag, encrypted_data, mac_tag, None, codec_id=codec_id,
+                      has_summary=with_summary)
 
+
+def sign_cloud_chunks_merkle(private_key, cloud_chunks, time_keeper=TimeKeeper()):
+    """
+    Signs the chunks with one ECDSA signature over the root of a Merkle tree, each chunk
+    gets its inclusion proof as signature (see merkle_sign_data_parts)
+    :param private_key: the private key (cryptography lib key format)
+    :param cloud_chunks: list of CloudChunk objects, the signatures are replaced
+    :param time_keeper: benchmark util object
+    :return: the cloud chunks
+    """
     time_keeper.start_clock()
-    # sign it with ECDSA-SHA256
-    signature = hash_sign_data(private_key,
-                               _enocde_cloud_chunk_without_signature(block_key, key_version,
-                                                                     tag, encrypted_data, mac_tag))
-    time_keeper.stop_clock('ecdsa_signature')
-    return CloudChunk(block_key, key_version, tag, encrypted_data, mac_tag, signature)
+    signatures = merkle_sign_data_parts(private_key, [cloud_chunk._get_parts_without_signature()
+                                                      for cloud_chunk in cloud_chunks])
+    for cloud_chunk, signature in zip(cloud_chunks, signatures):
+        cloud_chunk.signature = signature
+    time_keeper.stop_clock('merkle_signature')
+    return cloud_chunks
+
+
+def create_merkle_signed_cloud_chunks(data_stream_identifier, batch, private_key, key_version, symmetric_key,
+                                      use_compression=True, time_keeper=TimeKeeper(), codec_id=None,
+                                      codec_selector=None, with_summary=False):
+    """
+    Creates CloudChunk objects for many chunks with one Merkle batch signature instead of
+    one ECDSA signature per chunk, see create_cloud_chunk for the parameters
+    :param batch: list of (block_id, ChunkData object)
+    :return: list of CloudChunk objects in the order of the batch
+    """
+    cloud_chunks = []
+    for block_id, chunk_data in batch:
+        data, chunk_codec_id, summary = _encode_chunk_for_sealing(data_stream_identifier, chunk_data, codec_id,
+                                                                  codec_selector, with_summary)
+        cloud_chunks.append(_seal_unsigned_chunk(data_stream_identifier, block_id, key_version, symmetric_key,
+                                                 data, use_compression=use_compression, time_keeper=time_keeper,
+                                                 codec_id=chunk_codec_id, summary=summary))
+    return sign_cloud_chunks_merkle(private_key, cloud_chunks, time_keeper=time_keeper)
+
+
+_WORKER_PRIVATE_KEYS = {}
+
+
+def _seal_encoded_chunk_worker(args):
+    """
+    Process pool task of create_cloud_chunks, the private key is passed DER encoded
+    and deserialized once per worker process
+    """
+    data_stream_identifier, block_id, private_key_der, key_version, symmetric_key, data, \
+        use_compression, codec_id, summary = args
+    private_key = _WORKER_PRIVATE_KEYS.get(private_key_der)
+    if private_key is None and private_key_der is not None:
+        private_key = _WORKER_PRIVATE_KEYS[private_key_der] = \
+            serialization.load_der_private_key(private_key_der, None, default_backend())
+    time_keeper = TimeKeeper()
+    if private_key is None:
+        # Merkle batch, signed in the calling process
+        cloud_chunk = _seal_unsigned_chunk(data_stream_identifier, block_id, key_version, symmetric_key, data,
+                                           use_compression=use_compression, time_keeper=time_keeper,
+                                           codec_id=codec_id, summary=summary)
+    else:
+        cloud_chunk = _seal_encoded_chunk(data_stream_identifier, block_id, private_key, key_version,
+                                          symmetric_key, data, use_compression=use_compression,
+                                          time_keeper=time_keeper, codec_id=codec_id, summary=summary)
+    return cloud_chunk, time_keeper.logged_times
+
+
+def create_cloud_chunks(data_stream_identifier, batch, private_key, key_version, symmetric_key, workers=None,
+                        use_compression=True, codec_id=None, codec_selector=None, with_summary=False,
+                        time_keepers=None, pool=None, merkle_signature=False):
+    """
+    Creates CloudChunk objects for many chunks, the compression, encryption and signing is done in parallel
+    on a process pool. The chunks are encoded in the calling process (the encoded chunks are
+    cheaper to send to the workers than the entry objects).
+    :param data_stream_identifier: a stream identifier object
+    :param batch: list of (block_id, ChunkData object)
+    :param private_key: the private key (cryptography lib key format)
+    :param key_version: the version of the symmetric key
+    :param symmetric_key: the 32 byte symmetric key
+    :param workers: number of processes, default number of cpus (ignored if pool is given)
+    :param use_compression: see create_cloud_chunk
+    :param codec_id: see create_cloud_chunk
+    :param codec_selector: see create_cloud_chunk
+    :param with_summary: see create_cloud_chunk
+    :param time_keepers: optional list with a TimeKeeper per chunk, filled with the times of the workers
+    :param pool: an existing multiprocessing.Pool to use
+    :param merkle_signature: sign the batch with one Merkle signature in the calling process
+                             (see sign_cloud_chunks_merkle) instead of one signature per chunk
+    :return: list of CloudChunk objects in the order of the batch
+    """
+    private_key_der = None
+    if not merkle_signature:
+        private_key_der = private_key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8,
+                                                    serialization.NoEncryption())
+    tasks = []
+    for block_id, chunk_data in batch:
+        data, chunk_codec_id, summary = _encode_chunk_for_sealing(data_stream_identifier, chunk_data, codec_id,
+                                                                  codec_selector, with_summary)
+        tasks.append((data_stream_identifier, block_id, private_key_der, key_version, symmetric_key, data,
+                      use_compression, chunk_codec_id, summary))
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_seal_encoded_chunk_worker, tasks,
+                           chunksize=max(1, len(tasks) / (4 * (workers or multiprocessing.cpu_count()))))
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    if time_keepers is not None:
+        for time_keeper, (_, logged_times) in zip(time_keepers, results):
+            time_keeper.logged_times.update(logged_times)
+    cloud_chunks = [cloud_chunk for cloud_chunk, _ in results]
+    if merkle_signature:
+        sign_cloud_chunks_merkle(private_key, cloud_chunks)
+    return cloud_chunks
 
 
 def get_chunk_data_from_cloud_chunk(cloud_chunk, symmetric_key, is_compressed=True):
@@ -561,17 +2178,70 @@ def get_chunk_data_from_cloud_chunk(cloud_chunk, symmetric_key, is_compressed=Tr
     Given an encrypted CloudChunk object, decrypts it and returns a chunk data object
     :param cloud_chunk: the CloudChunk object
     :param symmetric_key: the 32 byte key for decryption
-    :param is_compressed: indicates if compression should be used
+    :param is_compressed: indicates if compression should be used (only for chunks without codec id)
     :return: a ChunkData object (the entries) InvalidTag exception if tag not matches
     """
-    # encode public part of the chunk for aes gcm verification
-    pub_part = _encode_cloud_chunk_public_part(cloud_chunk.key, cloud_chunk.key_version, cloud_chunk.policy_tag)
-
-    # decrypt with aes gcm
-    data = decrypt_aes_gcm_data(symmetric_key, cloud_chunk.mac_tag, pub_part, cloud_chunk.encrypted_data)
+    # decrypt with aes gcm, the public part of the chunk is authenticated
+    _, data = cloud_chunk._decrypt_payload(symmetric_key)
 
     # decompress data
-    if is_compressed:
-        data = decompress_data(data)
+    data = _decompress_chunk_payload(data, cloud_chunk.codec_id, is_compressed, TimeKeeper())
     # decode data
     return ChunkData.decode(data)
+
+
+_BATCH_LENGTH = struct.Struct("<I")
+_BATCH_BLOCK_ID = struct.Struct("<I")
+
+
+def encode_cloud_chunk_batch(cloud_chunks, block_ids=None):
+    """
+    Encodes a list of CloudChunk objects as one message, each chunk is prefixed with its length
+    (e.g. the body of the /get_chunks response)
+    :param cloud_chunks: list of CloudChunk objects, None is encoded as an empty chunk (missing chunk)
+    :param block_ids: list of the block ids of the chunks (optional), if given each chunk is
+                      additionally prefixed with its block id (e.g. the body of the /store_chunks request)
+    :return: the encoded batch
+    """
+    if block_ids is not None and len(block_ids) != len(cloud_chunks):
+        raise ValueError("Expected one block id per chunk")
+    parts = []
+    for index, cloud_chunk in enumerate(cloud_chunks):
+        encoded = cloud_chunk.encode() if cloud_chunk is not None else ""
+        if block_ids is not None:
+            parts.append(_BATCH_BLOCK_ID.pack(block_ids[index]))
+        parts.append(_BATCH_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    return "".join(parts)
+
+
+def decode_cloud_chunk_batch(encoded, with_block_ids=False):
+    """
+    Decodes a batch encoded with encode_cloud_chunk_batch, without copying the chunks
+    :param encoded: the encoded batch
+    :param with_block_ids: True if the batch was encoded with block ids
+    :return: list of CloudChunk objects (None for empty chunks), if with_block_ids a tuple
+             (list of CloudChunk objects, list of block ids),
+             throws CloudChunkDecodingError if the batch is malformed
+    """
+    view = memoryview(encoded)
+    cloud_chunks = []
+    block_ids = []
+    header_size = _BATCH_LENGTH.size + (_BATCH_BLOCK_ID.size if with_block_ids else 0)
+    pos = 0
+    while pos < len(view):
+        if pos + header_size > len(view):
+            raise CloudChunkDecodingError(view[pos:].tobytes(), "Truncated batch")
+        if with_block_ids:
+            block_id, = _BATCH_BLOCK_ID.unpack_from(encoded, pos)
+            block_ids.append(block_id)
+            pos += _BATCH_BLOCK_ID.size
+        length, = _BATCH_LENGTH.unpack_from(encoded, pos)
+        pos += _BATCH_LENGTH.size
+        if pos + length > len(view):
+            raise CloudChunkDecodingError(view[pos:].tobytes(), "Truncated batch")
+        cloud_chunks.append(CloudChunk.decode(view[pos:pos + length]) if length > 0 else None)
+        pos += length
+    if with_block_ids:
+        return cloud_chunks, block_ids
+    return cloud_chunks
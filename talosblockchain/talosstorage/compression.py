@@ -0,0 +1,172 @@
+import bz2
+import zlib
+from timeit import default_timer as timer
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+"""
+Registry of the compression codecs for chunks.
+The codec id is stored in the authenticated public part of a CloudChunk (high byte of the key version field).
+"""
+
+# chunks without codec id, the reader has to know if zlib was applied (compression_used flag)
+CODEC_LEGACY = 0
+CODEC_NONE = 1
+CODEC_ZLIB_FAST = 2
+CODEC_ZLIB = 3
+CODEC_ZLIB_BEST = 4
+CODEC_BZ2 = 5
+CODEC_LZMA = 6
+
+# the highest bit of the codec byte in the chunk header is used as flag
+MAX_CODEC_ID = 0x7f
+
+
+class CodecError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class Codec(object):
+    """
+    A compression codec for the encoded chunk data
+    """
+    def __init__(self, codec_id, name, compress, decompress):
+        """
+        Create a codec
+        :param codec_id: the id stored in the chunk header (1-127)
+        :param name: a readable name
+        :param compress: function data -> compressed data
+        :param decompress: function compressed data -> data
+        """
+        self.codec_id = codec_id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+    def __str__(self):
+        return "%s (%d)" % (self.name, self.codec_id)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """
+    Registers a codec, ids have to be unique
+    :param codec: the Codec object
+    """
+    if codec.codec_id <= CODEC_LEGACY or codec.codec_id > MAX_CODEC_ID:
+        raise CodecError("Invalid codec id %d" % codec.codec_id)
+    if codec.codec_id in CODECS:
+        raise CodecError("Codec id %d already registered" % codec.codec_id)
+    CODECS[codec.codec_id] = codec
+
+
+def get_codec(codec_id):
+    try:
+        return CODECS[codec_id]
+    except KeyError:
+        raise CodecError("Unknown codec id %d" % codec_id)
+
+
+def get_codec_ids():
+    return sorted(CODECS.keys())
+
+
+def _identity(data):
+    return data
+
+
+def _zlib_compressor(level):
+    return lambda data: zlib.compress(data, level)
+
+
+register_codec(Codec(CODEC_NONE, "none", _identity, _identity))
+register_codec(Codec(CODEC_ZLIB_FAST, "zlib-1", _zlib_compressor(1), zlib.decompress))
+register_codec(Codec(CODEC_ZLIB, "zlib-6", _zlib_compressor(6), zlib.decompress))
+register_codec(Codec(CODEC_ZLIB_BEST, "zlib-9", _zlib_compressor(9), zlib.decompress))
+register_codec(Codec(CODEC_BZ2, "bz2-9", lambda data: bz2.compress(data, 9), bz2.decompress))
+if lzma is not None:
+    register_codec(Codec(CODEC_LZMA, "lzma", lzma.compress, lzma.decompress))
+
+
+def benchmark_codec(codec, samples):
+    """
+    Compresses and decompresses the samples with the codec
+    :param codec: the Codec object
+    :param samples: list of encoded chunks
+    :return: (compressed size, time in seconds for compression and decompression)
+    """
+    size = 0
+    start = timer()
+    for sample in samples:
+        compressed = codec.compress(sample)
+        codec.decompress(compressed)
+        size += len(compressed)
+    return size, timer() - start
+
+
+def select_codec(samples, codec_ids=None, min_throughput=None):
+    """
+    Benchmarks the codecs on the sample chunks and selects the codec with the best compression ratio
+    which compresses and decompresses at least min_throughput bytes per second.
+    :param samples: list of encoded chunks
+    :param codec_ids: the codecs to consider, default all registered codecs
+    :param min_throughput: bytes per second, if None only the ratio is considered
+    :return: the id of the selected codec
+    """
+    codec_ids = codec_ids or get_codec_ids()
+    size_samples = sum([len(sample) for sample in samples])
+    results = []
+    for codec_id in codec_ids:
+        size, time_used = benchmark_codec(get_codec(codec_id), samples)
+        results.append((size, time_used, codec_id))
+    if min_throughput is not None:
+        fast_enough = [result for result in results
+                       if result[1] == 0 or size_samples / result[1] >= min_throughput]
+        if len(fast_enough) == 0:
+            return min(results, key=lambda result: result[1])[2]
+        results = fast_enough
+    return min(results)[2]
+
+
+class CodecSelector(object):
+    """
+    Selects a codec per stream. The first num_samples chunks of a stream are compressed
+    with the default codec and used as samples, afterwards the codec selected by
+    select_codec is used for the stream.
+    """
+    def __init__(self, num_samples=3, default_codec_id=CODEC_ZLIB, codec_ids=None, min_throughput=None):
+        self.num_samples = num_samples
+        self.default_codec_id = default_codec_id
+        self.codec_ids = codec_ids
+        self.min_throughput = min_throughput
+        self.samples = {}
+        self.selected = {}
+
+    def get_codec_id(self, stream_key, data):
+        """
+        Returns the codec id for the next chunk of a stream
+        :param stream_key: identifies the stream e.g. (owner, streamid)
+        :param data: the encoded chunk
+        :return: the codec id
+        """
+        if stream_key in self.selected:
+            return self.selected[stream_key]
+        samples = self.samples.setdefault(stream_key, [])
+        samples.append(data)
+        if len(samples) >= self.num_samples:
+            self.selected[stream_key] = select_codec(samples, codec_ids=self.codec_ids,
+                                                     min_throughput=self.min_throughput)
+            del self.samples[stream_key]
+        return self.default_codec_id
@@ -1,7 +1,10 @@
 import hashlib
+import math
 import os
 import struct
 
+from cachetools import LRUCache
+
 from talosstorage.checks import BitcoinVersionedPublicKey
 
 
@@ -13,8 +16,28 @@ def hash_sha384_32(to_hash):
     return hashlib.sha384(to_hash).digest()[:32]
 
 
+def _get_checkpoint_interval(num_keys, max_checkpoints):
+    """
+    Distance between two stored keys of a hash chain, a lookup needs at most interval - 1 hashes
+    :param num_keys: length of the chain
+    :param max_checkpoints: memory budget (number of stored keys), None for sqrt(num_keys)
+    """
+    if max_checkpoints is None:
+        return max(1, int(math.ceil(math.sqrt(num_keys))))
+    return max(1, int(math.ceil(float(num_keys) / max(1, max_checkpoints))))
+
+
 class KeyRegressionGenerator:
-    def __init__(self, seed=None, n=100, hf_seeds=hash_sha384_32, hf_hashes=hash_sha256):
+    """
+    Key regression of the owner, n seeds with n keys each.
+    The keys of a seed form a hash chain, every checkpoint_interval-th key of the recently used
+    chains is stored such that a lookup needs O(sqrt n) hashes instead of O(n).
+    """
+    def __init__(self, seed=None, n=100, hf_seeds=hash_sha384_32, hf_hashes=hash_sha256, max_checkpoints=None):
+        """
+        :param max_checkpoints: memory budget for the stored keys, None for sqrt(n) keys per chain
+                                of all chains
+        """
         self.n = n
         self.hf_seeds = hf_seeds
         self.hf_hashes = hf_hashes
@@ -25,6 +48,11 @@ class KeyRegressionGenerator:
         for i in range(n):
             prev = hf_seeds(prev)
             self.seeds.append(prev)
+        self.checkpoint_interval = _get_checkpoint_interval(n, None if max_checkpoints is None
+                                                            else max(1, max_checkpoints / n))
+        checkpoints_per_chain = int(math.ceil(float(n) / self.checkpoint_interval))
+        max_chains = n if max_checkpoints is None else max(1, max_checkpoints / checkpoints_per_chain)
+        self.chain_checkpoints = LRUCache(maxsize=max_chains)
 
     def num_keys(self):
         return self.n * self.n
@@ -37,51 +65,147 @@ class KeyRegressionGenerator:
         local_seed_version = (self.num_keys() - 1 - key_version) / self.n
         return local_seed_version, local_key_version
 
+    def _get_chain_checkpoints(self, local_seed_version):
+        """
+        Returns the stored keys of a chain, checkpoints[i] is the local key version i * checkpoint_interval
+        """
+        checkpoints = self.chain_checkpoints.get(local_seed_version)
+        if checkpoints is None:
+            checkpoints = []
+            cur_hash = self.seeds[local_seed_version]
+            for i in range(self.n):
+                cur_hash = self.hf_hashes(cur_hash)
+                if i % self.checkpoint_interval == 0:
+                    checkpoints.append(cur_hash)
+            self.chain_checkpoints[local_seed_version] = checkpoints
+        return checkpoints
+
+    def _get_next_seed(self, local_seed_version):
+        if local_seed_version + 1 < len(self.seeds):
+            return self.seeds[local_seed_version + 1]
+        return None
+
     def get_key(self, key_version):
         ls, lk = self._get_seed_and_key_for_version(key_version)
-        local_seed = self.seeds[ls]
-        cur_hash = local_seed
-        for i in range(lk + 1):
+        checkpoints = self._get_chain_checkpoints(ls)
+        cur_hash = checkpoints[lk / self.checkpoint_interval]
+        for i in range(lk % self.checkpoint_interval):
             cur_hash = self.hf_hashes(cur_hash)
-            # print "%d, %s" % (i, hexlify(cur_hash))
+        return cur_hash, self._get_next_seed(ls)
 
-        seed = None
-        if ls + 1 < len(self.seeds):
-            seed = self.seeds[ls + 1]
-        return cur_hash, seed
+    def get_keys(self, key_versions):
+        """
+        Returns the keys for a range of versions, each chain is walked once
+        :param key_versions: the versions e.g. range(10, 20)
+        :return: list of (key, seed) in the order of the versions
+        """
+        keys = {}
+        by_chain = {}
+        for key_version in key_versions:
+            ls, lk = self._get_seed_and_key_for_version(key_version)
+            by_chain.setdefault(ls, []).append(lk)
+        for ls, local_versions in by_chain.iteritems():
+            checkpoints = self._get_chain_checkpoints(ls)
+            wanted = set(local_versions)
+            seed = self._get_next_seed(ls)
+            first = min(wanted) / self.checkpoint_interval * self.checkpoint_interval
+            cur_hash = checkpoints[first / self.checkpoint_interval]
+            for lk in range(first, max(wanted) + 1):
+                if lk % self.checkpoint_interval == 0:
+                    cur_hash = checkpoints[lk / self.checkpoint_interval]
+                if lk in wanted:
+                    keys[(ls, lk)] = (cur_hash, seed)
+                cur_hash = self.hf_hashes(cur_hash)
+        return [keys[self._get_seed_and_key_for_version(key_version)] for key_version in key_versions]
 
 
 class KeyRegressionPastGenerator:
-    def __init__(self, seed, key, key_version, n=100, seed_hf=hash_sha384_32, key_hf=hash_sha256):
+    """
+    Key regression of a reader, given the key and seed of a version derives the keys of all previous
+    versions. The derived keys form one chain from ini_version down to 0, every checkpoint_interval-th
+    key (with its seed) is stored such that a lookup needs at most checkpoint_interval steps.
+    """
+    def __init__(self, seed, key, key_version, n=100, seed_hf=hash_sha384_32, key_hf=hash_sha256,
+                 max_checkpoints=None):
+        """
+        :param max_checkpoints: memory budget for the stored keys, None for sqrt(key_version) keys
+        """
         self.n = n
         self.seed_hf = seed_hf
         self.key_hf = key_hf
-        self.hashes = [key]
-        self.cur_seed = seed
         self.ini_version = key_version
         self.cur_version = key_version
+        self.checkpoint_interval = _get_checkpoint_interval(key_version + 1, max_checkpoints)
+        # (key, seed) at the versions ini_version - i * checkpoint_interval
+        self.checkpoints = [(key, seed)]
+
+    def _step(self, version, key, seed):
+        """
+        Derives the key of version - 1
+        :return: (key, seed)
+        """
+        if (version - 1) % self.n == (self.n - 1):
+            return self.key_hf(seed), self.seed_hf(seed)
+        return self.key_hf(key), seed
 
     def gen_keys(self, to_version):
-        cur_version = self.cur_version
+        """
+        Computes the checkpoints down to the given version
+        """
         assert to_version >= 0
-        cur_hash = self.hashes[self.ini_version - cur_version]
-        while cur_version > to_version:
-            cur_version -= 1
-            if cur_version % self.n == (self.n - 1):
-                cur_hash = self.key_hf(self.cur_seed)
-                # print "%d, %s" % (cur_version, hexlify(cur_hash))
-                self.cur_seed = self.seed_hf(self.cur_seed)
-            else:
-                cur_hash = self.key_hf(cur_hash)
-            self.hashes.append(cur_hash)
-        self.cur_version = cur_version
+        version = self.ini_version - (len(self.checkpoints) - 1) * self.checkpoint_interval
+        key, seed = self.checkpoints[-1]
+        while version - self.checkpoint_interval >= to_version:
+            for _ in range(self.checkpoint_interval):
+                key, seed = self._step(version, key, seed)
+                version -= 1
+            self.checkpoints.append((key, seed))
+        self.cur_version = min(self.cur_version, to_version)
+
+    def _walk(self, from_version, to_version):
+        """
+        Generator of (version, key) from from_version down to to_version
+        """
+        pos = (self.ini_version - from_version) / self.checkpoint_interval
+        self.gen_keys(self.ini_version - pos * self.checkpoint_interval)
+        version = self.ini_version - pos * self.checkpoint_interval
+        key, seed = self.checkpoints[pos]
+        while version > from_version:
+            key, seed = self._step(version, key, seed)
+            version -= 1
+        yield version, key
+        while version > to_version:
+            key, seed = self._step(version, key, seed)
+            version -= 1
+            if (self.ini_version - version) % self.checkpoint_interval == 0 and \
+                    (self.ini_version - version) / self.checkpoint_interval == len(self.checkpoints):
+                self.checkpoints.append((key, seed))
+            yield version, key
+        self.cur_version = min(self.cur_version, to_version)
 
     def get_key(self, key_version):
-        if key_version > self.ini_version:
+        if key_version > self.ini_version or key_version < 0:
             raise RuntimeError("cannot support version %d" % key_version)
-        if self.cur_version > key_version:
-            self.gen_keys(key_version)
-        return self.hashes[self.ini_version - key_version]
+        for _, key in self._walk(key_version, key_version):
+            return key
+
+    def get_keys(self, key_versions):
+        """
+        Returns the keys for many versions, the chain is walked once from the highest to the lowest version
+        :param key_versions: the versions e.g. range(10, 20)
+        :return: list of keys in the order of the versions
+        """
+        key_versions = list(key_versions)
+        if len(key_versions) == 0:
+            return []
+        if max(key_versions) > self.ini_version or min(key_versions) < 0:
+            raise RuntimeError("cannot support versions %d-%d" % (min(key_versions), max(key_versions)))
+        wanted = set(key_versions)
+        keys = {}
+        for version, key in self._walk(max(key_versions), min(key_versions)):
+            if version in wanted:
+                keys[version] = key
+        return [keys[key_version] for key_version in key_versions]
 
 
 def encode_key(key_version, n, key, seed):
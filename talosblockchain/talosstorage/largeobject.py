@@ -0,0 +1,125 @@
+from cStringIO import StringIO
+
+from talosstorage.chunkdata import ChunkData, LargeObjectEntry, TYPE_LARGE_OBJECT_ENTRY, create_cloud_chunk, \
+    create_cloud_chunk_from_bytes
+from talosstorage.timebench import TimeKeeper
+
+"""
+Large objects (e.g. high resolution pictures) are split into fixed-size segments, each segment is
+sealed (compressed, encrypted, signed) as an own CloudChunk. A manifest chunk with a LargeObjectEntry
+is stored at the block id of the object, the segments at the block ids "<block_id>/<segment index>".
+Sealing and opening read and write one segment at a time, the memory used does not depend on the
+size of the object.
+"""
+
+DEFAULT_SEGMENT_SIZE = 256 * 1024
+
+
+class LargeObjectError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def get_segment_block_id(block_id, segment_index):
+    """
+    Returns the block id of a segment, the key of the segment chunk is
+    data_stream_identifier.get_key_for_blockid(segment block id)
+    """
+    return "%d/%d" % (block_id, segment_index)
+
+
+def seal_large_object(data_stream_identifier, block_id, fileobj, private_key, key_version, symmetric_key,
+                      timestamp, metadata, segment_size=DEFAULT_SEGMENT_SIZE, codec_id=None,
+                      time_keeper=TimeKeeper()):
+    """
+    Splits the object into segments and seals them, the segments are read from the file object one at a time
+    :param data_stream_identifier: a stream identifier object
+    :param block_id: the block id of the object (the manifest chunk)
+    :param fileobj: file-like object with the object data (or a string)
+    :param private_key: the private key (cryptography lib key format)
+    :param key_version: the version of the symmetric key
+    :param symmetric_key: the 32 byte symmetric key
+    :param timestamp: the timestamp of the object
+    :param metadata: string metadata of the object
+    :param segment_size: the plaintext size of a segment
+    :param codec_id: compression codec of the segments (see talosstorage.compression), default none
+    :param time_keeper: benchmark util object
+    :return: generator of CloudChunk objects, the segments in order and the manifest chunk as last chunk
+             (store the manifest after the segments, readers never see an incomplete object)
+    """
+    if isinstance(fileobj, str):
+        fileobj = StringIO(fileobj)
+    num_segments = 0
+    object_size = 0
+    while True:
+        data = fileobj.read(segment_size)
+        if len(data) == 0:
+            break
+        object_size += len(data)
+        yield create_cloud_chunk_from_bytes(data_stream_identifier, get_segment_block_id(block_id, num_segments),
+                                            private_key, key_version, symmetric_key, data, use_compression=False,
+                                            time_keeper=time_keeper, codec_id=codec_id)
+        num_segments += 1
+    manifest = ChunkData()
+    manifest.add_entry(LargeObjectEntry(timestamp, metadata, object_size, segment_size, num_segments))
+    yield create_cloud_chunk(data_stream_identifier, block_id, private_key, key_version, symmetric_key, manifest,
+                             time_keeper=time_keeper)
+
+
+def get_large_object_entry(cloud_chunk, symmetric_key):
+    """
+    Decrypts a manifest chunk
+    :param cloud_chunk: the CloudChunk object stored at the block id of the object
+    :param symmetric_key: the 32 byte symmetric key
+    :return: the LargeObjectEntry, throws LargeObjectError if the chunk is not a manifest
+    """
+    for entry in cloud_chunk.get_and_check_chunk_data(symmetric_key).entries:
+        if entry.get_type_id() == TYPE_LARGE_OBJECT_ENTRY:
+            return entry
+    raise LargeObjectError("Chunk contains no large object")
+
+
+def iter_large_object(data_stream_identifier, block_id, manifest, fetch_chunk, symmetric_key,
+                      time_keeper=TimeKeeper()):
+    """
+    Fetches and decrypts the segments of a large object one at a time
+    :param data_stream_identifier: a stream identifier object
+    :param block_id: the block id of the object
+    :param manifest: the LargeObjectEntry (see get_large_object_entry)
+    :param fetch_chunk: function segment block id -> CloudChunk
+                        e.g. lambda bid: dht_client.fetch_chunk(bid, private_key, data_stream_identifier)
+    :param symmetric_key: the 32 byte symmetric key
+    :param time_keeper: benchmark util object
+    :return: generator of the plaintext segments, throws LargeObjectError if a segment is missing or
+             does not match the manifest and InvalidTag if a segment was modified
+    """
+    remaining = manifest.object_size
+    for index in range(manifest.num_segments):
+        segment_block_id = get_segment_block_id(block_id, index)
+        cloud_chunk = fetch_chunk(segment_block_id)
+        if cloud_chunk is None or cloud_chunk.key != data_stream_identifier.get_key_for_blockid(segment_block_id):
+            raise LargeObjectError("Segment %d missing" % index)
+        # the lookup key is authenticated with aes gcm, a segment cannot be moved to another position
+        data = cloud_chunk.get_and_check_chunk_data(symmetric_key, compression_used=False, time_keeper=time_keeper,
+                                                    do_decode=False)
+        if len(data) != min(manifest.segment_size, remaining):
+            raise LargeObjectError("Segment %d has an invalid size" % index)
+        remaining -= len(data)
+        yield data
+    if remaining != 0:
+        raise LargeObjectError("Object size does not match the segments")
+
+
+def read_large_object(data_stream_identifier, block_id, manifest, fetch_chunk, symmetric_key, fileobj,
+                      time_keeper=TimeKeeper()):
+    """
+    Writes the large object to the file object segment by segment, see iter_large_object
+    :return: the number of bytes written
+    """
+    for data in iter_large_object(data_stream_identifier, block_id, manifest, fetch_chunk, symmetric_key,
+                                  time_keeper=time_keeper):
+        fileobj.write(data)
+    return manifest.object_size
@@ -0,0 +1,299 @@
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from talosstorage.chunkdata import CloudChunk, HASH_BYTES
+from talosstorage.storage import TalosStorage
+
+"""
+Log-structured implementation of the talos storage. The chunks are immutable and written once, they are
+appended to large segment files and read back with mmap. An in-memory hash index maps the chunk key to
+(segment id, offset, length). Overwritten and deleted chunks are garbage in their segment, the compaction
+copies the live chunks of mostly dead segments to the active segment and removes the old segment files.
+
+Record format: key (32 bytes) | length (uint32) | crc32 of the data (uint32) | flags (uint8) | data
+"""
+
+DEFAULT_MAX_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_COMPACTION_RATIO = 0.5
+
+SEGMENT_FILE_FORMAT = "segment-%08d.log"
+
+_RECORD_HEADER = struct.Struct("<%dsIIB" % HASH_BYTES)
+_FLAG_DELETED = 1
+
+
+class LogStorageError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def _encode_record(key, data, flags=0):
+    return _RECORD_HEADER.pack(key, len(data), zlib.crc32(data) & 0xffffffff, flags) + data
+
+
+class _Segment(object):
+    """
+    A segment file, the data is read through a read-only mmap which is remapped when the file grew.
+    The compaction reads segments without the storage lock, the map has its own lock.
+    """
+    def __init__(self, segment_id, path):
+        self.segment_id = segment_id
+        self.path = path
+        self.file = open(path, 'a+b')
+        self.file.seek(0, os.SEEK_END)
+        self.size = self.file.tell()
+        self.map = None
+        self.map_lock = threading.Lock()
+        # bytes of records which are still referenced by the index
+        self.live_bytes = 0
+
+    def append(self, data, sync=False):
+        offset = self.size
+        self.file.write(data)
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+        self.size += len(data)
+        return offset
+
+    def read(self, offset, length):
+        with self.map_lock:
+            if self.map is None or offset + length > len(self.map):
+                if self.map is not None:
+                    self.map.close()
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.map[offset:offset + length]
+
+    def iter_records(self):
+        """
+        Scans the records of the segment, a record with a crc mismatch is skipped using its length
+        :return: generator of (offset, key, flags, data offset, length, valid), valid is False for a
+                 corrupted record, stops at the first record which runs past the end of the file
+                 (e.g. after a crash while appending)
+        """
+        if self.size == 0:
+            return
+        offset = 0
+        while offset + _RECORD_HEADER.size <= self.size:
+            key, length, crc, flags = _RECORD_HEADER.unpack(self.read(offset, _RECORD_HEADER.size))
+            data_offset = offset + _RECORD_HEADER.size
+            if data_offset + length > self.size:
+                return
+            valid = zlib.crc32(self.read(data_offset, length)) & 0xffffffff == crc
+            yield offset, key, flags, data_offset, length, valid
+            offset = data_offset + length
+
+    def truncate(self, size):
+        self._unmap()
+        self.file.truncate(size)
+        self.file.seek(0, os.SEEK_END)
+        self.size = size
+
+    def _unmap(self):
+        with self.map_lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+
+    def close(self):
+        self._unmap()
+        self.file.close()
+
+
+class LogStorage(TalosStorage):
+    """
+    Append-only talos storage with mmap reads and background compaction
+    """
+    def __init__(self, db_dir, max_segment_bytes=DEFAULT_MAX_SEGMENT_BYTES,
+                 compaction_ratio=DEFAULT_COMPACTION_RATIO, sync=False, chunk_cache=None):
+        """
+        Opens the storage and rebuilds the index from the segment files
+        :param db_dir: the directory of the segment files
+        :param max_segment_bytes: a new segment is started if the active segment is larger
+        :param compaction_ratio: segments with a smaller fraction of live bytes are compacted
+        :param sync: if True every write is synced to the disk (fsync)
+        :param chunk_cache: a ChunkCache object for the decoded chunks (optional)
+        """
+        TalosStorage.__init__(self, chunk_cache=chunk_cache)
+        self.db_dir = db_dir
+        self.max_segment_bytes = max_segment_bytes
+        self.compaction_ratio = compaction_ratio
+        self.sync = sync
+        self.lock = threading.RLock()
+        self.segments = {}
+        # key -> (segment id, data offset, length)
+        self.index = {}
+        self._compaction_thread = None
+        self._stop_compaction = threading.Event()
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self._load_segments()
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.db_dir, SEGMENT_FILE_FORMAT % segment_id)
+
+    def _load_segments(self):
+        segment_ids = []
+        for name in os.listdir(self.db_dir):
+            if not (name.startswith("segment-") and name.endswith(".log")):
+                continue
+            try:
+                segment_ids.append(int(name[len("segment-"):-len(".log")]))
+            except ValueError:
+                continue
+        for segment_id in sorted(segment_ids):
+            segment = _Segment(segment_id, self._segment_path(segment_id))
+            self.segments[segment_id] = segment
+            end = 0
+            for offset, key, flags, data_offset, length, valid in segment.iter_records():
+                end = data_offset + length
+                if not valid:
+                    continue
+                self._unlink(key)
+                if not flags & _FLAG_DELETED:
+                    self.index[key] = (segment_id, data_offset, length)
+                    segment.live_bytes += _RECORD_HEADER.size + length
+            if end < segment.size and segment_id == max(segment_ids):
+                # incomplete record at the end of the active segment, sealed segments are never shrunk
+                segment.truncate(end)
+        self.active = self.segments[max(segment_ids)] if segment_ids else self._new_segment()
+
+    def _new_segment(self):
+        segment_id = max(self.segments) + 1 if self.segments else 0
+        segment = _Segment(segment_id, self._segment_path(segment_id))
+        self.segments[segment_id] = segment
+        return segment
+
+    def _unlink(self, key):
+        location = self.index.pop(key, None)
+        if location is not None:
+            segment_id, _, length = location
+            self.segments[segment_id].live_bytes -= _RECORD_HEADER.size + length
+
+    def _append(self, records):
+        """
+        Appends (key, data, flags) records in one write and updates the index, requires the lock
+        """
+        if self.active.size >= self.max_segment_bytes:
+            self.active = self._new_segment()
+        encoded = [_encode_record(key, data, flags) for key, data, flags in records]
+        offset = self.active.append("".join(encoded), sync=self.sync)
+        for (key, data, flags), record in zip(records, encoded):
+            self._unlink(key)
+            if not flags & _FLAG_DELETED:
+                self.index[key] = (self.active.segment_id, offset + _RECORD_HEADER.size, len(data))
+                self.active.live_bytes += len(record)
+            offset += len(record)
+
+    def _store_chunk(self, chunk, block_id=None):
+        self._store_chunks([chunk])
+
+    def _store_chunks(self, chunks, block_ids=None):
+        for chunk in chunks:
+            if len(chunk.key) != HASH_BYTES:
+                raise LogStorageError("Invalid chunk key length")
+        records = [(chunk.key, chunk.get_encoded_without_key().tobytes(), 0) for chunk in chunks]
+        with self.lock:
+            self._append(records)
+
+    def _get_chunk(self, chunk_key):
+        with self.lock:
+            location = self.index.get(chunk_key)
+            if location is None:
+                return None
+            segment_id, offset, length = location
+            data = self.segments[segment_id].read(offset, length)
+        return CloudChunk.decode_without_key(chunk_key, data)
+
+    def _delete_chunk(self, chunk_key):
+        with self.lock:
+            if chunk_key in self.index:
+                self._append([(chunk_key, "", _FLAG_DELETED)])
+
+    def iter_chunk_keys(self):
+        """
+        Returns the keys of the stored chunks
+        """
+        with self.lock:
+            return list(self.index.keys())
+
+    def __contains__(self, chunk_key):
+        with self.lock:
+            return chunk_key in self.index
+
+    def __len__(self):
+        with self.lock:
+            return len(self.index)
+
+    def compact(self):
+        """
+        Copies the live chunks of the segments with less than compaction_ratio live bytes to the
+        active segment and removes the old segment files. The segments are scanned without the lock
+        (only the active segment is written), the store and get calls are blocked only while a single
+        record is copied. A segment with live chunks which could not be copied (e.g. a corrupted record)
+        is kept.
+        :return: the number of removed segments
+        """
+        with self.lock:
+            candidates = [segment for segment in self.segments.values()
+                          if segment is not self.active and
+                          segment.live_bytes < self.compaction_ratio * max(segment.size, 1)]
+        num_removed = 0
+        for segment in sorted(candidates, key=lambda s: s.segment_id):
+            for _, key, flags, data_offset, length, valid in segment.iter_records():
+                if not valid:
+                    continue
+                with self.lock:
+                    if self.segments.get(segment.segment_id) is not segment:
+                        break
+                    if flags & _FLAG_DELETED:
+                        # the tombstone hides the chunk in older segments after a restart
+                        if segment.segment_id != min(self.segments) and key not in self.index:
+                            self._append([(key, "", _FLAG_DELETED)])
+                    elif self.index.get(key) == (segment.segment_id, data_offset, length):
+                        self._append([(key, segment.read(data_offset, length), 0)])
+            with self.lock:
+                if self.segments.get(segment.segment_id) is not segment or segment.live_bytes > 0:
+                    # index entries still point to the segment
+                    continue
+                del self.segments[segment.segment_id]
+                segment.close()
+                os.remove(segment.path)
+            num_removed += 1
+        return num_removed
+
+    def _compaction_loop(self, interval):
+        while not self._stop_compaction.wait(interval):
+            self.compact()
+
+    def start_compaction(self, interval=60):
+        """
+        Runs the compaction periodically in a background thread
+        :param interval: the seconds between two compactions
+        """
+        if self._compaction_thread is not None:
+            return
+        self._stop_compaction.clear()
+        self._compaction_thread = threading.Thread(target=self._compaction_loop, args=(interval,))
+        self._compaction_thread.daemon = True
+        self._compaction_thread.start()
+
+    def stop_compaction(self):
+        if self._compaction_thread is not None:
+            self._stop_compaction.set()
+            self._compaction_thread.join()
+            self._compaction_thread = None
+
+    def close(self):
+        self.stop_compaction()
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments = {}
+            self.index = {}
@@ -0,0 +1,209 @@
+import sys
+import threading
+from Queue import Queue, Empty, Full
+
+from talosstorage.chunkdata import ChunkData, create_cloud_chunk
+
+"""
+Pipeline for producers: batches entries into chunks, seals them (compression, encryption, signing)
+and uploads them in concurrent stages connected by bounded queues.
+"""
+
+_END = object()
+_POLL_INTERVAL = 0.1
+
+
+class PipelineStopped(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def batch_entries(entries, chunk_size=1000, start_block_id=0, new_chunk=None):
+    """
+    Groups entries into chunks
+    :param entries: iterable of entries
+    :param chunk_size: the maximum number of entries per chunk
+    :param start_block_id: the block id of the first chunk
+    :param new_chunk: function returning an empty chunk, default ChunkData(max_size=chunk_size)
+    :return: generator of (block_id, chunk)
+    """
+    new_chunk = new_chunk or (lambda: ChunkData(max_size=chunk_size))
+    block_id = start_block_id
+    chunk = new_chunk()
+    for entry in entries:
+        if not chunk.add_entry(entry):
+            yield block_id, chunk
+            block_id += 1
+            chunk = new_chunk()
+            chunk.add_entry(entry)
+    if chunk.num_entries() > 0:
+        yield block_id, chunk
+
+
+def chunk_sealer(data_stream_identifier, private_key, key_version, symmetric_key, **kwargs):
+    """
+    Returns a function (block_id, chunk) -> CloudChunk, the kwargs are passed to create_cloud_chunk
+    """
+    def seal(block_id, chunk_data):
+        return create_cloud_chunk(data_stream_identifier, block_id, private_key, key_version,
+                                  symmetric_key, chunk_data, **kwargs)
+    return seal
+
+
+class _WorkerGroup(object):
+    """
+    Threads of a stage, the last thread which finishes signals the end to the next stage
+    """
+    def __init__(self, num_workers, out_queue, num_next_workers):
+        self.num_running = num_workers
+        self.out_queue = out_queue
+        self.num_next_workers = num_next_workers
+        self.lock = threading.Lock()
+
+    def worker_done(self):
+        with self.lock:
+            self.num_running -= 1
+            return self.num_running == 0
+
+
+class ChunkPipeline(object):
+    """
+    Seals and uploads chunks in bounded stages:
+
+    chunks -> feeder thread -> [queue] -> num_sealers threads (create_cloud_chunk)
+           -> [queue] -> num_uploaders threads (store) -> [queue] -> consumer
+
+    The compression, AES-GCM and ECDSA calls release the GIL, such that the stages overlap.
+    Each queue holds at most queue_size chunks, if a stage is slow the previous stages block
+    (backpressure) and the memory is bounded.
+    """
+    def __init__(self, seal, store=None, num_sealers=2, num_uploaders=2, queue_size=4):
+        """
+        Create a pipeline
+        :param seal: function (block_id, chunk) -> CloudChunk, see chunk_sealer
+        :param store: function CloudChunk -> result e.g. DHTRestClient.store_chunk, called concurrently
+                      from the uploader threads. If None the chunks are only sealed.
+        :param num_sealers: number of threads sealing chunks
+        :param num_uploaders: number of threads uploading chunks
+        :param queue_size: the maximum number of chunks waiting in front of each stage
+        """
+        self.seal = seal
+        self.store = store
+        self.num_sealers = num_sealers
+        self.num_uploaders = num_uploaders if store is not None else 0
+        self.queue_size = queue_size
+        self._stop = None
+        self._error = None
+
+    def _put(self, queue, item):
+        while True:
+            try:
+                queue.put(item, timeout=_POLL_INTERVAL)
+                return
+            except Full:
+                if self._stop.is_set():
+                    raise PipelineStopped("Pipeline stopped")
+
+    def _get(self, queue):
+        while True:
+            try:
+                return queue.get(timeout=_POLL_INTERVAL)
+            except Empty:
+                if self._stop.is_set():
+                    raise PipelineStopped("Pipeline stopped")
+
+    def _fail(self):
+        if self._error is None:
+            self._error = sys.exc_info()
+        self._stop.set()
+
+    def _feed(self, chunks, out_queue):
+        try:
+            for block_id, chunk in chunks:
+                if self._stop.is_set():
+                    return
+                self._put(out_queue, (block_id, chunk))
+            for _ in range(self.num_sealers):
+                self._put(out_queue, _END)
+        except PipelineStopped:
+            pass
+        except Exception:
+            self._fail()
+
+    def _work(self, in_queue, group, process):
+        try:
+            while True:
+                item = self._get(in_queue)
+                if item is _END:
+                    break
+                if self._stop.is_set():
+                    return
+                self._put(group.out_queue, process(item))
+            if group.worker_done():
+                for _ in range(group.num_next_workers):
+                    self._put(group.out_queue, _END)
+        except PipelineStopped:
+            pass
+        except Exception:
+            self._fail()
+
+    def _seal_item(self, item):
+        block_id, chunk = item
+        return block_id, self.seal(block_id, chunk)
+
+    def _store_item(self, item):
+        block_id, cloud_chunk = item
+        return block_id, cloud_chunk, self.store(cloud_chunk)
+
+    def run(self, chunks):
+        """
+        Runs the pipeline
+        :param chunks: iterable of (block_id, chunk) e.g. batch_entries(...)
+        :return: generator of (block_id, CloudChunk, store result or None) in completion order,
+                 re-raises the first exception of a stage
+        """
+        self._stop = threading.Event()
+        self._error = None
+        seal_queue = Queue(maxsize=self.queue_size)
+        out_queue = Queue(maxsize=self.queue_size)
+        if self.store is not None:
+            upload_queue = Queue(maxsize=self.queue_size)
+            sealers = _WorkerGroup(self.num_sealers, upload_queue, self.num_uploaders)
+            uploaders = _WorkerGroup(self.num_uploaders, out_queue, 1)
+            threads = [threading.Thread(target=self._work, args=(upload_queue, uploaders, self._store_item))
+                       for _ in range(self.num_uploaders)]
+        else:
+            sealers = _WorkerGroup(self.num_sealers, out_queue, 1)
+            threads = []
+        threads += [threading.Thread(target=self._work, args=(seal_queue, sealers, self._seal_item))
+                    for _ in range(self.num_sealers)]
+        threads.append(threading.Thread(target=self._feed, args=(chunks, seal_queue)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                try:
+                    item = self._get(out_queue)
+                except PipelineStopped:
+                    break
+                if item is _END:
+                    break
+                if self.store is None:
+                    item = item + (None,)
+                yield item
+            if self._error is not None:
+                raise self._error[0], self._error[1], self._error[2]
+        finally:
+            self._stop.set()
+
+    def run_entries(self, entries, chunk_size=1000, start_block_id=0, new_chunk=None):
+        """
+        Runs the pipeline on single entries, see batch_entries
+        """
+        return self.run(batch_entries(entries, chunk_size=chunk_size, start_block_id=start_block_id,
+                                      new_chunk=new_chunk))
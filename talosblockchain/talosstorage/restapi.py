@@ -1,10 +1,12 @@
-from flask import Flask
+from flask import Flask, Response
 from flask import request, g
 
-from talosstorage.checks import check_query_token_valid, get_and_check_query_token
-from talosstorage.chunkdata import CloudChunk
+from talosstorage.checks import check_query_token_valid, get_and_check_query_token, \
+    get_stream_identifier_from_policy
+from talosstorage.chunkdata import CloudChunk, CloudChunkDecodingError, encode_cloud_chunk_batch, \
+    decode_cloud_chunk_batch
 from talosstorage.storage import InvalidChunkError, InvalidAccess, InvalidQueryToken
-from talosvc.talosclient.restapiclient import TalosVCRestClient
+from talosvc.talosclient.restapiclient import TalosVCRestClient, TalosVCRestClientError
 
 app = Flask("Talos-Storage-LevelDB")
 
@@ -88,3 +90,104 @@ def store_chunk(chunkid):
         return "OK", 200
     except InvalidChunkError:
         return "ERROR Invalid chunk", 400
+    except TalosVCRestClientError:
+        return "ERROR No policy found", 400
+
+
+"""
+Post:
+[json token (see /get_chunk), ...]
+Returns the chunks in the order of the tokens (see chunkdata.encode_cloud_chunk_batch),
+missing chunks are empty
+"""
+
+
+@app.route('/get_chunks', methods=['POST'])
+def get_chunks():
+    msg = request.get_json(force=True)
+    try:
+        if not isinstance(msg, list):
+            raise InvalidQueryToken("ERROR Expected a list of tokens")
+        tokens = []
+        for json_token in msg:
+            token = get_and_check_query_token(json_token)
+            check_query_token_valid(token)
+            tokens.append(token)
+        # one policy lookup and access check per stream
+        streams = {}
+        for index, token in enumerate(tokens):
+            streams.setdefault((token.owner, token.streamid, token.pubkey), []).append(index)
+        storage = get_storage()
+        chunks = [None] * len(tokens)
+        for (owner, streamid, pubkey), indices in streams.iteritems():
+            policy = get_policy(owner, streamid)
+            stream_chunks = storage.get_check_chunks([tokens[index].chunk_key for index in indices],
+                                                     pubkey, policy)
+            for index, chunk in zip(indices, stream_chunks):
+                chunks[index] = chunk
+        return encode_cloud_chunk_batch(chunks)
+    except InvalidAccess:
+        return "ERROR Invalid access", 400
+    except InvalidQueryToken as e:
+        return e.value, 400
+    except:
+        return "ERROR", 400
+
+
+"""
+Post:
+bin_blocks with their block ids (see chunkdata.encode_cloud_chunk_batch with block_ids)
+"""
+
+
+@app.route('/store_chunks', methods=['POST'])
+def store_chunks():
+    encoded_chunks = request.get_data()
+    try:
+        chunks, block_ids = decode_cloud_chunk_batch(encoded_chunks, with_block_ids=True)
+        storage = get_storage()
+        storage.store_check_chunks(chunks, get_policy_with_txid, chunk_ids=block_ids)
+        return "OK", 200
+    except (InvalidChunkError, CloudChunkDecodingError):
+        return "ERROR Invalid chunk", 400
+    except TalosVCRestClientError:
+        return "ERROR No policy found", 400
+
+
+"""
+Post:
+json token (see /get_chunk), the chunk_key of the token is the key of the block start_block_id
+Streams the indexed chunks of the stream with start_block_id <= block id <= end_block_id in order
+(see chunkdata.encode_cloud_chunk_batch), requires a storage with stream index
+"""
+
+
+@app.route('/get_chunk_range/<int:start_block_id>/<int:end_block_id>', methods=['POST'])
+def get_chunk_range(start_block_id, end_block_id):
+    msg = request.get_json(force=True)
+    try:
+        token = get_and_check_query_token(msg)
+        check_query_token_valid(token)
+        policy = get_policy(token.owner, token.streamid)
+        if token.chunk_key != get_stream_identifier_from_policy(policy).get_key_for_blockid(start_block_id):
+            raise InvalidQueryToken("ERROR Token not valid for the range")
+        storage = get_storage()
+        chunks = storage.get_check_stream_range(token.pubkey, policy, start_block_id, end_block_id)
+        # checks the access before the response starts
+        first = next(chunks, None)
+    except InvalidAccess:
+        return "ERROR Invalid access", 400
+    except InvalidQueryToken as e:
+        return e.value, 400
+    except NotImplementedError:
+        return "ERROR No stream index", 400
+    except:
+        return "ERROR", 400
+
+    def generate():
+        if first is None:
+            return
+        yield encode_cloud_chunk_batch([first[1]])
+        for _, chunk in chunks:
+            yield encode_cloud_chunk_batch([chunk])
+    return Response(generate(), mimetype="application/octet-stream")
@@ -0,0 +1,71 @@
+import binascii
+from StringIO import StringIO
+
+import boto3
+from botocore.exceptions import ClientError
+
+from talosstorage.chunkdata import CloudChunk
+from talosstorage.storage import TalosStorage
+
+"""
+S3 implementation of the talos storage, the chunks are stored as objects named with the hex chunk key.
+Assumes S3 credentials are located in ~/.aws/credentials
+(see https://boto3.readthedocs.io/en/latest/guide/quickstart.html)
+"""
+
+
+def create_s3_object(endpoint_url=None):
+    """
+    Creates a boto3 S3 resource
+    :param endpoint_url: url of an S3 compatible server (e.g. a local minio server), default AWS
+    """
+    return boto3.resource('s3', endpoint_url=endpoint_url)
+
+
+def store_data_s3(s3, key, data, bucket_name):
+    s3.Object(bucket_name, key).upload_fileobj(StringIO(data))
+
+
+def get_data_s3(s3, key, bucket_name):
+    s3_object = s3.Object(bucket_name, key)
+    return s3_object.get()['Body'].read()
+
+
+def delete_data_s3(s3, key, bucket_name):
+    s3.Object(bucket_name, key).delete()
+
+
+def clean_bucket(s3, bucket_name):
+    bucket = s3.Bucket(bucket_name)
+    for key in bucket.objects.all():
+        key.delete()
+
+
+class TalosS3Storage(TalosStorage):
+    """
+    Talos storage backed by an S3 bucket
+    """
+    def __init__(self, bucket_name, s3=None, endpoint_url=None, chunk_cache=None):
+        """
+        :param bucket_name: the name of the bucket
+        :param s3: a boto3 S3 resource (optional, see create_s3_object)
+        :param endpoint_url: url of an S3 compatible server, used if s3 is None
+        :param chunk_cache: a ChunkCache object for the decoded chunks (optional)
+        """
+        TalosStorage.__init__(self, chunk_cache=chunk_cache)
+        self.s3 = s3 or create_s3_object(endpoint_url=endpoint_url)
+        self.bucket_name = bucket_name
+
+    def _get_chunk(self, chunk_key):
+        try:
+            return CloudChunk.decode(get_data_s3(self.s3, binascii.hexlify(chunk_key), self.bucket_name))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    def _store_chunk(self, chunk, block_id=None):
+        store_data_s3(self.s3, binascii.hexlify(chunk.key), chunk.encode(), self.bucket_name)
+
+    def _delete_chunk(self, chunk_key):
+        delete_data_s3(self.s3, binascii.hexlify(chunk_key), self.bucket_name)
@@ -1,7 +1,11 @@
+import struct
+import threading
+
 import leveldb
+from cachetools import LRUCache
 
 from checks import *
-from chunkdata import CloudChunk
+from chunkdata import CloudChunk, HASH_BYTES
 from talosstorage.util import *
 
 
@@ -9,6 +13,13 @@ from talosstorage.util import *
 Implementation of the talos storage, which checks each access against a policy.
 """
 
+STREAM_INDEX_PREFIX = "\x01"
+_INDEX_BLOCK_ID = struct.Struct(">Q")
+
+DEFAULT_CHUNK_CACHE_BYTES = 64 * 1024 * 1024
+# approximate size of the python objects of a decoded chunk
+_CHUNK_OBJECT_OVERHEAD = 512
+
 
 class InvalidChunkError(Exception):
     def __init__(self, value):
@@ -26,10 +37,97 @@ class InvalidAccess(Exception):
         return repr(self.value)
 
 
+def is_indexable_block_id(block_id):
+    return isinstance(block_id, (int, long)) and 0 <= block_id < (1 << 64)
+
+
+def get_stream_index_key(policy_tag, block_id):
+    """
+    Returns the key of the stream index entry of a chunk, the entries of a stream
+    are sorted by block id (big endian)
+    :param policy_tag: the binary policy tag of the stream
+    :param block_id: the (integer) block id of the chunk
+    :return: the index key
+    """
+    return STREAM_INDEX_PREFIX + policy_tag + _INDEX_BLOCK_ID.pack(block_id)
+
+
+def get_chunk_memory_size(chunk):
+    """
+    Approximates the memory used by a decoded CloudChunk object
+    """
+    return len(chunk.encrypted_data) + len(chunk.signature) + _CHUNK_OBJECT_OVERHEAD
+
+
+class ChunkCache(object):
+    """
+    Thread-safe LRU cache of decoded CloudChunk objects bounded by the memory of the chunks.
+    The chunk objects are shared between requests and must not be modified.
+    """
+    def __init__(self, max_bytes=DEFAULT_CHUNK_CACHE_BYTES):
+        """
+        :param max_bytes: the memory budget of the cached chunks (see get_chunk_memory_size)
+        """
+        self.cache = LRUCache(maxsize=max_bytes, getsizeof=get_chunk_memory_size)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+    def get(self, chunk_key):
+        with self.lock:
+            chunk = self.cache.get(chunk_key)
+            if chunk is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return chunk
+
+    def put(self, chunk, generation):
+        """
+        Caches a chunk loaded from the storage
+        :param chunk: the CloudChunk object
+        :param generation: the generation before the chunk was loaded, if chunks were invalidated
+                           in the meantime the loaded chunk may be outdated and is not cached
+        """
+        with self.lock:
+            if generation != self.generation:
+                return
+            try:
+                self.cache[chunk.key] = chunk
+            except ValueError:
+                # larger than the cache
+                pass
+
+    def invalidate(self, chunk_keys):
+        with self.lock:
+            self.generation += 1
+            for chunk_key in chunk_keys:
+                self.cache.pop(chunk_key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.cache.clear()
+
+    def get_stats(self):
+        """
+        :return: dict with the hits, misses, number of chunks and bytes of the cache
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "chunks": len(self.cache),
+                    "bytes": self.cache.currsize, "max_bytes": self.cache.maxsize}
+
+
 class TalosStorage(object):
     """
     High level interface class for a Talos storage
     """
+    def __init__(self, chunk_cache=None):
+        """
+        :param chunk_cache: a ChunkCache object for the decoded chunks (optional)
+        """
+        self.chunk_cache = chunk_cache
 
     def check_chunk_valid(self, chunk, policy, chunk_id=None, time_keeper=TimeKeeper()):
         """
@@ -82,7 +180,8 @@ class TalosStorage(object):
         time_keeper.stop_clock(ENTRY_PUT_CHECK_CHUNK)
 
         time_keeper.start_clock()
-        result_store = self._store_chunk(chunk)
+        result_store = self._store_chunk(chunk, block_id=chunk_id)
+        self._invalidate_cached_chunks([chunk.key])
         time_keeper.stop_clock(ENTRY_PUT_DB)
         return result_store
 
@@ -101,7 +200,7 @@ class TalosStorage(object):
         time_keeper.stop_clock(ENTRY_GET_CHECK_ACCESS)
 
         time_keeper.start_clock()
-        chunk = self._get_chunk(chunk_key)
+        chunk = self._load_chunk(chunk_key)
         time_keeper.stop_clock(ENTRY_GET_DB)
 
         time_keeper.start_clock()
@@ -110,25 +209,214 @@ class TalosStorage(object):
         time_keeper.stop_clock(ENTRY_GET_TAG_CHECK)
         return chunk
 
-    def _store_chunk(self, chunk):
+    def store_check_chunks(self, chunks, get_policy_for_tag, chunk_ids=None, time_keeper=TimeKeeper()):
+        """
+        Store a batch of CloudChunks if all of them validate against their Policy objects.
+        The policy is fetched once per policy tag of the batch, the batch is only stored if
+        all chunks are valid.
+        :param chunks: list of CloudChunk objects
+        :param get_policy_for_tag: function tag hex -> Policy object e.g. TalosVCRestClient.get_policy_with_txid
+        :param chunk_ids: list of the chunk ids (optional, entries can be None if not known)
+        :param time_keeper: benchamrk object
+        :return: True if ok else throws InvalidChunkError
+        """
+        if chunk_ids is None:
+            chunk_ids = [None] * len(chunks)
+        elif len(chunk_ids) != len(chunks):
+            raise InvalidChunkError("Expected one chunk id per chunk")
+        policies = {}
+        time_keeper.start_clock()
+        for chunk, chunk_id in zip(chunks, chunk_ids):
+            if chunk is None:
+                raise InvalidChunkError("Invalid chunk")
+            tag = chunk.get_tag_hex()
+            if tag not in policies:
+                policies[tag] = get_policy_for_tag(tag)
+            if policies[tag] is None:
+                raise InvalidChunkError("No policy for chunk")
+            self.check_chunk_valid(chunk, policies[tag], chunk_id=chunk_id, time_keeper=time_keeper)
+        time_keeper.stop_clock(ENTRY_PUT_CHECK_CHUNK)
+
+        time_keeper.start_clock()
+        result_store = self._store_chunks(chunks, block_ids=chunk_ids)
+        self._invalidate_cached_chunks([chunk.key for chunk in chunks])
+        time_keeper.stop_clock(ENTRY_PUT_DB)
+        return result_store
+
+    def get_check_chunks(self, chunk_keys, pubkey, policy, time_keeper=TimeKeeper()):
+        """
+        Given a list of chunk retrival keys of one stream, a public key and a policy object,
+        tries to retrive the corresponding chunks. The access is checked once for the batch.
+        :param chunk_keys: list of chunk retrieval keys
+        :param pubkey: the hex string public key
+        :param policy: the Policy object
+        :param time_keeper: benchmark object
+        :return: list of CloudChunk objects in the order of the keys, None if a chunk is not stored
+        """
+        time_keeper.start_clock()
+        self.check_access_valid(pubkey, policy)
+        time_keeper.stop_clock(ENTRY_GET_CHECK_ACCESS)
+
+        time_keeper.start_clock()
+        chunks = self._get_chunks(chunk_keys)
+        time_keeper.stop_clock(ENTRY_GET_DB)
+
+        time_keeper.start_clock()
+        for chunk in chunks:
+            if chunk is not None and not check_tag_matches(chunk, policy):
+                raise InvalidAccess("Chunk not matches policy")
+        time_keeper.stop_clock(ENTRY_GET_TAG_CHECK)
+        return chunks
+
+    def get_check_stream_range(self, pubkey, policy, start_block_id, end_block_id, time_keeper=TimeKeeper()):
+        """
+        Given a public key and a policy object, retrieves the chunks of the stream with block ids in
+        [start_block_id, end_block_id] in order of the block id. Only chunks stored with their
+        block id (see store_check_chunk) are found.
+        :param pubkey: the hex string public key
+        :param policy: the Policy object
+        :param start_block_id: the first block id
+        :param end_block_id: the last block id (inclusive)
+        :param time_keeper: benchmark object
+        :return: generator of (block_id, CloudChunk) throws InvalidAccess if the access is not valid
+        """
+        time_keeper.start_clock()
+        self.check_access_valid(pubkey, policy)
+        time_keeper.stop_clock(ENTRY_GET_CHECK_ACCESS)
+
+        stream_ident = get_stream_identifier_from_policy(policy)
+        for block_id, chunk in self._iter_stream_range(stream_ident.get_tag(), start_block_id, end_block_id):
+            if not check_tag_matches(chunk, policy):
+                raise InvalidAccess("Chunk not matches policy")
+            yield block_id, chunk
+
+    def delete_chunk(self, chunk_key):
+        """
+        Deletes a chunk from the storage (local maintenance, no access check)
+        :param chunk_key: the chunk retrieval key
+        """
+        self._delete_chunk(chunk_key)
+        self._invalidate_cached_chunks([chunk_key])
+
+    def get_chunk_cache_stats(self):
+        """
+        :return: the statistics of the chunk cache (see ChunkCache.get_stats) or None if there is no cache
+        """
+        if self.chunk_cache is None:
+            return None
+        return self.chunk_cache.get_stats()
+
+    def _load_chunk(self, chunk_key):
+        if self.chunk_cache is None:
+            return self._get_chunk(chunk_key)
+        chunk = self.chunk_cache.get(chunk_key)
+        if chunk is None:
+            generation = self.chunk_cache.generation
+            chunk = self._get_chunk(chunk_key)
+            if chunk is not None:
+                self.chunk_cache.put(chunk, generation)
+        return chunk
+
+    def _invalidate_cached_chunks(self, chunk_keys):
+        if self.chunk_cache is not None:
+            self.chunk_cache.invalidate(chunk_keys)
+
+    def _store_chunk(self, chunk, block_id=None):
         pass
 
     def _get_chunk(self, chunk_key):
         pass
 
+    def _delete_chunk(self, chunk_key):
+        pass
+
+    def _store_chunks(self, chunks, block_ids=None):
+        if block_ids is None:
+            block_ids = [None] * len(chunks)
+        for chunk, block_id in zip(chunks, block_ids):
+            self._store_chunk(chunk, block_id=block_id)
+
+    def _get_chunks(self, chunk_keys):
+        return [self._load_chunk(chunk_key) for chunk_key in chunk_keys]
+
+    def _iter_stream_range(self, policy_tag, start_block_id, end_block_id):
+        for block_id, chunk_key in self._iter_stream_range_keys(policy_tag, start_block_id, end_block_id):
+            chunk = self._load_chunk(chunk_key)
+            if chunk is None:
+                continue
+            yield block_id, chunk
+
+    def _iter_stream_range_keys(self, policy_tag, start_block_id, end_block_id):
+        """
+        Returns a generator of (block_id, chunk key) of the stream index entries in block id order,
+        the entries of deleted chunks may still be returned
+        """
+        raise NotImplementedError("Storage has no stream index")
+
 
 class LevelDBStorage(TalosStorage):
     """
     Simple level db implementation of the talos storage for testing
     """
-    def __init__(self, db_dir):
+    def __init__(self, db_dir, stream_index=False, chunk_cache_bytes=0):
+        """
+        :param db_dir: the leveldb directory
+        :param stream_index: if True, chunks stored with their block id are indexed by policy tag and
+                             block id in the same db (keys with STREAM_INDEX_PREFIX), such that the chunks
+                             of a stream can be scanned in order (see get_check_stream_range)
+        :param chunk_cache_bytes: memory budget of the decoded chunk cache, 0 disables the cache
+        """
+        TalosStorage.__init__(self, chunk_cache=ChunkCache(chunk_cache_bytes) if chunk_cache_bytes > 0 else None)
         self.db = leveldb.LevelDB(db_dir)
+        self.stream_index = stream_index
 
-    def _store_chunk(self, chunk):
-        self.db.Put(chunk.key, chunk.get_encoded_without_key())
+    def _encode_value(self, chunk):
+        return chunk.get_encoded_without_key()
+
+    def _store_chunk(self, chunk, block_id=None):
+        if self.stream_index and is_indexable_block_id(block_id):
+            self._store_chunks([chunk], block_ids=[block_id])
+        else:
+            self.db.Put(chunk.key, self._encode_value(chunk))
 
     def _get_chunk(self, chunk_key):
-        bin_chunk = self.db.Get(chunk_key)
-        if bin_chunk is None:
+        try:
+            bin_chunk = self.db.Get(chunk_key)
+        except KeyError:
             return None
-        return CloudChunk.decode(chunk_key + bin_chunk)
+        return CloudChunk.decode_without_key(chunk_key, bin_chunk)
+
+    def _delete_chunk(self, chunk_key):
+        self.db.Delete(chunk_key)
+
+    def iter_chunk_keys(self):
+        """
+        Returns a generator of the keys of the stored chunks (without the stream index entries)
+        """
+        for key in self.db.RangeIter(include_value=False):
+            if len(key) == HASH_BYTES:
+                yield key
+
+    def _store_chunks(self, chunks, block_ids=None):
+        # one atomic write for the whole batch, the chunks and their index entries
+        if block_ids is None:
+            block_ids = [None] * len(chunks)
+        batch = leveldb.WriteBatch()
+        for chunk, block_id in zip(chunks, block_ids):
+            batch.Put(chunk.key, self._encode_value(chunk))
+            if self.stream_index and is_indexable_block_id(block_id):
+                batch.Put(get_stream_index_key(chunk.policy_tag, block_id), chunk.key)
+        self.db.Write(batch, sync=False)
+
+    def _iter_stream_range_keys(self, policy_tag, start_block_id, end_block_id):
+        if not self.stream_index:
+            raise NotImplementedError("Stream index not enabled")
+        if end_block_id < start_block_id:
+            return
+        start_block_id = max(0, start_block_id)
+        end_block_id = min(end_block_id, (1 << 64) - 1)
+        # sequential scan over the index entries of the stream
+        for index_key, chunk_key in self.db.RangeIter(get_stream_index_key(policy_tag, start_block_id),
+                                                      get_stream_index_key(policy_tag, end_block_id)):
+            block_id, = _INDEX_BLOCK_ID.unpack_from(index_key, len(STREAM_INDEX_PREFIX) + len(policy_tag))
+            yield block_id, chunk_key
@@ -1,3 +1,4 @@
+import StringIO
 import unittest
 import time
 import json
@@ -8,8 +9,12 @@ from pybitcoin import extract_bin_bitcoin_pubkey, get_bin_hash160, bin_hash160_t
 from global_tests.test_storage_api import generate_random_chunk
 from talosstorage.checks import check_key_matches, check_tag_matches, check_signature, \
     get_crypto_ecdsa_pubkey_from_bitcoin_hex, BitcoinVersionedPrivateKey, get_priv_key, get_bitcoin_address_for_pubkey, \
-    BitcoinVersionedPublicKey, QueryToken, check_valid
+    BitcoinVersionedPublicKey, QueryToken, check_valid, clear_key_caches, PUBLIC_KEY_CACHE
 from talosstorage.chunkdata import *
+from talosstorage.compression import *
+from talosstorage.largeobject import seal_large_object, get_large_object_entry, read_large_object, \
+    LargeObjectError
+from talosstorage.pipeline import ChunkPipeline, chunk_sealer
 
 import talosstorage.keymanagement as km
 from timeit import default_timer as timer
@@ -78,6 +83,315 @@ class TestChunk(unittest.TestCase):
         chunk_after = ChunkData.decode(encoded)
         self.assertEquals(pic, chunk_after.entries[0].picture_data)
 
+    def test_encode_preallocated(self):
+        chunk = ChunkData()
+        for i in range(100):
+            chunk.add_entry(DoubleEntry(i, "test", float(i)))
+            chunk.add_entry(MultiDoubleEntry(i, "sm-h1", [float(i), 0.5, 1.5]))
+        encoded = chunk.encode()
+        self.assertEquals(chunk.get_encoded_size(), len(encoded))
+        self.assertEquals("".join([entry.encode() for entry in chunk.entries]), encoded)
+        chunk_after = ChunkData.decode(encoded)
+        for i in range(0, len(chunk_after.entries), 2):
+            self.assertEquals(str(chunk.entries[i]), str(chunk_after.entries[i]))
+
+    def test_columnar_chunk(self):
+        chunk = ColumnarChunkData(max_size=1000)
+        for i in range(1000):
+            self.assertTrue(chunk.add_entry(DoubleEntry(1000 + i, "test", float(i) / 3)))
+        self.assertFalse(chunk.add_entry(DoubleEntry(2000, "test", 0.0)))
+        key = os.urandom(32)
+        private_key = ec.generate_private_key(ec.SECP256K1, default_backend())
+        stream_ident = DataStreamIdentifier("pubaddr", 3, "asvcgdterategdts",
+                                            "59f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb")
+
+        cd = create_cloud_chunk(stream_ident, 1, private_key, 1, key, chunk)
+        chunk_after = CloudChunk.decode(cd.encode()).get_and_check_chunk_data(key)
+
+        self.assertTrue(isinstance(chunk_after, ColumnarChunkData))
+        self.assertEquals(chunk.num_entries(), chunk_after.num_entries())
+        for before, after in zip(chunk, chunk_after):
+            self.assertEquals(str(before), str(after))
+
+    def test_timeseries_entry(self):
+        entries = [MultiDoubleEntry(1000 + i * 15, "sm-h1", [230.0 + (i % 7) * 0.01, 0.0, float(i)])
+                   for i in range(500)]
+        chunk = ChunkData(entries_in=[TimeSeriesEntry.from_entries(entries)])
+        encoded = chunk.encode()
+        self.assertTrue(len(encoded) < len(ChunkData(entries_in=entries).encode()) / 2)
+        entry_after = ChunkData.decode(encoded).entries[0]
+        for before, after in zip(entries, entry_after):
+            self.assertEquals(str(before), str(after))
+
+        chunk = ColumnarChunkData(max_size=100, use_timeseries_codec=True)
+        for i in range(100):
+            chunk.add_value(1000 + i - (i % 3), "test", float(i) / 3)
+        chunk_after = ChunkData.decode(chunk.encode())
+        self.assertTrue(chunk_after.use_timeseries_codec)
+        for before, after in zip(chunk, chunk_after):
+            self.assertEquals(str(before), str(after))
+
+    def test_multi_entries(self):
+        chunk = ChunkData()
+        chunk.add_entry(MultiDoubleEntry(1, "sm-h1", [230.5, 0.0, -1.25]))
+        chunk.add_entry(MultiIntegerEntry(2, "counter", [0, 7, 2 ** 32 - 1]))
+        encoded = chunk.encode()
+        self.assertEquals(chunk.get_encoded_size(), len(encoded))
+        chunk_after = ChunkData.decode(encoded)
+        self.assertEquals([230.5, 0.0, -1.25], chunk_after.entries[0].values)
+        self.assertEquals(TYPE_MULTI_INT_ENTRY, chunk_after.entries[1].get_type_id())
+        self.assertEquals([0, 7, 2 ** 32 - 1], chunk_after.entries[1].values)
+
+    def test_to_numpy(self):
+        chunk = ChunkData()
+        for i in range(100):
+            chunk.add_entry(DoubleEntry(i, "sensor-1", float(i)))
+        array = chunk_to_numpy(chunk.encode())
+        self.assertTrue(array.base is not None)
+        self.assertEquals(range(100), array['timestamp'].tolist())
+        self.assertEquals(chunk.to_numpy().tolist(), array.tolist())
+        self.assertEquals(str(chunk.entries[5]), str(ChunkData.from_numpy(array).entries[5]))
+
+        chunk = ChunkData(use_metadata_table=True, use_index=True)
+        for i in range(100):
+            chunk.add_entry(MultiDoubleEntry(i, "sm-%d" % (i % 3), [float(i), 0.5]))
+        array = chunk_to_numpy(chunk.encode())
+        for field in ['timestamp', 'metadata', 'values']:
+            self.assertEquals(chunk.to_numpy()[field].tolist(), array[field].tolist())
+        self.assertEquals("sm-1", array['metadata'][4])
+        self.assertEquals([4.0, 0.5], array['values'][4].tolist())
+
+    def test_metadata_table(self):
+        chunk = ChunkData(use_metadata_table=True)
+        for i in range(100):
+            chunk.add_entry(DoubleEntry(i, "device-3-7", float(i)))
+            chunk.add_entry(MultiDoubleEntry(i, "sm-h1", [float(i), 0.5]))
+        encoded = chunk.encode()
+        self.assertEquals(chunk.get_encoded_size(), len(encoded))
+        self.assertTrue(len(encoded) < len(ChunkData(entries_in=chunk.entries).encode()))
+        chunk_after = ChunkData.decode(encoded)
+        self.assertTrue(chunk_after.use_metadata_table)
+        self.assertEquals(chunk.num_entries(), chunk_after.num_entries())
+        for before, after in zip(chunk, chunk_after):
+            self.assertEquals(before.metadata, after.metadata)
+        self.assertEquals(str(chunk.entries[10]), str(chunk_after.entries[10]))
+
+    def test_chunk_index(self):
+        chunk = ChunkData(max_size=1000, use_metadata_table=True, use_index=True)
+        for i in range(1000):
+            chunk.add_entry(DoubleEntry(1000 + i * 2, "device-3-7", float(i)))
+        encoded = chunk.encode()
+        self.assertEquals(chunk.get_encoded_size(), len(encoded))
+
+        view = ChunkDataView(encoded)
+        self.assertEquals(1000, view.num_entries())
+        self.assertEquals(str(chunk.entries[500]), str(view.get_entry(500)))
+        self.assertEquals(2, view.find_timestamp(1003))
+        self.assertEquals(["1004 device-3-7 2.0", "1006 device-3-7 3.0"],
+                          [str(entry) for entry in view.get_entries_in_range(1003, 1007)])
+        self.assertEquals(str(chunk.entries[-1]), str(view.get_last_entries(1)[0]))
+
+        chunk_after = ChunkData.decode(encoded)
+        self.assertTrue(chunk_after.use_index)
+        self.assertEquals(chunk.num_entries(), chunk_after.num_entries())
+        self.assertFalse(ChunkDataView.has_index(ChunkData(entries_in=chunk.entries).encode()))
+
+    def test_codec_id(self):
+        chunk = ChunkData()
+        for i in range(100):
+            chunk.add_entry(DoubleEntry(i, "test", float(i)))
+        key = os.urandom(32)
+        private_key = ec.generate_private_key(ec.SECP256K1, default_backend())
+        stream_ident = DataStreamIdentifier("pubaddr", 3, "asvcgdterategdts",
+                                            "59f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb")
+        for codec_id in get_codec_ids():
+            cloud_chunk = CloudChunk.decode(create_cloud_chunk(stream_ident, 1, private_key, 7, key, chunk,
+                                                               codec_id=codec_id).encode())
+            self.assertEquals(codec_id, cloud_chunk.codec_id)
+            self.assertEquals(7, cloud_chunk.key_version)
+            chunk_after = cloud_chunk.get_and_check_chunk_data(key, compression_used=False)
+            self.assertEquals(str(chunk.entries[10]), str(chunk_after.entries[10]))
+
+        # the codec id is authenticated
+        cloud_chunk.codec_id = CODEC_NONE if cloud_chunk.codec_id != CODEC_NONE else CODEC_ZLIB
+        self.assertRaises(InvalidTag, cloud_chunk.get_and_check_chunk_data, key)
+
+        selector = CodecSelector(num_samples=2, codec_ids=[CODEC_NONE, CODEC_ZLIB])
+        codec_ids = [create_cloud_chunk(stream_ident, i, private_key, 7, key, chunk,
+                                        codec_selector=selector).codec_id for i in range(3)]
+        self.assertEquals([CODEC_ZLIB, CODEC_ZLIB, CODEC_ZLIB], codec_ids)
+
+    def test_chunk_summary(self):
+        chunk = ChunkData()
+        for i in range(100):
+            chunk.add_entry(DoubleEntry(1000 + i, "test", float(i)))
+        key = os.urandom(32)
+        private_key = ec.generate_private_key(ec.SECP256K1, default_backend())
+        stream_ident = DataStreamIdentifier("pubaddr", 3, "asvcgdterategdts",
+                                            "59f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb")
+        cloud_chunk = CloudChunk.decode(create_cloud_chunk(stream_ident, 1, private_key, 1, key, chunk,
+                                                           with_summary=True).encode())
+        self.assertTrue(cloud_chunk.has_summary)
+        summary = cloud_chunk.get_and_check_summary(key)
+        self.assertEquals((1000, 1099, 100), (summary.min_timestamp, summary.max_timestamp, summary.count))
+        self.assertEquals((0.0, 99.0, 4950.0), (summary.min_value, summary.max_value, summary.sum_values))
+        self.assertTrue(summary.overlaps(1099, 2000))
+        self.assertFalse(summary.overlaps(1100, 2000))
+        self.assertEquals(str(chunk.entries[10]), str(cloud_chunk.get_and_check_chunk_data(key).entries[10]))
+        self.assertTrue(cloud_chunk.check_signature(private_key.public_key()))
+
+        cloud_chunk.has_summary = False
+        self.assertRaises(InvalidTag, cloud_chunk.get_and_check_summary, key)
+
+    def test_pipeline(self):
+        key = os.urandom(32)
+        private_key = ec.generate_private_key(ec.SECP256K1, default_backend())
+        stream_ident = DataStreamIdentifier("pubaddr", 3, "asvcgdterategdts",
+                                            "59f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb")
+        stored = {}
+
+        def store(cloud_chunk):
+            stored[cloud_chunk.key] = cloud_chunk.encode()
+            return True
+
+        pipeline = ChunkPipeline(chunk_sealer(stream_ident, private_key, 1, key), store=store, queue_size=2)
+        entries = (DoubleEntry(i, "test", float(i)) for i in range(1050))
+        results = sorted(pipeline.run_entries(entries, chunk_size=100))
+        self.assertEquals(range(11), [block_id for block_id, _, _ in results])
+        self.assertEquals(11, len(stored))
+        chunk_after = CloudChunk.decode(stored[stream_ident.get_key_for_blockid(10)]).get_and_check_chunk_data(key)
+        self.assertEquals("1049 test 1049.0", str(chunk_after.entries[-1]))
+
+        def failing_store(cloud_chunk):
+            raise IOError("upload failed")
+
+        pipeline = ChunkPipeline(chunk_sealer(stream_ident, private_key, 1, key), store=failing_store)
+        entries = [DoubleEntry(i, "test", float(i)) for i in range(100)]
+        self.assertRaises(IOError, list, pipeline.run_entries(entries, chunk_size=10))
+
+    def test_create_cloud_chunks(self):
+        key = os.urandom(32)
+        private_key = ec.generate_private_key(ec.SECP256K1, default_backend())
+        stream_ident = DataStreamIdentifier("pubaddr", 3, "asvcgdterategdts",
+                                            "59f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb")
+        batch = []
+        for block_id in range(8):
+            chunk = ChunkData()
+            for i in range(100):
+                chunk.add_entry(DoubleEntry(block_id * 100 + i, "test", float(i)))
+            batch.append((block_id, chunk))
+        time_keepers = [TimeKeeper() for _ in batch]
+        cloud_chunks = create_cloud_chunks(stream_ident, batch, private_key, 1, key, workers=2,
+                                           time_keepers=time_keepers, with_summary=True)
+        for (block_id, chunk), cloud_chunk, time_keeper in zip(batch, cloud_chunks, time_keepers):
+            self.assertEquals(stream_ident.get_key_for_blockid(block_id), cloud_chunk.key)
+            self.assertTrue(cloud_chunk.check_signature(private_key.public_key()))
+            self.assertEquals(str(chunk.entries[-1]), str(cloud_chunk.get_and_check_chunk_data(key).entries[-1]))
+            self.assertTrue("gcm_encryption" in time_keeper.logged_times)
+
+    def test_merkle_signature(self):
+        key = os.urandom(32)
+        private_key = ec.generate_private_key(ec.SECP256K1, default_backend())
+        stream_ident = DataStreamIdentifier("pubaddr", 3, "asvcgdterategdts",
+                                            "59f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb")
+        for num_chunks in [1, 2, 7]:
+            batch = []
+            for block_id in range(num_chunks):
+                chunk = ChunkData()
+                for i in range(10):
+                    chunk.add_entry(DoubleEntry(block_id * 10 + i, "test", float(i)))
+                batch.append((block_id, chunk))
+            cloud_chunks = create_merkle_signed_cloud_chunks(stream_ident, batch, private_key, 1, key)
+            verified_roots = {}
+            for cloud_chunk in cloud_chunks:
+                cloud_chunk = CloudChunk.decode(cloud_chunk.encode())
+                self.assertTrue(cloud_chunk.has_merkle_signature())
+                self.assertTrue(cloud_chunk.check_signature(private_key.public_key(), verified_roots=verified_roots))
+                self.assertEquals(1, len(verified_roots))
+
+        other_key = ec.generate_private_key(ec.SECP256K1, default_backend())
+        self.assertRaises(InvalidSignature, cloud_chunks[0].check_signature, other_key.public_key(),
+                          verified_roots=verified_roots)
+        tampered = CloudChunk(cloud_chunks[1].key, cloud_chunks[1].key_version, cloud_chunks[1].policy_tag,
+                              cloud_chunks[2].encrypted_data, cloud_chunks[1].mac_tag, cloud_chunks[1].signature)
+        self.assertRaises(InvalidSignature, tampered.check_signature, private_key.public_key(),
+                          verified_roots=verified_roots)
+
+    def test_keys_for_blockids(self):
+        stream_ident = DataStreamIdentifier("pubaddr", 3, "asvcgdterategdts",
+                                            "59f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb")
+        hasher = hashlib.sha256()
+        hasher.update("pubaddr" + "3" + "asvcgdterategdts" + "42")
+        self.assertEquals(hasher.digest(), stream_ident.get_key_for_blockid(42))
+        self.assertEquals([stream_ident.get_key_for_blockid(block_id) for block_id in range(100)],
+                          stream_ident.get_keys_for_blockids(range(100)))
+
+    def test_large_object(self):
+        key = os.urandom(32)
+        private_key = ec.generate_private_key(ec.SECP256K1, default_backend())
+        stream_ident = DataStreamIdentifier("pubaddr", 3, "asvcgdterategdts",
+                                            "59f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb")
+        picture = os.urandom(100000)
+        stored = {}
+        for cloud_chunk in seal_large_object(stream_ident, 7, picture, private_key, 1, key, 1000, "cam",
+                                             segment_size=30000, codec_id=CODEC_ZLIB_FAST):
+            self.assertTrue(cloud_chunk.check_signature(private_key.public_key()))
+            stored[cloud_chunk.key] = cloud_chunk.encode()
+        self.assertEquals(5, len(stored))
+
+        def fetch_chunk(block_id):
+            encoded = stored.get(stream_ident.get_key_for_blockid(block_id))
+            return None if encoded is None else CloudChunk.decode(encoded)
+
+        manifest = get_large_object_entry(fetch_chunk(7), key)
+        self.assertEquals((100000, 4), (manifest.object_size, manifest.num_segments))
+        out = StringIO.StringIO()
+        read_large_object(stream_ident, 7, manifest, fetch_chunk, key, out)
+        self.assertEquals(picture, out.getvalue())
+
+        del stored[stream_ident.get_key_for_blockid("7/3")]
+        self.assertRaises(LargeObjectError, read_large_object, stream_ident, 7, manifest, fetch_chunk, key,
+                          StringIO.StringIO())
+
+    def test_public_key_cache(self):
+        clear_key_caches()
+        key = BitcoinVersionedPrivateKey("cN5YgNRq8rbcJwngdp3fRzv833E7Z74TsF8nB6GhzRg8Gd9aGWH1")
+        hex_pubkey = key.public_key().to_hex()
+        pub_key = get_crypto_ecdsa_pubkey_from_bitcoin_hex(hex_pubkey)
+        self.assertTrue(hex_pubkey in PUBLIC_KEY_CACHE)
+        self.assertTrue(pub_key is get_crypto_ecdsa_pubkey_from_bitcoin_hex(hex_pubkey))
+        data = "test"
+        check_signed_data(pub_key, hash_sign_data(get_priv_key(key), data), data)
+        clear_key_caches()
+        self.assertEquals(0, len(PUBLIC_KEY_CACHE))
+
+    def test_decode_memoryview(self):
+        chunk = ChunkData()
+        for i in range(100):
+            chunk.add_entry(DoubleEntry(i, "test", float(i)))
+        key = os.urandom(32)
+        private_key = ec.generate_private_key(ec.SECP256K1, default_backend())
+        stream_ident = DataStreamIdentifier("pubaddr", 3, "asvcgdterategdts",
+                                            "59f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb")
+        encoded = create_cloud_chunk(stream_ident, 1, private_key, 1, key, chunk).encode()
+
+        cloud_chunk = CloudChunk.decode(memoryview(encoded))
+        self.assertTrue(isinstance(cloud_chunk.encrypted_data, memoryview))
+        self.assertTrue(cloud_chunk.check_signature(private_key.public_key()))
+        self.assertEquals(encoded, cloud_chunk.encode())
+        self.assertEquals(encoded[HASH_BYTES:], cloud_chunk.get_encoded_without_key().tobytes())
+
+        cloud_chunk = CloudChunk.decode_without_key(encoded[:HASH_BYTES], encoded[HASH_BYTES:])
+        self.assertEquals(encoded, cloud_chunk.encode())
+        chunk_after = cloud_chunk.get_and_check_chunk_data(key)
+        self.assertEquals(str(chunk.entries[10]), str(chunk_after.entries[10]))
+
+        other_key = ec.generate_private_key(ec.SECP256K1, default_backend())
+        cloud_chunk.signature = hash_sign_data_parts(other_key, cloud_chunk._get_parts_without_signature())
+        self.assertNotEquals(encoded, cloud_chunk.encode())
+        self.assertEquals(cloud_chunk.encode()[HASH_BYTES:], cloud_chunk.get_encoded_without_key().tobytes())
+        self.assertTrue(CloudChunk.decode(cloud_chunk.encode()).check_signature(other_key.public_key()))
+
 
 def check_chunk_valid(chunk, policy, chunk_id=None):
     try:
@@ -246,6 +560,21 @@ class TestKeyReg(unittest.TestCase):
             #print "before: %s after: %s" % (hexlify(key_null), hexlify(compare_key))
             self.assertEquals(compare_key, key_null)
 
+    def test_key_reg_checkpoints(self):
+        n = 20
+        max_version = 150
+        gen = km.KeyRegressionGenerator(seed="hello", n=n)
+        small_gen = km.KeyRegressionGenerator(seed="hello", n=n, max_checkpoints=30)
+        key_max, seed_max = gen.get_key(max_version)
+        past = km.KeyRegressionPastGenerator(seed_max, key_max, max_version, n=n, max_checkpoints=5)
+        versions = range(max_version + 1)
+        keys = [key for key, _ in gen.get_keys(versions)]
+        self.assertEquals(keys, [small_gen.get_key(version)[0] for version in versions])
+        self.assertEquals(keys[7], past.get_key(7))
+        self.assertEquals(keys[:100:3], past.get_keys(range(0, 100, 3)))
+        self.assertEquals(keys[::-1], past.get_keys(reversed(versions)))
+        self.assertTrue(len(past.checkpoints) <= 5)
+
     def test_encode_decode(self):
         n = 100
         gen = km.KeyRegressionGenerator(seed="hello", n=n)
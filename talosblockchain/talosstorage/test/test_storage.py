@@ -0,0 +1,344 @@
+import base64
+import os
+import shutil
+import tempfile
+import unittest
+
+from talosstorage.checks import BitcoinVersionedPrivateKey, get_priv_key
+from talosstorage.chunkdata import ChunkData, DoubleEntry, DataStreamIdentifier, create_cloud_chunk, \
+    encode_cloud_chunk_batch, decode_cloud_chunk_batch
+from talosstorage import restapi
+from talosstorage.logstorage import LogStorage
+from talosstorage.storage import InvalidChunkError, LevelDBStorage
+from talosstorage.tieredstorage import TieredStorage
+from talosvc.policy import Policy
+from talosvc.talosclient.restapiclient import TalosVCRestClientError
+
+PRIVATE_KEY = "cN5YgNRq8rbcJwngdp3fRzv833E7Z74TsF8nB6GhzRg8Gd9aGWH1"
+NONCE = "asvcgdterategdts"
+TXID = "59f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb"
+OTHER_TXID = "49f7a5a9de7a44ad0f8b0cb95faee0a2a43af1f99ec7cab036b737a4c0f911bb"
+
+
+class StorageTestCase(unittest.TestCase):
+    """
+    Creates a stream with its policy and keys and a temporary directory for the storage
+    """
+    def setUp(self):
+        key = BitcoinVersionedPrivateKey(PRIVATE_KEY)
+        self.private_key = get_priv_key(key)
+        self.policy = Policy("pubaddr", key.public_key().to_hex(), 3, base64.b64encode(NONCE), TXID)
+        self.stream_ident = DataStreamIdentifier(self.policy.owner, self.policy.stream_id,
+                                                 self.policy.get_nonce_bin(), self.policy.txid)
+        self.symmetric_key = os.urandom(32)
+        self.db_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    def create_chunk(self, block_id, num_entries=1, stream_ident=None):
+        chunk = ChunkData()
+        for i in range(num_entries):
+            chunk.add_entry(DoubleEntry(i, "test", float(block_id)))
+        return create_cloud_chunk(stream_ident or self.stream_ident, block_id, self.private_key, 1,
+                                  self.symmetric_key, chunk)
+
+    def create_chunks(self, block_ids, num_entries=1):
+        return [self.create_chunk(block_id, num_entries=num_entries) for block_id in block_ids]
+
+
+class TestLevelDBStorage(StorageTestCase):
+
+    def test_store_check_chunks(self):
+        chunks = decode_cloud_chunk_batch(encode_cloud_chunk_batch(self.create_chunks(range(10))))
+        tags = []
+
+        def get_policy_for_tag(tag):
+            tags.append(tag)
+            return self.policy
+
+        storage = LevelDBStorage(self.db_dir)
+        invalid_chunk = self.create_chunk(11, num_entries=0)
+        with self.assertRaises(InvalidChunkError):
+            storage.store_check_chunks(chunks + [invalid_chunk], get_policy_for_tag, chunk_ids=range(12))
+        self.assertEquals([None] * 10, storage._get_chunks([chunk.key for chunk in chunks]))
+
+        del tags[:]
+        storage.store_check_chunks(chunks, get_policy_for_tag, chunk_ids=range(10))
+        self.assertEquals(1, len(tags))
+        stored = storage._get_chunks([chunk.key for chunk in chunks] + [invalid_chunk.key])
+        self.assertEquals([chunk.encode() for chunk in chunks], [chunk.encode() for chunk in stored[:-1]])
+        self.assertTrue(stored[-1] is None)
+
+    def test_stream_index(self):
+        other_ident = DataStreamIdentifier("pubaddr", 4, NONCE, OTHER_TXID)
+        storage = LevelDBStorage(self.db_dir, stream_index=True)
+        for block_id in [300, 2, 1, 0, 256]:
+            storage._store_chunk(self.create_chunk(block_id), block_id=block_id)
+            storage._store_chunk(self.create_chunk(block_id, stream_ident=other_ident), block_id=block_id)
+        # chunks stored without block id are not indexed
+        storage._store_chunk(self.create_chunk(3))
+
+        result = list(storage._iter_stream_range(self.stream_ident.get_tag(), 1, 300))
+        self.assertEquals([1, 2, 256, 300], [block_id for block_id, _ in result])
+        for block_id, chunk in result:
+            self.assertEquals(self.stream_ident.get_key_for_blockid(block_id), chunk.key)
+        self.assertEquals([], list(storage._iter_stream_range(self.stream_ident.get_tag(), 3, 255)))
+
+    def test_chunk_cache(self):
+        cloud_chunk = self.create_chunk(1)
+        storage = LevelDBStorage(self.db_dir, chunk_cache_bytes=1024 * 1024)
+        storage.store_check_chunk(cloud_chunk, 1, self.policy)
+        first = storage._load_chunk(cloud_chunk.key)
+        self.assertTrue(first is storage._load_chunk(cloud_chunk.key))
+        stats = storage.get_chunk_cache_stats()
+        self.assertEquals((1, 1, 1), (stats["hits"], stats["misses"], stats["chunks"]))
+
+        # a new version of the chunk replaces the cached one
+        cloud_chunk = self.create_chunk(1, num_entries=2)
+        storage.store_check_chunk(cloud_chunk, 1, self.policy)
+        self.assertEquals(0, storage.get_chunk_cache_stats()["chunks"])
+        self.assertEquals(cloud_chunk.encode(), storage._load_chunk(cloud_chunk.key).encode())
+
+        storage.delete_chunk(cloud_chunk.key)
+        self.assertTrue(storage._load_chunk(cloud_chunk.key) is None)
+
+
+class FakeVCClient(object):
+    def __init__(self, policy):
+        self.policy = policy
+
+    def get_policy_with_txid(self, txid):
+        if self.policy is None:
+            raise TalosVCRestClientError("Not Found")
+        return self.policy
+
+
+class TestRestApi(StorageTestCase):
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.storage = LevelDBStorage(self.db_dir, stream_index=True)
+        self.addCleanup(restapi.set_vc_client, restapi.client)
+        self.addCleanup(restapi.set_storage_impl, restapi.storage_impl)
+        restapi.set_storage_impl(self.storage)
+        restapi.set_vc_client(FakeVCClient(self.policy))
+        self.client = restapi.app.test_client()
+
+    def post_chunks(self, chunks, block_ids):
+        response = self.client.post('/store_chunks', data=encode_cloud_chunk_batch(chunks, block_ids=block_ids))
+        return response.status_code, response.get_data()
+
+    def test_store_chunks(self):
+        chunks = self.create_chunks(range(3))
+        self.assertEquals((200, "OK"), self.post_chunks(chunks, [0, 1, 2]))
+        # the bulk path fills the stream index
+        result = list(self.storage._iter_stream_range(self.stream_ident.get_tag(), 0, 2))
+        self.assertEquals([chunk.encode() for chunk in chunks], [chunk.encode() for _, chunk in result])
+
+    def test_store_chunks_invalid(self):
+        chunks = self.create_chunks(range(3, 5))
+        # the block id does not match the key of the chunk
+        self.assertEquals((400, "ERROR Invalid chunk"), self.post_chunks(chunks, [3, 3]))
+        # empty entry
+        self.assertEquals((400, "ERROR Invalid chunk"), self.post_chunks([chunks[0], None], [3, 4]))
+        restapi.set_vc_client(FakeVCClient(None))
+        self.assertEquals((400, "ERROR No policy found"), self.post_chunks(chunks, [3, 4]))
+        self.assertEquals([None, None], self.storage._get_chunks([chunk.key for chunk in chunks]))
+
+
+class TestLogStorage(StorageTestCase):
+
+    def test_log_storage(self):
+        chunks = self.create_chunks(range(20), num_entries=50)
+        storage = LogStorage(self.db_dir, max_segment_bytes=4096)
+        storage._store_chunks(chunks[:10])
+        for chunk in chunks[10:]:
+            storage._store_chunk(chunk)
+        for chunk in chunks[:15]:
+            storage.delete_chunk(chunk.key)
+        self.assertTrue(len(storage.segments) > 1)
+        self.assertTrue(storage.compact() > 0)
+        storage.close()
+
+        # the index is rebuilt from the segments, an incomplete record at the end is dropped
+        with open(storage.active.path, 'ab') as f:
+            f.write("\x00" * 10)
+        storage = LogStorage(self.db_dir, max_segment_bytes=4096)
+        self.assertEquals(5, len(storage))
+        self.assertTrue(storage._get_chunk(chunks[0].key) is None)
+        for chunk in chunks[15:]:
+            self.assertEquals(chunk.encode(), storage._get_chunk(chunk.key).encode())
+        storage.close()
+
+    def test_compact_keeps_corrupted_segment(self):
+        chunks = self.create_chunks(range(10), num_entries=10)
+        # every batch starts a new segment
+        storage = LogStorage(self.db_dir, max_segment_bytes=1)
+        storage._store_chunks(chunks[:5])
+        storage._store_chunks(chunks[5:])
+        segment_id, data_offset, _ = storage.index[chunks[1].key]
+        for chunk in [chunks[0], chunks[2], chunks[3]]:
+            storage.delete_chunk(chunk.key)
+        segment = storage.segments[segment_id]
+        with open(segment.path, 'r+b') as f:
+            f.seek(data_offset)
+            f.write("\xff" * 4)
+
+        # the corrupted record of the live chunk 1 is not copied, chunk 4 behind it is
+        storage.compact()
+        self.assertTrue(storage.segments[segment_id] is segment)
+        self.assertTrue(os.path.exists(segment.path))
+        self.assertNotEquals(segment_id, storage.index[chunks[4].key][0])
+        self.assertEquals(chunks[4].encode(), storage._get_chunk(chunks[4].key).encode())
+        for chunk in [chunks[0], chunks[2], chunks[3]]:
+            self.assertTrue(storage._get_chunk(chunk.key) is None)
+        storage.close()
+
+    def test_reopen_corrupted_segment(self):
+        chunks = self.create_chunks(range(6), num_entries=10)
+        storage = LogStorage(self.db_dir, max_segment_bytes=1)
+        storage._store_chunks(chunks[:3])
+        storage._store_chunks(chunks[3:])
+        segment_id, data_offset, _ = storage.index[chunks[0].key]
+        path = storage.segments[segment_id].path
+        storage.close()
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as f:
+            f.seek(data_offset)
+            f.write("\xff" * 4)
+
+        # the corrupted record is skipped, the sealed segment is not truncated
+        storage = LogStorage(self.db_dir, max_segment_bytes=1)
+        self.assertEquals(size, os.path.getsize(path))
+        self.assertEquals(5, len(storage))
+        self.assertTrue(storage._get_chunk(chunks[0].key) is None)
+        for chunk in chunks[1:]:
+            self.assertEquals(chunk.encode(), storage._get_chunk(chunk.key).encode())
+        storage.close()
+
+
+class TestTieredStorage(StorageTestCase):
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.now = 1000
+        self.cold = LogStorage(os.path.join(self.db_dir, "cold"))
+        hot = LevelDBStorage(os.path.join(self.db_dir, "hot"), stream_index=True)
+        self.storage = TieredStorage(hot, self.cold, max_idle_seconds=100, max_hot_chunks=8,
+                                     clock=lambda: self.now)
+
+    def tearDown(self):
+        self.cold.close()
+        StorageTestCase.tearDown(self)
+
+    def test_tiered_storage(self):
+        chunks = self.create_chunks(range(10))
+        storage = self.storage
+        storage._store_chunks(chunks[:5])
+        self.now += 60
+        storage._store_chunks(chunks[5:])
+        storage._get_chunk(chunks[0].key)
+        # chunks 1 and 2 over capacity
+        self.assertEquals(2, storage.demote())
+        self.now += 60
+        # chunks 3 and 4 idle
+        self.assertEquals(2, storage.demote())
+        self.assertEquals(6, storage.get_num_hot_chunks())
+        self.assertEquals(4, len(self.cold))
+        for chunk in chunks:
+            self.assertEquals(chunk.encode(), storage._get_chunk(chunk.key).encode())
+        # promoted on read
+        self.assertEquals(10, storage.get_num_hot_chunks())
+        storage.delete_chunk(chunks[1].key)
+        self.assertTrue(storage._get_chunk(chunks[1].key) is None)
+
+    def test_stream_range(self):
+        chunks = self.create_chunks(range(10))
+        storage = self.storage
+        storage._store_chunks(chunks, block_ids=range(10))
+        self.now += 200
+        self.assertEquals(10, storage.demote())
+        storage._get_chunk(chunks[2].key)
+        storage.delete_chunk(chunks[5].key)
+
+        # the index entries of demoted chunks are resolved through the cold tier
+        result = list(storage._iter_stream_range(self.stream_ident.get_tag(), 1, 8))
+        self.assertEquals([1, 2, 3, 4, 6, 7, 8], [block_id for block_id, _ in result])
+        for block_id, chunk in result:
+            self.assertEquals(chunks[block_id].encode(), chunk.encode())
+
+    def test_delete_during_demotion(self):
+        chunks = self.create_chunks(range(4))
+        storage = self.storage
+        storage._store_chunks(chunks)
+        self.now += 200
+        cold_store_chunks = self.cold._store_chunks
+
+        def delete_then_store(to_store, block_ids=None):
+            storage.delete_chunk(chunks[0].key)
+            cold_store_chunks(to_store, block_ids=block_ids)
+
+        self.cold._store_chunks = delete_then_store
+        self.assertEquals(3, storage.demote())
+        self.assertTrue(storage._get_chunk(chunks[0].key) is None)
+        self.assertEquals(3, len(self.cold))
+
+    def test_delete_during_promotion(self):
+        chunks = self.create_chunks(range(2))
+        storage = self.storage
+        storage._store_chunks(chunks)
+        self.now += 200
+        self.assertEquals(2, storage.demote())
+        cold_get_chunk = self.cold._get_chunk
+
+        def get_then_delete(chunk_key):
+            chunk = cold_get_chunk(chunk_key)
+            storage.delete_chunk(chunk_key)
+            return chunk
+
+        self.cold._get_chunk = get_then_delete
+        self.assertEquals(chunks[0].encode(), storage._get_chunk(chunks[0].key).encode())
+        self.assertTrue(storage.hot._get_chunk(chunks[0].key) is None)
+        self.assertEquals(0, storage.get_num_hot_chunks())
+
+    def test_promotion_outside_lock(self):
+        chunks = self.create_chunks(range(2))
+        storage = self.storage
+        storage._store_chunks(chunks)
+        self.now += 200
+        self.assertEquals(2, storage.demote())
+        hot_store_chunk = storage.hot._store_chunk
+
+        def store_then_delete(chunk, block_id=None):
+            self.assertFalse(storage.lock.locked())
+            hot_store_chunk(chunk, block_id=block_id)
+            storage.delete_chunk(chunk.key)
+
+        storage.hot._store_chunk = store_then_delete
+        self.assertEquals(chunks[0].encode(), storage._get_chunk(chunks[0].key).encode())
+        self.assertTrue(storage.hot._get_chunk(chunks[0].key) is None)
+        self.assertEquals(0, storage.get_num_hot_chunks())
+
+    def test_untracked_after_delete(self):
+        chunks = self.create_chunks(range(3))
+        storage = self.storage
+        storage._store_chunks(chunks)
+        hot_get_chunk = storage.hot._get_chunk
+
+        def get_then_delete(chunk_key):
+            chunk = hot_get_chunk(chunk_key)
+            storage.delete_chunk(chunk_key)
+            return chunk
+
+        # the read does not track the deleted chunk again
+        storage.hot._get_chunk = get_then_delete
+        storage._get_chunk(chunks[0].key)
+        storage.hot._get_chunk = hot_get_chunk
+        self.assertEquals(2, storage.get_num_hot_chunks())
+
+        # a candidate missing in the hot tier is dropped by the demotion
+        storage.hot._delete_chunk(chunks[1].key)
+        self.now += 200
+        self.assertEquals(1, storage.demote())
+        self.assertEquals(0, storage.get_num_hot_chunks())
@@ -0,0 +1,221 @@
+import threading
+import time
+
+from talosstorage.storage import TalosStorage
+
+"""
+Tiered implementation of the talos storage. Recently stored or read chunks are kept in a hot storage
+(e.g. LevelDBStorage), chunks which were not accessed for a while are demoted to a cold storage
+(e.g. LogStorage or TalosS3Storage). Reads check the hot tier first, chunks read from the cold tier
+are promoted back to the hot tier.
+The stream index (see get_check_stream_range) is kept in the hot tier, its entries stay when a chunk
+is demoted and are resolved through both tiers.
+"""
+
+DEFAULT_MAX_IDLE_SECONDS = 7 * 24 * 3600
+DEFAULT_DEMOTION_BATCH_SIZE = 100
+
+
+class TieredStorage(TalosStorage):
+    """
+    Talos storage with a hot and a cold tier, the demotion follows an idle time and a capacity policy
+    """
+    def __init__(self, hot_storage, cold_storage, max_idle_seconds=DEFAULT_MAX_IDLE_SECONDS,
+                 max_hot_chunks=None, promote_on_read=True, batch_size=DEFAULT_DEMOTION_BATCH_SIZE,
+                 chunk_cache=None, clock=time.time):
+        """
+        :param hot_storage: the hot TalosStorage, must provide iter_chunk_keys (e.g. LevelDBStorage)
+        :param cold_storage: the cold TalosStorage (e.g. LogStorage or TalosS3Storage)
+        :param max_idle_seconds: chunks not stored or read for this time are demoted (None disables)
+        :param max_hot_chunks: the maximum number of chunks in the hot tier, the least recently
+                               accessed chunks are demoted first (None disables)
+        :param promote_on_read: if True, chunks read from the cold tier are stored in the hot tier
+        :param batch_size: number of chunks moved to the cold tier in one batch
+        :param chunk_cache: a ChunkCache object for the decoded chunks (optional)
+        :param clock: function returning the current time in seconds
+        """
+        TalosStorage.__init__(self, chunk_cache=chunk_cache)
+        self.hot = hot_storage
+        self.cold = cold_storage
+        self.max_idle_seconds = max_idle_seconds
+        self.max_hot_chunks = max_hot_chunks
+        self.promote_on_read = promote_on_read
+        self.batch_size = batch_size
+        self.clock = clock
+        self.lock = threading.Lock()
+        self._demotion_lock = threading.Lock()
+        self._demotion_thread = None
+        self._stop_demotion = threading.Event()
+        # chunk key -> (last store or read time, sequence number) of the chunks in the hot tier, the access
+        # times are not persisted, after a restart the chunks of the hot tier count as accessed at startup
+        now = clock()
+        self.last_access = dict((key, (now, 0)) for key in hot_storage.iter_chunk_keys())
+        self._sequence = 0
+        # chunk key -> sequence number of the delete, kept while a demotion or a cold read runs, such that
+        # these do not bring back a chunk deleted in the meantime
+        self._deleted = {}
+        self._num_running = 0
+
+    def _begin_transfer(self):
+        with self.lock:
+            self._num_running += 1
+            return self._sequence
+
+    def _end_transfer(self):
+        with self.lock:
+            self._num_running -= 1
+            if self._num_running == 0:
+                self._deleted.clear()
+
+    def _is_deleted_since(self, chunk_key, sequence):
+        # requires the lock
+        return self._deleted.get(chunk_key, -1) > sequence
+
+    def _touch(self, chunk_keys, tracked_only=False):
+        now = self.clock()
+        with self.lock:
+            for chunk_key in chunk_keys:
+                if tracked_only and chunk_key not in self.last_access:
+                    continue
+                self._sequence += 1
+                self.last_access[chunk_key] = (now, self._sequence)
+
+    def _store_chunk(self, chunk, block_id=None):
+        # touch before the write, a concurrent demotion does not remove the new version
+        self._touch([chunk.key])
+        self.hot._store_chunk(chunk, block_id=block_id)
+
+    def _store_chunks(self, chunks, block_ids=None):
+        self._touch([chunk.key for chunk in chunks])
+        self.hot._store_chunks(chunks, block_ids=block_ids)
+
+    def _get_chunk(self, chunk_key):
+        chunk = self.hot._get_chunk(chunk_key)
+        if chunk is not None:
+            # not tracked again if the chunk was deleted or demoted after the read
+            self._touch([chunk_key], tracked_only=True)
+            return chunk
+        start_sequence = self._begin_transfer()
+        try:
+            chunk = self.cold._get_chunk(chunk_key)
+            if chunk is not None and self.promote_on_read:
+                self._promote(chunk, start_sequence)
+        finally:
+            self._end_transfer()
+        return chunk
+
+    def _promote(self, chunk, start_sequence):
+        with self.lock:
+            # not promoted if the chunk was deleted or stored again since the cold read started
+            if self._is_deleted_since(chunk.key, start_sequence) or chunk.key in self.last_access:
+                return
+            self._sequence += 1
+            self.last_access[chunk.key] = (self.clock(), self._sequence)
+        # the write does not hold the lock, the chunk is tracked before such that a delete removes it
+        self.hot._store_chunk(chunk)
+        with self.lock:
+            if chunk.key not in self.last_access:
+                # deleted (or dropped by a demotion) during the write, the hot copy would be untracked
+                self.hot._delete_chunk(chunk.key)
+
+    def _iter_stream_range_keys(self, policy_tag, start_block_id, end_block_id):
+        return self.hot._iter_stream_range_keys(policy_tag, start_block_id, end_block_id)
+
+    def _delete_chunk(self, chunk_key):
+        with self.lock:
+            self._sequence += 1
+            if self._num_running > 0:
+                self._deleted[chunk_key] = self._sequence
+            self.last_access.pop(chunk_key, None)
+        self.hot._delete_chunk(chunk_key)
+        self.cold._delete_chunk(chunk_key)
+
+    def get_num_hot_chunks(self):
+        with self.lock:
+            return len(self.last_access)
+
+    def _get_demotion_candidates(self):
+        now = self.clock()
+        with self.lock:
+            by_access = sorted(self.last_access.iteritems(), key=lambda item: item[1])
+        num_over_capacity = 0
+        if self.max_hot_chunks is not None:
+            num_over_capacity = max(0, len(by_access) - self.max_hot_chunks)
+        candidates = []
+        for index, (chunk_key, access) in enumerate(by_access):
+            if index < num_over_capacity:
+                candidates.append((chunk_key, access))
+            elif self.max_idle_seconds is not None and now - access[0] >= self.max_idle_seconds:
+                candidates.append((chunk_key, access))
+            else:
+                break
+        return candidates
+
+    def demote(self):
+        """
+        Moves the chunks selected by the idle time and capacity policy to the cold tier.
+        A chunk is only removed from the hot tier if it was not accessed while it was copied, the cold
+        copy is removed again if the chunk was deleted while it was copied.
+        :return: the number of demoted chunks
+        """
+        with self._demotion_lock:
+            candidates = self._get_demotion_candidates()
+            num_demoted = 0
+            for start in range(0, len(candidates), self.batch_size):
+                num_demoted += self._demote_batch(candidates[start:start + self.batch_size])
+            return num_demoted
+
+    def _demote_batch(self, batch):
+        start_sequence = self._begin_transfer()
+        try:
+            chunks = []
+            for chunk_key, access in batch:
+                chunk = self.hot._get_chunk(chunk_key)
+                if chunk is not None:
+                    chunks.append((chunk, access))
+                    continue
+                with self.lock:
+                    # not in the hot tier, e.g. deleted after the candidates were selected
+                    if self.last_access.get(chunk_key) == access:
+                        del self.last_access[chunk_key]
+            self.cold._store_chunks([chunk for chunk, _ in chunks])
+            num_demoted = 0
+            deleted = []
+            for chunk, access in chunks:
+                with self.lock:
+                    if self._is_deleted_since(chunk.key, start_sequence):
+                        deleted.append(chunk.key)
+                        continue
+                    if self.last_access.get(chunk.key) != access:
+                        continue
+                    del self.last_access[chunk.key]
+                    self.hot._delete_chunk(chunk.key)
+                num_demoted += 1
+            # only the demotion writes to the cold tier, no newer version is removed
+            for chunk_key in deleted:
+                self.cold._delete_chunk(chunk_key)
+            return num_demoted
+        finally:
+            self._end_transfer()
+
+    def _demotion_loop(self, interval):
+        while not self._stop_demotion.wait(interval):
+            self.demote()
+
+    def start_demotion(self, interval=600):
+        """
+        Runs the demotion periodically in a background thread
+        :param interval: the seconds between two demotion runs
+        """
+        if self._demotion_thread is not None:
+            return
+        self._stop_demotion.clear()
+        self._demotion_thread = threading.Thread(target=self._demotion_loop, args=(interval,))
+        self._demotion_thread.daemon = True
+        self._demotion_thread.start()
+
+    def stop_demotion(self):
+        if self._demotion_thread is not None:
+            self._stop_demotion.set()
+            self._demotion_thread.join()
+            self._demotion_thread = None